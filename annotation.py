@@ -1,25 +1,236 @@
+import os
+import json
+import time
 import base64
-from openai import OpenAI
+import logging
+import threading
 from key_manager import get_openai_api_key
+from config import OPENAI_RATE_LIMITS, OPENAI_BASE_URL, MODEL_LIST_CACHE
+from rate_limiter import RateLimiter
+from annotation_cache import AnnotationCache, cache_key
+from image_prep import ImagePreprocessor
+from telemetry import Telemetry, percentile
 
-client = OpenAI(api_key=get_openai_api_key())
+# Shared by every annotation path, sequential or parallel
+rate_limiter = RateLimiter(**OPENAI_RATE_LIMITS)
+preprocessor = ImagePreprocessor()
+telemetry = Telemetry()
 
+MAX_TOKENS = 500
+# Rough token cost of one image, used to meter the TPM bucket before the call
+IMAGE_TOKEN_ESTIMATE = 800
+LOW_DETAIL_TOKENS = 85
 
-def available_models() -> list[str]:
-    """Return a list of model identifiers available to the API key.
+_client = None
+_client_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_refresh_callbacks = None  # list of callbacks while a refresh is running
+
+
+def get_client(interactive: bool = True):
+    """Return the shared OpenAI client, creating it on first use.
+
+    Nothing is imported, read or asked for until a request is actually
+    made. With ``interactive=False`` a missing API key gives None instead
+    of a prompt.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            api_key = get_openai_api_key(interactive)
+            if api_key is None:
+                return None
+            # Importing openai is a large part of startup time
+            from openai import OpenAI
+            # Retries are handled by ``rate_limiter`` so that they are budgeted and counted
+            _client = OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, max_retries=0)
+        return _client
+
+
+def _read_model_cache():
+    try:
+        with open(MODEL_LIST_CACHE["path"], "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data["models"], data["fetched_at"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return [], 0
 
-    If the request fails, an empty list is returned.
+
+def require_client():
+    """Return the shared client for a request, never prompting for a key.
+
+    Requests run on UI and worker threads where nobody can answer a prompt;
+    without a configured key they fail instead of blocking every caller.
     """
+    client = get_client(interactive=False)
+    if client is None:
+        raise RuntimeError("OpenAI API key not configured; set the OPENAI_API_KEY environment variable")
+    return client
+
+
+def refresh_models(interactive: bool = False) -> list[str]:
+    """Fetch the model list from the API and store it in the cache file.
+
+    Returns an empty list if there is no API key or the request fails.
+    """
+    client = get_client(interactive)
+    if client is None:
+        return []
     try:  # pragma: no cover - network call
-        return [m.id for m in client.models.list().data]
-    except Exception:
+        models = [m.id for m in client.models.list().data]
+    except Exception as e:
+        logging.warning(f"Could not fetch the model list: {e}")
         return []
+    path = MODEL_LIST_CACHE["path"]
+    try:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": time.time(), "models": models}, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logging.warning(f"Could not save the model list: {e}")
+    return models
+
+
+def _refresh_in_background(on_refresh=None):
+    global _refresh_callbacks
+    with _refresh_lock:
+        if _refresh_callbacks is not None:
+            if on_refresh:
+                _refresh_callbacks.append(on_refresh)
+            return
+        _refresh_callbacks = [on_refresh] if on_refresh else []
+
+    def run():
+        global _refresh_callbacks
+        models = refresh_models()
+        with _refresh_lock:
+            callbacks, _refresh_callbacks = _refresh_callbacks, None
+        if models:
+            for callback in callbacks:
+                callback(models)
+
+    threading.Thread(target=run, name="refresh-models", daemon=True).start()
+
+
+def available_models(refresh: bool = True, on_refresh=None) -> list[str]:
+    """Return a list of model identifiers available to the API key.
+
+    The list comes from a cache file and never waits for the network. When
+    the cache is missing or older than ``MODEL_LIST_CACHE["ttl_hours"]`` it
+    is refreshed on a background thread (unless ``refresh`` is False), and
+    ``on_refresh(models)`` is called from that thread with the new list.
+    Until the first refresh succeeds, an empty list is returned.
+    """
+    models, fetched_at = _read_model_cache()
+    if refresh and time.time() - fetched_at > MODEL_LIST_CACHE["ttl_hours"] * 3600:
+        _refresh_in_background(on_refresh)
+    return models
+
+SYSTEM_MESSAGE = "You are a helpful assistant that describes images."
+
+# Appended to the prompt when several images share one request
+PACK_INSTRUCTIONS = (
+    "Apply the instructions above to each of the {count} images below separately. "
+    "Reply with a JSON object whose keys are the image labels ({labels}) and whose "
+    "values are the descriptions, one per image."
+)
+
+
+def _image_part(image) -> dict:
+    encoded_string = base64.b64encode(image.data).decode("utf-8")
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{image.mime_type};base64,{encoded_string}",
+            "detail": image.detail,
+        },
+    }
+
+
+def build_messages(prompt: str, image) -> list:
+    """Chat messages asking the model to describe ``image``, a
+    :class:`image_prep.PreparedImage`."""
+    return [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": [{"type": "text", "text": prompt}, _image_part(image)]},
+    ]
+
+
+def build_packed_messages(prompt: str, labelled_images) -> list:
+    """Chat messages asking for a JSON object describing every image of
+    ``labelled_images``, a list of ``(label, PreparedImage)``."""
+    labels = [label for label, _ in labelled_images]
+    content = [
+        {"type": "text", "text": prompt},
+        {"type": "text", "text": PACK_INSTRUCTIONS.format(count=len(labels), labels=", ".join(labels))},
+    ]
+    for label, image in labelled_images:
+        content += [{"type": "text", "text": f"{label}:"}, _image_part(image)]
+    return [{"role": "system", "content": SYSTEM_MESSAGE}, {"role": "user", "content": content}]
+
+
+def parse_packed_response(text: str, labels) -> dict:
+    """Return ``{label: annotation}`` for every label answered with a
+    non-empty string in the JSON object ``text``; others are left out."""
+    text = text.strip()
+    if text.startswith("```"):
+        # Tolerate a fenced code block around the JSON
+        text = text.strip("`").removeprefix("json").strip()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {label: data[label].strip() for label in labels
+            if isinstance(data.get(label), str) and data[label].strip()}
+
+
+def _create_completion(model, messages, cost, stats=None, **kwargs):
+    """Send one chat request through the shared rate limiter and return the
+    parsed response. ``stats`` receives the limiter's per-call timings."""
+    raw = rate_limiter.call(
+        lambda: require_client().chat.completions.with_raw_response.create(model=model, messages=messages, **kwargs),
+        cost_tokens=cost,
+        headers_of=lambda raw: raw.headers,
+        stats=stats,
+    )
+    return raw.parse()
+
+
+def _record_call(kind, model, images, image_bytes, stats, usage=None, outcome="ok", error=None):
+    telemetry.record(
+        kind,
+        model,
+        images=images,
+        image_bytes=image_bytes,
+        prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+        completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+        outcome=outcome,
+        error=error,
+        **stats,
+    )
+
+
+def estimate_tokens(prompt: str, image) -> int:
+    """Upper estimate of the tokens one request for ``image`` will use."""
+    image_tokens = LOW_DETAIL_TOKENS if image.detail == "low" else IMAGE_TOKEN_ESTIMATE
+    return len(prompt) // 4 + image_tokens + MAX_TOKENS
+
 
 class AnnotationManager:
-    @staticmethod
-    def generate_annotation(image_path: str, prompt: str, model: str) -> str:
+    def __init__(self, cache=None):
+        """``cache`` defaults to an :class:`AnnotationCache` configured by
+        ``config.ANNOTATION_CACHE``."""
+        self.cache = cache if cache is not None else AnnotationCache()
+
+    def generate_annotation(self, image_path: str, prompt: str, model: str, use_cache: bool = True,
+                            stream: bool = False):
         """Generate an annotation for ``image_path`` using OpenAI.
 
+        A cached response for the same image content, prompt and model is
+        returned without calling the API.
+
         Parameters
         ----------
         image_path : str
@@ -28,38 +239,171 @@ class AnnotationManager:
             Instructional prompt sent to the model.
         model : str
             OpenAI model identifier.
+        use_cache : bool
+            Set to False to bypass the cache lookup and request a fresh
+            annotation, which then replaces the cached one.
+        stream : bool
+            Return an iterator of text deltas as the model produces them
+            instead of waiting for the whole annotation. Nothing is sent
+            until the iterator is first advanced.
 
         Returns
         -------
-        str
-            The annotation text returned by the model.
+        str or iterator of str
+            The annotation text returned by the model, or its deltas when
+            ``stream`` is set. Joined and stripped, the deltas give the same
+            text, which is cached once the stream ends.
         """
+        deltas = self._annotate(image_path, prompt, model, use_cache, stream)
+        return deltas if stream else "".join(deltas)
 
+    def _annotate(self, image_path, prompt, model, use_cache, stream):
         try:
             with open(image_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
+                image_bytes = image_file.read()
         except OSError as exc:
             raise FileNotFoundError(f"Could not read image: {image_path}") from exc
 
+        key = cache_key(image_bytes, prompt, model, preprocessor.settings)
+        if use_cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                yield cached
+                return
+
+        # Downscaled and re-encoded in a worker process; the cache key above
+        # uses the original bytes plus the pre-processing settings
+        image = preprocessor.prepare(image_bytes, image_path)
+        yield from self._request(image, key, prompt, model, stream)
+
+    def _request(self, image, key, prompt, model, stream):
+        """Annotate an already prepared ``image`` with one request and cache
+        the answer under ``key``."""
+        messages = build_messages(prompt, image)
+        cost = estimate_tokens(prompt, image)
+
+        kind = "stream" if stream else "single"
+        stats = {}
+        options = {"stream_options": {"include_usage": True}} if stream else {}
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that describes images."},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": f"data:image/jpeg;base64,{encoded_string}"},
-                            },
-                        ],
-                    },
-                ],
-                max_tokens=500,
-            )
+            # Only opening the request is retried; a stream that breaks
+            # halfway fails the annotation
+            response = _create_completion(model, messages, cost, stats, max_tokens=MAX_TOKENS, stream=stream,
+                                          **options)
+            if not stream:
+                annotation = response.choices[0].message.content.strip()
+                usage = response.usage
+            else:
+                opened = time.perf_counter()
+                parts = []
+                usage = None
+                for chunk in response:
+                    usage = getattr(chunk, "usage", None) or usage
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if not delta or not (parts or delta.strip()):
+                        continue
+                    if not parts:
+                        delta = delta.lstrip()
+                    parts.append(delta)
+                    yield delta
+                annotation = "".join(parts).strip()
+                # Latency of a stream runs until its last chunk
+                stats["latency"] = stats.get("latency", 0.0) + time.perf_counter() - opened
         except Exception as exc:  # pragma: no cover - network call
-            raise RuntimeError("Failed to generate annotation") from exc
+            _record_call(kind, model, 1, len(image.data), stats, outcome="error", error=str(exc))
+            raise RuntimeError(f"Failed to generate annotation: {exc}") from exc
+
+        _record_call(kind, model, 1, len(image.data), stats, usage)
+        self.cache.put(key, model, annotation)
+        if not stream:
+            yield annotation
+
+    def generate_annotations(self, image_paths, prompt: str, model: str, use_cache: bool = True):
+        """Annotate several images with a single request.
+
+        The prompt and system message are sent once for all of them and the
+        model is asked for a JSON object keyed by image label. Every image
+        whose entry is missing or invalid, or all of them if the request
+        fails, is annotated on its own, reusing its prepared payload.
+
+        Returns
+        -------
+        tuple
+            ``(results, report)``: ``results`` holds an annotation or the
+            exception raised for each of ``image_paths``, in order.
+            ``report`` counts ``images``, ``packed`` and ``fallback`` images,
+            the ``prompt_tokens``/``completion_tokens`` of the packed request,
+            the estimated ``tokens_saved`` and ``requests_saved`` against one
+            request per image, and ``elapsed`` seconds. ``latency_saved`` is
+            the measured latency of the packed request against that of as
+            many single requests, at the median single-request latency seen
+            in telemetry (0 while there is none to compare with).
+        """
+        started = time.perf_counter()
+        results = [None] * len(image_paths)
+        pending = []
+        for position, image_path in enumerate(image_paths):
+            try:
+                with open(image_path, "rb") as image_file:
+                    image_bytes = image_file.read()
+            except OSError as exc:
+                results[position] = FileNotFoundError(f"Could not read image: {image_path} ({exc})")
+                continue
+            key = cache_key(image_bytes, prompt, model, preprocessor.settings)
+            cached = self.cache.get(key) if use_cache else None
+            if cached is not None:
+                results[position] = cached
+            else:
+                pending.append((position, image_path, key, preprocessor.prepare(image_bytes, image_path)))
+
+        report = {"images": len(image_paths), "packed": 0, "fallback": 0, "prompt_tokens": 0,
+                  "completion_tokens": 0, "tokens_saved": 0, "requests_saved": 0, "latency_saved": 0.0,
+                  "elapsed": 0.0}
+        answers = {}
+        packed_latency = 0.0
+        labels = [f"image_{number}" for number in range(1, len(pending) + 1)]
+        if len(pending) > 1:
+            messages = build_packed_messages(prompt, [(label, item[3]) for label, item in zip(labels, pending)])
+            cost = sum(estimate_tokens("", item[3]) for item in pending) + len(prompt) // 4
+            image_bytes = sum(len(item[3].data) for item in pending)
+            stats = {}
+            try:
+                response = _create_completion(model, messages, cost, stats, max_tokens=MAX_TOKENS * len(pending),
+                                              response_format={"type": "json_object"})
+                packed_latency = stats.get("latency", 0.0)
+                answers = parse_packed_response(response.choices[0].message.content or "", labels)
+                if response.usage:
+                    report["prompt_tokens"] = response.usage.prompt_tokens
+                    report["completion_tokens"] = response.usage.completion_tokens
+                _record_call("packed", model, len(answers), image_bytes, stats, response.usage,
+                             outcome="ok" if answers else "invalid")
+            except Exception as e:  # pragma: no cover - network call
+                _record_call("packed", model, 0, image_bytes, stats, outcome="error", error=str(e))
+                logging.warning(f"Packed request for {len(pending)} images failed, annotating one by one: {e}")
+
+        for label, (position, image_path, key, image) in zip(labels, pending):
+            if label in answers:
+                results[position] = answers[label]
+                self.cache.put(key, model, answers[label])
+                report["packed"] += 1
+                continue
+            if len(pending) > 1:
+                report["fallback"] += 1
+            try:
+                results[position] = "".join(self._request(image, key, prompt, model, stream=False))
+            except Exception as e:
+                results[position] = e
 
-        return response.choices[0].message.content.strip()
+        if report["packed"] > 1:
+            report["requests_saved"] = report["packed"] - 1
+            report["tokens_saved"] = report["requests_saved"] * (len(prompt) + len(SYSTEM_MESSAGE)) // 4
+            single = [entry["latency"] for entry in telemetry.records()
+                      if entry["kind"] == "single" and entry["model"] == model and entry["outcome"] == "ok"]
+            if single:
+                report["latency_saved"] = report["packed"] * percentile(single, 0.5) - packed_latency
+        report["elapsed"] = time.perf_counter() - started
+        logging.info(f"Packed {report['packed']} of {report['images']} images in one request "
+                     f"({report['fallback']} fell back) in {report['elapsed']:.1f}s, "
+                     f"~{report['tokens_saved']} prompt tokens, {report['requests_saved']} requests and "
+                     f"{report['latency_saved']:.1f}s of request latency saved")
+        return results, report
@@ -0,0 +1,131 @@
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from config import ANNOTATION_CACHE
+
+
+def cache_key(image_bytes: bytes, prompt: str, model: str, preprocessing: str = "") -> str:
+    """Content address of a request: the image bytes, the prompt, the model
+    and the pre-processing settings (:attr:`ImagePreprocessor.settings`)."""
+    digest = hashlib.sha256(image_bytes)
+    for part in (prompt, model, preprocessing):
+        digest.update(b"\0" + part.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class AnnotationCache:
+    """Persistent cache of model responses keyed by :func:`cache_key`.
+
+    The same image annotated again with the same prompt and model - even
+    when Gradio hands it over under a new temporary path - is answered from
+    SQLite instead of the API. Entries older than ``max_age_days`` expire and
+    the least recently used ones are evicted beyond ``max_entries``.
+    """
+
+    # Eviction runs on open and after this many new entries
+    EVICT_EVERY = 100
+
+    def __init__(self, db_name=ANNOTATION_CACHE["path"], max_entries=ANNOTATION_CACHE["max_entries"],
+                 max_age_days=ANNOTATION_CACHE["max_age_days"], enabled=ANNOTATION_CACHE["enabled"]):
+        self.db_name = db_name
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.enabled = enabled
+        self.hits = self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if enabled:
+            self._open()
+
+    def _open(self):
+        # Lookups are single-row, so one connection behind a lock is enough
+        self._conn = sqlite3.connect(self.db_name, timeout=30.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS annotation_cache
+                              (key TEXT PRIMARY KEY,
+                               model TEXT,
+                               annotation TEXT NOT NULL,
+                               created_at REAL NOT NULL,
+                               used_at REAL NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_used ON annotation_cache(used_at)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key):
+        """Return the cached annotation for ``key``, or None."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT annotation, created_at FROM annotation_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self.max_age and row[1] < now - self.max_age:
+                row = None
+            if row:
+                self._conn.execute("UPDATE annotation_cache SET used_at = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, model, annotation):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO annotation_cache (key, model, annotation, created_at, used_at)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (key, model, annotation, now, now),
+            )
+            self._conn.commit()
+            self._puts += 1
+            evict = self._puts % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """Drop expired entries and the least recently used ones beyond
+        ``max_entries``. Returns the number of entries removed."""
+        if not self.enabled:
+            return 0
+        with self._lock:
+            removed = 0
+            if self.max_age:
+                removed += self._conn.execute(
+                    "DELETE FROM annotation_cache WHERE created_at < ?", (time.time() - self.max_age,)
+                ).rowcount
+            if self.max_entries:
+                removed += self._conn.execute(
+                    """DELETE FROM annotation_cache WHERE key IN
+                       (SELECT key FROM annotation_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)""",
+                    (self.max_entries,),
+                ).rowcount
+            self._conn.commit()
+        if removed:
+            logging.info(f"Evicted {removed} cached annotations")
+        return removed
+
+    def clear(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM annotation_cache")
+            self._conn.commit()
+
+    def __len__(self):
+        if not self.enabled:
+            return 0
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM annotation_cache").fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,175 @@
+import time
+import contextvars
+from collections import namedtuple
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import ANNOTATION_CONCURRENCY
+
+AnnotationResult = namedtuple("AnnotationResult", "index image_path annotation error elapsed")
+
+
+class AnnotationEngine:
+    """Annotate many images with a bounded pool of concurrent requests.
+
+    Folder runs spend nearly all their time waiting on the network, so
+    keeping ``concurrency`` requests in flight divides wall-clock time by
+    roughly that factor. Only ``concurrency`` images are submitted at a time,
+    which keeps memory flat for any folder size.
+    """
+
+    def __init__(self, generate, concurrency=ANNOTATION_CONCURRENCY, limiter=None, preprocessor=None,
+                 generate_many=None, pack_size=1):
+        """``generate(image_path, prompt, model)`` returns the annotation text,
+        e.g. :meth:`AnnotationManager.generate_annotation`. ``limiter`` is the
+        :class:`RateLimiter` ``generate`` goes through and ``preprocessor``
+        the :class:`ImagePreprocessor`; their throttle, retry and byte counts
+        for the run are added to the summary.
+
+        With ``pack_size`` above 1, ``generate_many(image_paths, prompt,
+        model)`` - e.g. :meth:`AnnotationManager.generate_annotations` - is
+        given that many images per request and returns ``(results, report)``;
+        ``concurrency`` then counts requests, not images."""
+        self.generate = generate
+        self.concurrency = max(1, int(concurrency))
+        self.limiter = limiter
+        self.preprocessor = preprocessor
+        self.generate_many = generate_many
+        self.pack_size = max(1, int(pack_size)) if generate_many else 1
+
+    def _annotate(self, items, prompt, model):
+        """Annotate ``(index, image_path)`` items; return their results and the packing report."""
+        started = time.perf_counter()
+        if len(items) > 1:
+            try:
+                annotations, report = self.generate_many([path for _, path in items], prompt, model)
+            except Exception as e:
+                annotations, report = [e] * len(items), None
+            elapsed = (time.perf_counter() - started) / len(items)
+            return [AnnotationResult(index, path, None, annotation, elapsed)
+                    if isinstance(annotation, Exception)
+                    else AnnotationResult(index, path, annotation, None, elapsed)
+                    for (index, path), annotation in zip(items, annotations)], report
+
+        index, image_path = items[0]
+        try:
+            annotation = self.generate(image_path, prompt, model)
+            return [AnnotationResult(index, image_path, annotation, None, time.perf_counter() - started)], None
+        except Exception as e:
+            # A failing image must not take the rest of the run down with it
+            return [AnnotationResult(index, image_path, None, e, time.perf_counter() - started)], None
+
+    def run(self, image_paths, prompt, model, on_result=None, progress=None, should_stop=None) -> dict:
+        """Annotate ``image_paths`` and report each :class:`AnnotationResult`.
+
+        Parameters
+        ----------
+        on_result : callable, optional
+            Called with every result **in input order**, whatever order the
+            requests finish in, so rows reach the database in the order the
+            images were given.
+        progress : callable, optional
+            Called as ``progress(done, total)`` as requests finish.
+        should_stop : callable, optional
+            Polled before each submission; returning true stops submitting
+            new images. Requests already in flight are still reported.
+
+        Returns
+        -------
+        dict
+            ``total``, ``annotated``, ``failed``, ``errors`` (first ten
+            messages) and ``elapsed`` seconds, plus ``throttled`` and
+            ``retried`` request counts when a limiter is set,
+            ``bytes_in``/``bytes_out`` of uploaded images when a
+            preprocessor is set and ``packing``, the packing reports summed,
+            when images are packed.
+        """
+        started = time.perf_counter()
+        limits_before = self.limiter.stats() if self.limiter else None
+        prep_before = self.preprocessor.stats() if self.preprocessor else None
+        image_paths = list(image_paths)
+        total = len(image_paths)
+        queue = iter(enumerate(image_paths))
+        ready = {}
+        next_index = 0
+        done = annotated = failed = 0
+        errors = []
+        packing = {}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="annotate") as pool:
+            futures = set()
+
+            def submit_next():
+                if should_stop and should_stop():
+                    return
+                items = list(islice(queue, self.pack_size))
+                if items:
+                    # Workers see the caller's context variables, such as the telemetry run id
+                    futures.add(pool.submit(contextvars.copy_context().run, self._annotate, items, prompt, model))
+
+            for _ in range(self.concurrency):
+                submit_next()
+
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    futures.discard(future)
+                    results, report = future.result()
+                    for name, value in (report or {}).items():
+                        packing[name] = packing.get(name, 0) + value
+                    for result in results:
+                        ready[result.index] = result
+                        done += 1
+                        if result.error is None:
+                            annotated += 1
+                        else:
+                            failed += 1
+                            if len(errors) < 10:
+                                errors.append(f"{result.image_path}: {result.error}")
+                    if progress:
+                        progress(done, total)
+                    submit_next()
+                # Release results in input order
+                while next_index in ready:
+                    result = ready.pop(next_index)
+                    next_index += 1
+                    if on_result:
+                        on_result(result)
+
+        summary = {
+            "total": total,
+            "annotated": annotated,
+            "failed": failed,
+            "errors": errors,
+            "elapsed": time.perf_counter() - started,
+        }
+        if packing:
+            summary["packing"] = packing
+        if limits_before is not None:
+            limits = self.limiter.stats()
+            for name in ("throttled", "retried"):
+                summary[name] = limits[name] - limits_before[name]
+        if prep_before is not None:
+            prep = self.preprocessor.stats()
+            for name in ("bytes_in", "bytes_out"):
+                summary[name] = prep[name] - prep_before[name]
+        return summary
+
+
+def summary_text(summary: dict) -> str:
+    """One-line description of an :meth:`AnnotationEngine.run` result."""
+    text = (f"Annotated {summary['annotated']} of {summary['total']} images, "
+            f"{summary['failed']} failed in {summary['elapsed']:.1f}s")
+    if "throttled" in summary:
+        text += f" ({summary['throttled']} throttled, {summary['retried']} retried)"
+    packing = summary.get("packing")
+    if packing and packing.get("images"):
+        text += (f"\nPacked {packing['packed']} images ({packing['fallback']} fell back to single requests): "
+                 f"{packing['requests_saved']} requests, ~{packing['tokens_saved']} prompt tokens and "
+                 f"{packing['latency_saved']:.1f}s of request latency saved")
+    if summary.get("bytes_in"):
+        saved = summary["bytes_in"] - summary["bytes_out"]
+        text += (f"\nUploaded {summary['bytes_out'] / 1e6:.1f} MB instead of {summary['bytes_in'] / 1e6:.1f} MB "
+                 f"({saved * 100 / summary['bytes_in']:.0f}% saved)")
+    if summary["errors"]:
+        text += "\n" + "\n".join(summary["errors"])
+    return text
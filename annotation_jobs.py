@@ -0,0 +1,99 @@
+import os
+from contextlib import nullcontext
+from annotation_engine import AnnotationEngine, summary_text as engine_summary_text
+from config import ANNOTATION_CONCURRENCY
+from telemetry import report_text
+
+
+def job_source(image_paths):
+    """Name a set of images by the folder they share, to find their job again."""
+    image_paths = list(image_paths)
+    if not image_paths:
+        return ""
+    try:
+        return os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in image_paths])
+    except ValueError:
+        # Paths on different drives
+        return ""
+
+
+def run_annotation_job(db, image_paths, prompt, model, generate, source=None,
+                       concurrency=ANNOTATION_CONCURRENCY, force=False, failed_only=False,
+                       limiter=None, preprocessor=None, generate_many=None, pack_size=1, telemetry=None,
+                       progress=None, should_stop=None, on_error=None) -> dict:
+    """Annotate ``image_paths`` as a checkpointed job in ``db``.
+
+    The job for the same ``source``, prompt and model is resumed if an
+    earlier run did not finish: images already done are not requested again,
+    and tasks left running by a crash start over. Each annotation is
+    committed together with its task state, so at most the requests in
+    flight are lost when the process dies.
+
+    Parameters
+    ----------
+    db : DatabaseManager or BlockingDatabase
+        Database holding annotations and job state.
+    generate, generate_many : callable
+        Single and packed annotation functions, see :class:`AnnotationEngine`.
+    source : str, optional
+        Job identity; defaults to the folder the images share.
+    force : bool
+        Also annotate images that already have annotation text.
+    failed_only : bool
+        Only re-run the tasks that failed last time.
+    telemetry : Telemetry, optional
+        Recorder of the API calls; its report for the run is included.
+    on_error : callable, optional
+        Called with every failed :class:`AnnotationResult`.
+
+    Returns
+    -------
+    dict
+        The :meth:`AnnotationEngine.run` summary plus ``job_id``,
+        ``resumed``, ``skipped`` (already annotated) and ``tasks``, the
+        task counts by state after the run, and ``telemetry``, the
+        :meth:`Telemetry.report` of the run's API calls, if requested.
+    """
+    source = job_source(image_paths) if source is None else source
+    job_id, resumed = db.open_job(source, prompt, model)
+    skipped = 0
+    if not failed_only:
+        _, skipped = db.add_job_tasks(job_id, image_paths, force)
+    paths = db.start_job_tasks(job_id, ("failed",) if failed_only else ("pending", "running", "failed"))
+
+    engine = AnnotationEngine(generate, concurrency, limiter=limiter, preprocessor=preprocessor,
+                              generate_many=generate_many, pack_size=pack_size)
+    buffer = db.write_behind(write_rows=lambda rows: db.complete_job_tasks(job_id, rows))
+
+    def store(result):
+        if result.error is None:
+            buffer.add(result.image_path, result.annotation)
+        else:
+            db.fail_job_task(job_id, result.image_path, result.error)
+            if on_error:
+                on_error(result)
+
+    # Calls of this run are tagged, so runs going on at the same time
+    # (several Gradio sessions) are reported separately
+    tagged = telemetry.tag_run() if telemetry is not None else nullcontext()
+    try:
+        with tagged as run_id, buffer:
+            summary = engine.run(paths, prompt, model, on_result=store, progress=progress, should_stop=should_stop)
+    finally:
+        tasks = db.finish_job(job_id)
+    summary.update(job_id=job_id, resumed=resumed, skipped=skipped, tasks=tasks)
+    if telemetry is not None:
+        summary["telemetry"] = telemetry.report(run_id=run_id)
+    return summary
+
+
+def summary_text(summary: dict) -> str:
+    """Description of a :func:`run_annotation_job` result."""
+    tasks = summary["tasks"]
+    text = (f"{'Resumed' if summary['resumed'] else 'Started'} job #{summary['job_id']}: "
+            f"{tasks['done']} done, {tasks['failed']} failed, {tasks['pending']} left, "
+            f"{summary['skipped']} already annotated\n")
+    text += engine_summary_text(summary)
+    if summary.get("telemetry"):
+        text += "\n" + report_text(summary["telemetry"])
+    return text
@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from database import DatabaseManager, WriteBehindBuffer
+
+# DatabaseManager methods that modify the database and go to the writer thread
+WRITE_METHODS = frozenset({
+    "insert_or_update_annotation",
+    "insert_or_update_annotations",
+    "insert_annotation",
+    "update_annotation",
+    "update_image_path",
+    "update_annotation_status",
+    "approve_all_annotations",
+    "delete_annotation",
+    "clear_database",
+    "record_caption_files",
+    "forget_caption_files",
+    "prune_changes",
+    "record_batch",
+    "update_batch",
+    "open_job",
+    "add_job_tasks",
+    "start_job_tasks",
+    "complete_job_tasks",
+    "fail_job_task",
+    "finish_job",
+})
+
+# Bulk writes that commit in chunks of their own. They run on a thread of
+# their own so a long import does not hold up the writer queue; between
+# chunks other writes take SQLite's write lock in turn.
+BULK_METHODS = frozenset({
+    "import_annotations",
+    "import_file",
+})
+
+
+class AsyncDatabase:
+    """Awaitable facade over :class:`DatabaseManager` for async handlers.
+
+    Writes are queued to a single dedicated writer thread, so concurrent
+    users never compete for SQLite's write lock inside this process. Reads
+    run on a pool of threads, each with its own WAL connection, and proceed
+    while a write is in progress. Imports (:data:`BULK_METHODS`) get a
+    thread of their own. Every ``DatabaseManager`` method is
+    available as a coroutine, e.g. ``await adb.get_annotation(path)``.
+
+    Unlike the synchronous manager, failures are raised rather than logged
+    and turned into ``False``, after the manager's busy retries are spent.
+    """
+
+    def __init__(self, db_name="annotations.db", readers=4, **kwargs):
+        self.db = DatabaseManager(db_name, raise_errors=True, **kwargs)
+        self._writer_ident = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer",
+                                          initializer=self._register_writer)
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+
+    def _register_writer(self):
+        self._writer_ident = threading.get_ident()
+
+    def write(self, fn, *args, **kwargs):
+        """Run ``fn(*args, **kwargs)`` on the writer thread and wait for it.
+
+        For worker threads; called on the writer thread itself, ``fn`` runs
+        directly instead of deadlocking on its own queue.
+        """
+        if threading.get_ident() == self._writer_ident:
+            return fn(*args, **kwargs)
+        return self._writer.submit(fn, *args, **kwargs).result()
+
+    async def run(self, fn, *args, write=False, **kwargs):
+        """Run ``fn(*args, **kwargs)`` on the writer thread or the reader pool."""
+        loop = asyncio.get_running_loop()
+        executor = self._writer if write else self._readers
+        return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+        write = name in WRITE_METHODS
+
+        async def call(*args, **kwargs):
+            if name in BULK_METHODS:
+                return await asyncio.to_thread(method, *args, **kwargs)
+            return await self.run(method, *args, write=write, **kwargs)
+
+        call.__name__ = name
+        return call
+
+    def write_behind(self, max_rows=50, max_delay=2.0, write_rows=None):
+        """Return a :class:`WriteBehindBuffer` whose batches go through the writer thread.
+
+        Batches are annotation upserts, or calls to ``write_rows(rows)``.
+        """
+        write_rows = write_rows or self.db.insert_or_update_annotations
+        return WriteBehindBuffer(functools.partial(self.write, write_rows), max_rows, max_delay)
+
+    def blocking(self):
+        """Return a :class:`BlockingDatabase` for code running on worker threads."""
+        return BlockingDatabase(self)
+
+    def close(self):
+        """Finish queued work, stop the threads and close their connections."""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.db.close()
+
+
+class BlockingDatabase:
+    """Synchronous view of an :class:`AsyncDatabase` for worker threads.
+
+    Code written against :class:`DatabaseManager`, such as
+    :func:`run_annotation_job` run through ``asyncio.to_thread``, can use
+    it unchanged: methods in :data:`WRITE_METHODS` and write-behind batches
+    still go through the single writer thread, while reads run directly on
+    the calling thread's own connection.
+    """
+
+    def __init__(self, adb: AsyncDatabase):
+        self._adb = adb
+
+    def __getattr__(self, name):
+        method = getattr(self._adb.db, name)
+        if not callable(method) or name not in WRITE_METHODS:
+            return method
+        return functools.partial(self._adb.write, method)
+
+    def write_behind(self, max_rows=50, max_delay=2.0, write_rows=None):
+        return self._adb.write_behind(max_rows, max_delay, write_rows)
@@ -0,0 +1,293 @@
+"""Annotate large image sets through the OpenAI Batch API.
+
+Batch requests cost half as much as synchronous ones and are not subject to
+the interactive rate limits, in exchange for results arriving within 24
+hours. Submitted batches are recorded in ``annotations.db``, so polling and
+importing pick up where they left off after a restart::
+
+    python batch_annotate.py submit --folder images/ --model gpt-4o
+    python batch_annotate.py submit --unannotated
+    python batch_annotate.py poll --wait
+    python batch_annotate.py status
+
+Set ``OPENAI_BASE_URL`` in ``config.py`` (or the environment) to run against
+a local server implementing the files and batches endpoints.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from database import DatabaseManager
+from annotation import get_client, require_client, preprocessor, build_messages, MAX_TOKENS
+from annotation_cache import AnnotationCache, cache_key
+from config import DEFAULT_PROMPT
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Limits of a single batch input file, with some headroom on the size
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+TERMINAL_STATUSES = frozenset({"completed", "failed", "expired", "cancelled"})
+
+
+def folder_images(folder_path):
+    """Return the image files directly inside ``folder_path``, sorted by name."""
+    return [os.path.join(folder_path, name) for name in sorted(os.listdir(folder_path))
+            if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+class BatchAnnotator:
+    """Build, submit, poll and import Batch API annotation jobs.
+
+    Images already answered by the :class:`AnnotationCache` are written to
+    the database straight away and never sent. Every batch and the image
+    behind each of its requests is stored in the database, which is the only
+    state needed to resume.
+    """
+
+    def __init__(self, db, prompt=DEFAULT_PROMPT, model="gpt-4-turbo", client=None, cache=None,
+                 prepare_workers=8):
+        self.db = db
+        self.prompt = prompt
+        self.model = model
+        self.client = client or require_client()
+        self.cache = cache if cache is not None else AnnotationCache()
+        self.prepare_workers = prepare_workers
+
+    def _prepare(self, image_path):
+        """Return ``(image_path, cache_key, cached_annotation, request_body)``."""
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+        key = cache_key(image_bytes, self.prompt, self.model, preprocessor.settings)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return image_path, key, cached, None
+        image = preprocessor.prepare(image_bytes, image_path)
+        body = {"model": self.model, "messages": build_messages(self.prompt, image), "max_tokens": MAX_TOKENS}
+        return image_path, key, None, body
+
+    def _prepared(self, image_paths, errors):
+        """Yield :meth:`_prepare` results, encoding a slice of images at a time."""
+        paths = iter(image_paths)
+        with ThreadPoolExecutor(max_workers=self.prepare_workers) as pool:
+            while True:
+                chunk = list(islice(paths, self.prepare_workers * 8))
+                if not chunk:
+                    return
+                futures = [(path, pool.submit(self._prepare, path)) for path in chunk]
+                for path, future in futures:
+                    try:
+                        yield future.result()
+                    except OSError as e:
+                        logging.error(f"Skipping {path}: {e}")
+                        errors.append(f"{path}: {e}")
+
+    def _submit_file(self, path, items):
+        with open(path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+            metadata={"source": "annotate"},
+        )
+        self.db.record_batch(batch.id, input_file.id, self.model, batch.status, items)
+        logging.info(f"Submitted batch {batch.id} with {len(items)} requests")
+        return batch.id
+
+    def submit(self, image_paths, progress=None, force=False) -> dict:
+        """Send ``image_paths`` as one or more batches.
+
+        Images already queued in an open batch are skipped, so submitting the
+        same folder again after a crash does not pay for them twice. Images
+        that already have annotation text are skipped too unless ``force`` is
+        set, so edited or approved annotations are never replaced.
+        ``progress(done)`` is called as images are prepared.
+
+        Returns
+        -------
+        dict
+            ``batches`` (ids), ``requests`` sent, ``cached`` answered from the
+            cache, ``skipped`` already queued, ``annotated`` skipped for
+            having text and ``errors``.
+        """
+        queued = self.db.get_open_batch_paths()
+        pending = [path for path in image_paths if path not in queued]
+        annotated = set() if force else self.db.get_annotated_paths(pending)
+        summary = {"batches": [], "requests": 0, "cached": 0, "skipped": len(image_paths) - len(pending),
+                   "annotated": len(annotated), "errors": []}
+        pending = [path for path in pending if path not in annotated]
+
+        with tempfile.TemporaryDirectory(prefix="annotate-batch-") as workdir:
+            fp = path = None
+            items, size, cached_rows = [], 0, []
+
+            def flush():
+                nonlocal fp, items, size
+                if fp is None:
+                    return
+                fp.close()
+                summary["batches"].append(self._submit_file(path, items))
+                summary["requests"] += len(items)
+                os.remove(path)
+                fp, items, size = None, [], 0
+
+            for done, (image_path, key, cached, body) in enumerate(
+                    self._prepared(pending, summary["errors"]), start=1):
+                if cached is not None:
+                    cached_rows.append((image_path, cached))
+                else:
+                    body = json.dumps(body)
+                    if fp is not None and (len(items) >= MAX_BATCH_REQUESTS
+                                           or size + len(body) + 100 > MAX_BATCH_BYTES):
+                        flush()
+                    custom_id = f"img-{len(items)}"
+                    line = (f'{{"custom_id": "{custom_id}", "method": "POST", '
+                            f'"url": "{BATCH_ENDPOINT}", "body": {body}}}\n')
+                    if fp is None:
+                        path = os.path.join(workdir, f"requests-{len(summary['batches'])}.jsonl")
+                        fp = open(path, "w", encoding="utf-8")
+                    fp.write(line)
+                    size += len(line)
+                    items.append((custom_id, image_path, key))
+                if progress:
+                    progress(done)
+            flush()
+
+        if cached_rows:
+            self.db.insert_or_update_annotations(cached_rows)
+        summary["cached"] = len(cached_rows)
+        return summary
+
+    def import_results(self, batch_id, output_file_id, model=None, chunk_size=1000):
+        """Stream the output file of ``batch_id`` into the database.
+
+        Rows are upserted ``chunk_size`` at a time, so importing again after
+        an interruption is harmless. Returns ``(imported, failed)``.
+        """
+        items = self.db.get_batch_items(batch_id)
+        imported = failed = 0
+        rows = []
+        with self.client.files.with_streaming_response.content(output_file_id) as response:
+            for line in response.iter_lines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                image_path, key = items.get(result.get("custom_id"), (None, None))
+                response_data = result.get("response") or {}
+                if image_path is None or result.get("error") or response_data.get("status_code") != 200:
+                    failed += 1
+                    logging.error(f"Batch {batch_id} request {result.get('custom_id')} failed: "
+                                  f"{result.get('error') or response_data.get('body')}")
+                    continue
+                annotation = response_data["body"]["choices"][0]["message"]["content"].strip()
+                self.cache.put(key, model or self.model, annotation)
+                rows.append((image_path, annotation))
+                if len(rows) >= chunk_size:
+                    self.db.insert_or_update_annotations(rows)
+                    imported += len(rows)
+                    rows = []
+        if rows:
+            self.db.insert_or_update_annotations(rows)
+            imported += len(rows)
+        return imported, failed
+
+    def poll(self) -> list:
+        """Check every open batch once and import those that have finished.
+
+        Returns a list of ``(batch_id, status, imported, failed)``; the last
+        two are None for batches still running.
+        """
+        report = []
+        for batch_id, _, model in self.db.get_open_batches():
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status not in TERMINAL_STATUSES:
+                self.db.update_batch(batch_id, batch.status)
+                report.append((batch_id, batch.status, None, None))
+                continue
+            imported = failed = 0
+            # Expired and cancelled batches still return what was finished
+            if batch.output_file_id:
+                imported, failed = self.import_results(batch_id, batch.output_file_id, model)
+            counts = getattr(batch, "request_counts", None)
+            if counts is not None:
+                failed = max(failed, counts.total - imported)
+            self.db.update_batch(batch_id, batch.status, batch.output_file_id, batch.error_file_id,
+                                 imported=True)
+            logging.info(f"Batch {batch_id} {batch.status}: {imported} imported, {failed} failed")
+            report.append((batch_id, batch.status, imported, failed))
+        return report
+
+    def wait(self, interval=60.0, on_poll=None, should_stop=None):
+        """Poll every ``interval`` seconds until no batch is left open.
+
+        ``on_poll(report)`` receives each :meth:`poll` report. Returns the
+        reports of all finished batches.
+        """
+        finished = []
+        while True:
+            report = self.poll()
+            finished += [entry for entry in report if entry[2] is not None]
+            if on_poll:
+                on_poll(report)
+            if not self.db.get_open_batches() or (should_stop and should_stop()):
+                return finished
+            time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Annotate images with the OpenAI Batch API")
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="build and submit batches")
+    source = submit.add_mutually_exclusive_group(required=True)
+    source.add_argument("--folder", help="annotate the images in this folder")
+    source.add_argument("--unannotated", action="store_true", help="annotate database rows without text")
+    submit.add_argument("--model", default="gpt-4-turbo")
+    submit.add_argument("--prompt-file", help="read the prompt from this file")
+    submit.add_argument("--force", action="store_true", help="also re-annotate images that have text")
+    poll = commands.add_parser("poll", help="import finished batches")
+    poll.add_argument("--wait", action="store_true", help="keep polling until every batch is done")
+    poll.add_argument("--interval", type=float, default=60.0)
+    commands.add_parser("status", help="list batches not imported yet")
+    parser.add_argument("--db", default="annotations.db")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    db = DatabaseManager(args.db)
+    # The command line is the one place where asking for a missing key is fine
+    client = get_client() if args.command != "status" else None
+
+    if args.command == "submit":
+        prompt = DEFAULT_PROMPT
+        if args.prompt_file:
+            with open(args.prompt_file, encoding="utf-8") as f:
+                prompt = f.read().strip()
+        paths = folder_images(args.folder) if args.folder else list(db.iter_unannotated_paths())
+        summary = BatchAnnotator(db, prompt, args.model, client=client).submit(paths, force=args.force)
+        print(f"Submitted {summary['requests']} requests in {len(summary['batches'])} batches, "
+              f"{summary['cached']} answered from cache, {summary['skipped']} already queued, "
+              f"{summary['annotated']} already annotated, {len(summary['errors'])} unreadable")
+    elif args.command == "poll":
+        # Prompt and model are only needed to submit; results map back by custom_id
+        annotator = BatchAnnotator(db, client=client)
+        if args.wait:
+            annotator.wait(args.interval, on_poll=lambda report: [print(*entry) for entry in report])
+        else:
+            for entry in annotator.poll():
+                print(*entry)
+    else:
+        for batch_id, status, model in db.get_open_batches():
+            print(batch_id, status, model)
+    db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""A local stand-in for the OpenAI files and batches endpoints.
+
+It implements just enough of the API for ``batch_annotate.py`` to run end
+to end without an account or network access::
+
+    python batch_stub_server.py 8765
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python batch_annotate.py submit --folder images/
+
+Uploaded request files are answered immediately: every request gets the
+annotation ``"Stub annotation for <custom_id>"``. A batch reports
+``in_progress`` on its first retrieval and ``completed`` from then on, so
+one poll sees it running and the next one imports it. Requests whose
+``custom_id`` is listed in ``failing`` come back with status 500.
+"""
+import re
+import sys
+import json
+import time
+import uuid
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class BatchStubServer(ThreadingHTTPServer):
+    """HTTP server holding the uploaded files and submitted batches."""
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), failing=()):
+        super().__init__(address, BatchStubHandler)
+        self.files = {}
+        self.batches = {}
+        self.failing = set(failing)
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def answer(self, request):
+        """Return the output line of one batch request."""
+        custom_id = request["custom_id"]
+        if custom_id in self.failing:
+            response = {"status_code": 500, "request_id": uuid.uuid4().hex,
+                        "body": {"error": {"message": "Stub failure", "type": "server_error"}}}
+        else:
+            response = {"status_code": 200, "request_id": uuid.uuid4().hex,
+                        "body": {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "object": "chat.completion",
+                                 "model": request["body"]["model"],
+                                 "choices": [{"index": 0, "finish_reason": "stop",
+                                              "message": {"role": "assistant",
+                                                          "content": f"Stub annotation for {custom_id}"}}]}}
+        return {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": custom_id,
+                "response": response, "error": None}
+
+    def start(self):
+        """Serve from a daemon thread and return the server."""
+        threading.Thread(target=self.serve_forever, name="batch-stub", daemon=True).start()
+        return self
+
+
+class BatchStubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status=200, payload=None, raw=None):
+        body = raw if raw is not None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json" if raw is None else "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self):
+        self._send(404, {"error": {"message": f"No route for {self.command} {self.path}", "type": "invalid_request_error"}})
+
+    def _upload(self, body):
+        """Return the content of the ``file`` part of a multipart body."""
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers["Content-Type"]).group(1).encode()
+        for part in body.split(b"--" + boundary):
+            headers, _, content = part.partition(b"\r\n\r\n")
+            if b'name="file"' in headers:
+                return content[:-2] if content.endswith(b"\r\n") else content
+        return None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        path = self.path.split("?")[0]
+        if path.endswith("/files"):
+            content = self._upload(body)
+            if content is None:
+                return self._send(400, {"error": {"message": "Missing file", "type": "invalid_request_error"}})
+            file_id = f"file-{uuid.uuid4().hex[:12]}"
+            with server.lock:
+                server.files[file_id] = content
+            return self._send(payload={"id": file_id, "object": "file", "bytes": len(content),
+                                       "created_at": int(time.time()), "filename": "requests.jsonl",
+                                       "purpose": "batch", "status": "processed"})
+        if path.endswith("/batches"):
+            request = json.loads(body)
+            with server.lock:
+                content = server.files.get(request["input_file_id"])
+                if content is None:
+                    return self._send(404, {"error": {"message": "No such file", "type": "invalid_request_error"}})
+                requests = [json.loads(line) for line in content.decode("utf-8").splitlines() if line.strip()]
+                answers = [server.answer(line) for line in requests]
+                output_id = f"file-{uuid.uuid4().hex[:12]}"
+                server.files[output_id] = "".join(json.dumps(answer) + "\n" for answer in answers).encode("utf-8")
+                failed = sum(answer["response"]["status_code"] != 200 for answer in answers)
+                batch = {"id": f"batch_{uuid.uuid4().hex[:12]}", "object": "batch",
+                         "endpoint": request["endpoint"], "input_file_id": request["input_file_id"],
+                         "completion_window": request["completion_window"], "status": "validating",
+                         "created_at": int(time.time()), "output_file_id": None, "error_file_id": None,
+                         "metadata": request.get("metadata"),
+                         "request_counts": {"total": len(answers), "completed": len(answers) - failed,
+                                            "failed": failed}}
+                server.batches[batch["id"]] = {"batch": batch, "output": output_id, "polls": 0}
+            return self._send(payload=batch)
+        self._not_found()
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        match = re.search(r"/batches/([^/]+)$", path)
+        if match:
+            with server.lock:
+                entry = server.batches.get(match.group(1))
+                if entry is None:
+                    return self._not_found()
+                entry["polls"] += 1
+                batch = entry["batch"]
+                if entry["polls"] == 1:
+                    batch["status"] = "in_progress"
+                else:
+                    batch.update(status="completed", output_file_id=entry["output"])
+            return self._send(payload=batch)
+        match = re.search(r"/files/([^/]+)/content$", path)
+        if match:
+            with server.lock:
+                content = server.files.get(match.group(1))
+            if content is None:
+                return self._not_found()
+            return self._send(raw=content)
+        self._not_found()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    port = int(argv[0]) if argv else 8765
+    server = BatchStubServer(("127.0.0.1", port))
+    print(f"Batch stub listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""Compare pooled and connect-per-query modes of ``DatabaseManager``.
+
+Usage::
+
+    python bench_database.py [rows]
+
+A temporary database is created for each mode, ``rows`` annotations are
+inserted one by one, then every row is looked up and approved - the same
+pattern the UIs produce while reviewing a dataset.
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+from database import DatabaseManager
+
+
+def _run(pooled: bool, rows: int) -> dict:
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, "bench.db"), pooled=pooled)
+        paths = [f"/data/img_{i:06d}.png" for i in range(rows)]
+
+        start = time.perf_counter()
+        for path in paths:
+            db.insert_or_update_annotation(path, "benchmark annotation " * 20)
+        timings["insert"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for path in paths:
+            db.get_annotation(path)
+        timings["select"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for path in paths:
+            db.update_annotation_status(path, True)
+        timings["approve"] = time.perf_counter() - start
+
+        # Concurrent readers while the main thread writes
+        def reader():
+            for path in paths:
+                db.get_annotation(path)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=reader) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for path in paths:
+            db.update_annotation(path, "edited")
+        for t in threads:
+            t.join()
+        timings["mixed"] = time.perf_counter() - start
+
+        db.close()
+    return timings
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    results = {
+        "connect-per-query": _run(False, rows),
+        "pooled": _run(True, rows),
+    }
+    print(f"{rows} rows")
+    print(f"{'mode':<20}" + "".join(f"{k:>10}" for k in results["pooled"]))
+    for mode, timings in results.items():
+        print(f"{mode:<20}" + "".join(f"{v:>9.3f}s" for v in timings.values()))
+    base, pooled = results["connect-per-query"], results["pooled"]
+    for key in pooled:
+        print(f"{key}: {base[key] / pooled[key]:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Measure how long importing the app entry points takes.
+
+Usage::
+
+    python bench_startup.py [--runs N] [--budget SECONDS] [modules...]
+
+Each module (``gradio_app`` and ``main`` by default) is imported in a fresh
+interpreter with ``-X importtime``; the best wall time of ``--runs`` runs is
+reported along with the slowest imports. Stdin is closed, so an import that
+prompts for input fails instead of hanging. With ``--budget`` the exit code
+is 1 when any module takes longer, which keeps startup cost in check.
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+DEFAULT_MODULES = ("gradio_app", "main")
+
+
+def _slowest_imports(stderr, count):
+    """Parse ``-X importtime`` output into the ``count`` largest self times."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(self_us), int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def measure(module, runs=3):
+    """Return ``(best_seconds, stderr_of_best_run)`` for importing ``module``."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=here, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+        elapsed = time.perf_counter() - started
+        if result.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{result.stderr.splitlines()[-1]}")
+        if best is None or elapsed < best[0]:
+            best = (elapsed, result.stderr)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--budget", type=float, help="fail when an import takes longer (seconds)")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to list")
+    args = parser.parse_args()
+
+    over_budget = False
+    for module in args.modules:
+        try:
+            elapsed, stderr = measure(module, args.runs)
+        except RuntimeError as e:
+            print(e)
+            over_budget = True
+            continue
+        print(f"import {module}: {elapsed:.2f}s")
+        for self_us, cumulative_us, name in _slowest_imports(stderr, args.top):
+            print(f"  {self_us / 1000:8.1f} ms self {cumulative_us / 1000:8.1f} ms total  {name}")
+        if args.budget is not None and elapsed > args.budget:
+            print(f"  over budget of {args.budget:.2f}s")
+            over_budget = True
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import os
+import time
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+def caption_path(image_path: str) -> str:
+    """Return the ``.txt`` sidecar path for ``image_path``."""
+    return os.path.splitext(image_path)[0] + ".txt"
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def write_atomic(path: str, text: str):
+    """Write ``text`` to ``path`` through a temporary file and a rename.
+
+    Readers never see a half-written caption, even if the process dies
+    mid-write.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix=".caption-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def sync_caption_files(db, delete_orphans=False, max_workers=8, verify=False, progress=None) -> dict:
+    """Bring the ``.txt`` sidecars of approved annotations up to date.
+
+    A content hash is stored for every sidecar written, so only captions
+    that are new, edited or moved are written again. Writes run on a pool
+    of ``max_workers`` threads, which hides the latency of network storage.
+
+    Parameters
+    ----------
+    db : DatabaseManager
+        Database holding the annotations.
+    delete_orphans : bool
+        Remove sidecars written earlier for annotations that are no longer
+        approved or were deleted.
+    max_workers : int
+        Number of concurrent file writers.
+    verify : bool
+        Also rewrite unchanged captions whose file has gone missing. This
+        costs one ``stat`` per caption.
+    progress : callable, optional
+        Called as ``progress(done, total)`` while files are written.
+
+    Returns
+    -------
+    dict
+        Counts (``written``, ``unchanged``, ``deleted``, ``failed``), the
+        first few ``errors`` and timings in seconds (``scan``, ``write``,
+        ``total``).
+    """
+    started = time.perf_counter()
+    revision = db.current_revision()
+
+    pending = []
+    unchanged = 0
+    for image_path, annotation, old_txt_path, old_hash in db.iter_caption_candidates():
+        txt_path = caption_path(image_path)
+        digest = content_hash(annotation or "")
+        if (digest == old_hash and txt_path == old_txt_path
+                and not (verify and not os.path.exists(txt_path))):
+            unchanged += 1
+            continue
+        pending.append((image_path, txt_path, annotation or "", digest))
+    orphans = db.get_orphan_caption_files() if delete_orphans else []
+    scanned = time.perf_counter()
+
+    written, deleted, errors = [], [], []
+    total = len(pending) + len(orphans)
+
+    def write(job):
+        image_path, txt_path, text, digest = job
+        write_atomic(txt_path, text)
+        return image_path, txt_path, digest, revision, time.time()
+
+    def remove(orphan):
+        image_path, txt_path = orphan
+        try:
+            os.remove(txt_path)
+        except FileNotFoundError:
+            pass
+        return image_path
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [(job[0], pool.submit(write, job)) for job in pending]
+        futures += [(orphan[0], pool.submit(remove, orphan)) for orphan in orphans]
+        for done, (image_path, future) in enumerate(futures, start=1):
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Error syncing caption for {image_path}: {e}")
+                errors.append(f"{image_path}: {e}")
+            else:
+                (written if isinstance(result, tuple) else deleted).append(result)
+            if progress:
+                progress(done, total)
+
+    if written:
+        db.record_caption_files(written)
+    if deleted:
+        db.forget_caption_files(deleted)
+    finished = time.perf_counter()
+
+    return {
+        "written": len(written),
+        "unchanged": unchanged,
+        "deleted": len(deleted),
+        "failed": len(errors),
+        "errors": errors[:10],
+        "scan": scanned - started,
+        "write": finished - scanned,
+        "total": finished - started,
+    }
+
+
+def summary_text(summary: dict) -> str:
+    """One-line description of a :func:`sync_caption_files` result."""
+    text = (f"Wrote {summary['written']} text files, {summary['unchanged']} unchanged, "
+            f"{summary['deleted']} removed, {summary['failed']} failed "
+            f"in {summary['total']:.2f}s (scan {summary['scan']:.2f}s, write {summary['write']:.2f}s)")
+    if summary["errors"]:
+        text += "\n" + "\n".join(summary["errors"])
+    return text
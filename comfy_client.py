@@ -1,98 +1,513 @@
 import os
 import uuid
 import json
-import urllib.parse
-import urllib.request
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import requests
 import websocket
+from requests.adapters import HTTPAdapter
+from config import COMFY_CONNECTION, COMFY_BATCH, COMFY_TIMEOUTS
+from workflow_template import load_template
+
+OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "generated")
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# How often a waiting batch checks timeouts and its stop flag, in seconds
+POLL_INTERVAL = 0.5
+
+# Progress of a queued prompt: "started", "executing" a node, or a sampler
+# "progress" step out of ``maximum``
+ProgressEvent = namedtuple("ProgressEvent", "key prompt_id kind node value maximum", defaults=(None, 0, 0))
+
+# One downloaded output file; ``seconds`` is the time its download took
+OutputFile = namedtuple("OutputFile", "node_id path size seconds")
+
+
+class GenerationResult(namedtuple("GenerationResult", "key prompt_id outputs error queue_seconds run_seconds "
+                                                      "download_seconds", defaults=((), None, 0.0, 0.0, 0.0))):
+    """Outcome of one queued prompt.
+
+    ``outputs`` holds an :class:`OutputFile` for every file saved, in the
+    order of the workflow's outputs, and ``error`` is set when the prompt
+    or any download failed. The timings are the seconds spent waiting in
+    the server's queue, executing and downloading the outputs.
+    """
+    __slots__ = ()
+
+    @property
+    def path(self):
+        """Path of the first output file, or None."""
+        return self.outputs[0].path if self.outputs else None
+
 
 class ComfyUIClient:
-    def __init__(self, server: str):
+    """Client for a ComfyUI server.
+
+    A client is a long-lived session: one ``requests`` session whose
+    keep-alive connections are shared by every HTTP call, and one WebSocket
+    opened under a fixed ``client_id`` on first use and reopened whenever it
+    drops. A reader thread owns the WebSocket and hands each message to the
+    caller waiting for its ``prompt_id``, so any number of threads and
+    batches can share one client.
+    """
+
+    def __init__(self, server: str, pool_size=COMFY_CONNECTION["pool_size"],
+                 http_timeout=COMFY_CONNECTION["http_timeout"],
+                 reconnect_attempts=COMFY_CONNECTION["reconnect_attempts"],
+                 reconnect_delay=COMFY_CONNECTION["reconnect_delay"],
+                 max_queued=COMFY_BATCH["max_queued"], download_workers=COMFY_BATCH["download_workers"]):
         self.server = server.rstrip('/')
+        self.client_id = uuid.uuid4().hex
+        self.http_timeout = http_timeout
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.max_queued = max_queued
+        self.download_workers = download_workers
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._ws = None
+        self._ws_lock = threading.Lock()
+        # prompt_id -> queue of the caller waiting for it; also held while
+        # queueing a prompt so its first messages cannot arrive unclaimed
+        self._listeners = {}
+        self._listen_lock = threading.Lock()
+        self._reader = None
+        self._closing = False
 
     def set_server(self, server: str):
-        self.server = server.rstrip('/')
+        server = server.rstrip('/')
+        if server != self.server:
+            self.server = server
+            self._disconnect()
 
-    def _queue_prompt(self, prompt: dict, client_id: str) -> str:
-        data = json.dumps({"prompt": prompt, "client_id": client_id}).encode("utf-8")
-        req = urllib.request.Request(
-            f"{self.server}/prompt",
-            data=data,
-            headers={"Content-Type": "application/json"},
-        )
-        resp = urllib.request.urlopen(req).read()
-        return json.loads(resp)["prompt_id"]
-
-    def _get_image(self, filename: str, subfolder: str, folder_type: str) -> bytes:
-        params = urllib.parse.urlencode(
-            {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        )
-        url = f"{self.server}/view?{params}"
-        with urllib.request.urlopen(url) as resp:
-            return resp.read()
+    def close(self):
+        """Close the WebSocket and every pooled HTTP connection."""
+        self._closing = True
+        self._disconnect()
+        self._session.close()
 
-    def generate_image(
-        self,
-        prompt: str,
-        model: str,
-        width: int,
-        height: int,
-        steps: int,
-        workflow: str,
-    ) -> str:
-        """Generate an image using a ComfyUI server.
+    def __enter__(self):
+        return self
 
-        The provided ``workflow`` JSON is sent directly to ComfyUI.
-        ``prompt`` and other parameters should already be baked into the
-        workflow by the user.
-        """
+    def __exit__(self, *exc):
+        self.close()
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        resp = self._session.request(method, f"{self.server}{path}", timeout=self.http_timeout, **kwargs)
+        if not resp.ok:
+            raise RuntimeError(f"ComfyUI {method} {path} failed with {resp.status_code}: {resp.text[:500]}")
+        return resp
 
-        prompt_data = json.loads(workflow) if workflow else {}
+    def _connect(self) -> websocket.WebSocket:
+        """Return the open WebSocket, (re)connecting with backoff if needed."""
+        with self._ws_lock:
+            if self._ws is not None and self._ws.connected:
+                return self._ws
+            ws_url = (
+                self.server.replace("http://", "ws://")
+                .replace("https://", "wss://")
+                + f"/ws?clientId={self.client_id}"
+            )
+            delay = self.reconnect_delay
+            for attempt in range(self.reconnect_attempts + 1):
+                try:
+                    ws = websocket.WebSocket()
+                    ws.connect(ws_url, timeout=self.http_timeout)
+                    # Waiting for a long generation must not time out the socket
+                    ws.settimeout(None)
+                    self._ws = ws
+                    return ws
+                except (websocket.WebSocketException, OSError) as e:
+                    if attempt == self.reconnect_attempts:
+                        raise ConnectionError(f"Could not connect to ComfyUI at {ws_url}: {e}") from e
+                    logging.warning(f"ComfyUI WebSocket connect failed ({e}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    delay *= 2
 
-        client_id = uuid.uuid4().hex
+    def _disconnect(self):
+        with self._ws_lock:
+            if self._ws is not None:
+                try:
+                    self._ws.close()
+                except (websocket.WebSocketException, OSError):
+                    pass
+                self._ws = None
 
-        ws_url = (
-            self.server.replace("http://", "ws://")
-            .replace("https://", "wss://")
-            + f"/ws?clientId={client_id}"
-        )
+    def _start_reader(self):
+        """Connect and make sure the reader thread is running."""
+        self._closing = False
+        self._connect()
+        with self._listen_lock:
+            if self._reader is None or not self._reader.is_alive():
+                self._reader = threading.Thread(target=self._read_loop, name="comfy-ws", daemon=True)
+                self._reader.start()
 
-        ws = websocket.WebSocket()
-        ws.connect(ws_url)
+    def _dispatch(self, prompt_id, msg):
+        with self._listen_lock:
+            if prompt_id is None:
+                targets = list(self._listeners.items())
+            else:
+                targets = [(prompt_id, self._listeners[prompt_id])] if prompt_id in self._listeners else []
+        for target_id, inbox in targets:
+            inbox.put((target_id, msg))
 
-        prompt_id = self._queue_prompt(prompt_data, client_id)
+    def _read_loop(self):
+        """Route WebSocket messages to the listeners of their ``prompt_id``.
 
-        # wait for execution to finish
+        Messages without a prompt id (queue status, previews) are dropped.
+        After a reconnect every listener gets a ``reconnected`` message:
+        messages sent while disconnected are lost, so they must check the
+        history of their prompts.
+        """
         while True:
-            out = ws.recv()
+            try:
+                ws = self._connect()
+                out = ws.recv()
+                if not ws.connected:
+                    # A close frame from the server comes back as empty data
+                    raise websocket.WebSocketConnectionClosedException("closed by the server")
+            except (websocket.WebSocketException, OSError) as e:
+                if self._closing:
+                    return
+                logging.warning(f"ComfyUI WebSocket dropped ({e}), reconnecting")
+                self._disconnect()
+                try:
+                    self._connect()
+                except ConnectionError as e:
+                    self._dispatch(None, {"type": "connection_lost", "data": {"error": str(e)}})
+                    return
+                self._dispatch(None, {"type": "reconnected", "data": {}})
+                continue
             if isinstance(out, str):
                 msg = json.loads(out)
-                if msg.get("type") == "executing":
-                    data = msg.get("data", {})
-                    if data.get("node") is None and data.get("prompt_id") == prompt_id:
+                prompt_id = (msg.get("data") or {}).get("prompt_id")
+                if prompt_id is not None:
+                    self._dispatch(prompt_id, msg)
+
+    def _queue_prompt(self, prompt: dict, inbox: queue.Queue) -> str:
+        with self._listen_lock:
+            resp = self._request("POST", "/prompt", json={"prompt": prompt, "client_id": self.client_id})
+            prompt_id = resp.json()["prompt_id"]
+            self._listeners[prompt_id] = inbox
+        return prompt_id
+
+    def _unlisten(self, prompt_ids):
+        with self._listen_lock:
+            for prompt_id in prompt_ids:
+                self._listeners.pop(prompt_id, None)
+
+    def _history(self, prompt_id: str) -> dict:
+        """History entry of ``prompt_id``, empty while it has not finished."""
+        return self._request("GET", f"/history/{prompt_id}").json().get(prompt_id, {})
+
+    def _prompt_state(self, prompt_id, msg):
+        """Interpret ``msg`` for ``prompt_id``: ``"done"``, an error string or None."""
+        kind, data = msg.get("type"), msg.get("data") or {}
+        if kind == "executing" and data.get("node") is None:
+            return "done"
+        if kind == "execution_success":
+            return "done"
+        if kind == "execution_error":
+            return f"{data.get('node_type', 'node')} failed: {data.get('exception_message', 'unknown error')}"
+        if kind == "execution_interrupted":
+            return "Interrupted"
+        if kind == "connection_lost":
+            return data.get("error", "Connection lost")
+        if kind == "reconnected":
+            try:
+                finished = self._history(prompt_id)
+            except (RuntimeError, ValueError, requests.RequestException) as e:
+                # The server may still be unreachable right after the socket
+                # comes back; keep waiting and let the timeouts decide
+                logging.warning(f"Could not check ComfyUI prompt {prompt_id} after reconnecting: {e}")
+                return None
+            if finished:
+                return "done"
+        return None
+
+    def _output_files(self, history: dict) -> list:
+        """``(node_id, file_ref)`` for every file in the outputs of ``history``."""
+        files = []
+        for node_id, node_output in history.get("outputs", {}).items():
+            # "images", and "gifs" or "audio" of video/audio nodes
+            for items in node_output.values():
+                if isinstance(items, list):
+                    files += [(node_id, item) for item in items if isinstance(item, dict) and "filename" in item]
+        return files
+
+    def _output_path(self, key, prompt_id, node_id, index, filename) -> str:
+        prefix = prompt_id if key is None else f"{os.path.splitext(os.path.basename(str(key)))[0]}_{prompt_id[:8]}"
+        return os.path.join(OUTPUT_DIR, f"{prefix}_{node_id}_{index}{os.path.splitext(filename)[1] or '.png'}")
+
+    def _download_file(self, node_id, file_ref, path) -> OutputFile:
+        """Stream one output file to ``path`` in chunks, never holding it in memory."""
+        started = time.perf_counter()
+        params = {"filename": file_ref["filename"], "subfolder": file_ref.get("subfolder", ""),
+                  "type": file_ref.get("type", "output")}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = path + ".part"
+        size = 0
+        try:
+            with self._request("GET", "/view", params=params, stream=True) as resp, open(part_path, "wb") as f:
+                for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(part_path, path)
+        except BaseException:
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+            raise
+        return OutputFile(node_id, path, size, time.perf_counter() - started)
+
+    def _queue_status(self) -> tuple:
+        """Return the ids of the ``(running, pending)`` prompts on the server."""
+        status = self._request("GET", "/queue").json()
+        # Queue entries are [number, prompt_id, prompt, extra_data, outputs]
+        return ({entry[1] for entry in status.get("queue_running", [])},
+                {entry[1] for entry in status.get("queue_pending", [])})
+
+    def cancel(self, prompt_ids):
+        """Cancel ``prompt_ids``: delete them from the server's queue and
+        interrupt the one executing, if any.
+
+        Prompts of other clients are never interrupted.
+        """
+        prompt_ids = set(prompt_ids)
+        if not prompt_ids:
+            return
+        self._request("POST", "/queue", json={"delete": sorted(prompt_ids)})
+        running, _ = self._queue_status()
+        for prompt_id in running & prompt_ids:
+            self._request("POST", "/interrupt", json={"prompt_id": prompt_id})
+
+    def _lost_prompts(self, prompt_ids) -> dict:
+        """Check ``prompt_ids`` after a silence: ``{prompt_id: "done" or error}``
+        for those that are neither queued nor running any more."""
+        try:
+            running, pending = self._queue_status()
+        except (RuntimeError, requests.RequestException) as e:
+            return {prompt_id: f"ComfyUI is not responding: {e}" for prompt_id in prompt_ids}
+        lost = {}
+        for prompt_id in prompt_ids:
+            if prompt_id not in running and prompt_id not in pending:
+                # Finished while its messages were lost, or dropped by a restart
+                lost[prompt_id] = "done" if self._history(prompt_id) else "Prompt is no longer queued on the server"
+        return lost
+
+    def generate_many(self, jobs, max_queued=None, on_event=None, should_stop=None,
+                      job_timeout=COMFY_TIMEOUTS["job"], idle_timeout=COMFY_TIMEOUTS["idle"]):
+        """Generate a prompt graph for every ``(key, prompt)`` in ``jobs``.
+
+        Up to ``max_queued`` prompts are kept queued on the server, so it
+        moves straight on to the next one while finished outputs are
+        downloaded by a small thread pool: every file of every output node,
+        streamed to :data:`OUTPUT_DIR`. ``jobs`` may be a generator and is
+        consumed lazily.
+
+        ``on_event`` receives a :class:`ProgressEvent` when a prompt starts,
+        enters a node and at every sampler step. A prompt executing for
+        longer than ``job_timeout`` seconds, or sending nothing for
+        ``idle_timeout`` seconds, is cancelled and fails; when no prompt is
+        executing, a silence that long makes the server's queue be checked
+        instead, failing the batch if the server does not answer. Once
+        ``should_stop()`` returns True, or the generator is closed, the
+        prompts still queued or executing are cancelled on the server.
+
+        Yields
+        ------
+        GenerationResult
+            One per job, in the order they finish. Failed jobs carry the
+            error; they do not stop the batch.
+        """
+        jobs = iter(jobs)
+        max_queued = max_queued or self.max_queued
+        inbox = queue.Queue()
+        waiting = {}   # prompt_id -> {"key", "submitted", "started", "last"}
+        fetching = {}  # prompt_id -> download state of a finished prompt
+        exhausted = False
+        last_message = time.monotonic()
+        self._start_reader()
+        pool = ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="comfy-download")
+
+        def run(kind, prompt_id, fn, *args):
+            # Results come back through the inbox, keeping all state in this generator
+            try:
+                data, error = fn(*args), None
+            except Exception as e:
+                data, error = None, str(e)
+            inbox.put((prompt_id, {"type": kind, "data": {"result": data, "error": error}}))
+
+        def settle(prompt_id, status):
+            """Stop waiting for ``prompt_id``; fetch its outputs or return its failure."""
+            entry = waiting.pop(prompt_id)
+            self._unlisten([prompt_id])
+            now = time.monotonic()
+            started = entry["started"] or now
+            fetching[prompt_id] = {"key": entry["key"], "queue_seconds": started - entry["submitted"],
+                                   "run_seconds": now - started, "finished": now,
+                                   "files": [], "errors": [], "order": {}, "total": 0, "left": 0}
+            if status == "done":
+                pool.submit(run, "outputs", prompt_id, self._history, prompt_id)
+                return None
+            return finish(prompt_id, status)
+
+        def finish(prompt_id, error=None):
+            state = fetching.pop(prompt_id)
+            outputs = tuple(sorted(state["files"], key=lambda output: state["order"][output.path]))
+            if error is None and state["errors"]:
+                error = (f"{len(state['errors'])} of {state['total']} downloads failed: "
+                         f"{state['errors'][0]}")
+            return GenerationResult(state["key"], prompt_id, outputs, error, state["queue_seconds"],
+                                    state["run_seconds"], time.monotonic() - state["finished"])
+
+        def expired(now):
+            """Prompts to give up on, as ``{prompt_id: "done" or error}``."""
+            failed = {}
+            for prompt_id, entry in waiting.items():
+                if entry["started"] is None:
+                    continue
+                if job_timeout and now - entry["started"] > job_timeout:
+                    failed[prompt_id] = f"Timed out after {job_timeout:.0f}s"
+                elif idle_timeout and now - entry["last"] > idle_timeout:
+                    failed[prompt_id] = f"No progress for {idle_timeout:.0f}s"
+            if failed:
+                try:
+                    self.cancel(failed)
+                except (RuntimeError, requests.RequestException) as e:
+                    logging.warning(f"Could not cancel timed out ComfyUI prompts: {e}")
+            elif waiting and idle_timeout and now - last_message > idle_timeout:
+                failed = self._lost_prompts(list(waiting))
+            return failed
+
+        try:
+            while True:
+                while not exhausted and len(waiting) < max_queued:
+                    try:
+                        key, prompt = next(jobs)
+                    except StopIteration:
+                        exhausted = True
                         break
-            else:
-                continue
+                    try:
+                        prompt_id = self._queue_prompt(prompt, inbox)
+                    except (RuntimeError, requests.RequestException) as e:
+                        yield GenerationResult(key, None, error=str(e))
+                        continue
+                    now = time.monotonic()
+                    waiting[prompt_id] = {"key": key, "submitted": now, "started": None, "last": now}
+                if not waiting and not fetching:
+                    return
+                if should_stop and should_stop():
+                    return
+
+                try:
+                    prompt_id, msg = inbox.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    now = time.monotonic()
+                    for prompt_id, status in expired(now).items():
+                        result = settle(prompt_id, status)
+                        if result is not None:
+                            yield result
+                    if idle_timeout and now - last_message > idle_timeout:
+                        last_message = now
+                    continue
+
+                kind, data = msg.get("type"), msg.get("data") or {}
+                if kind == "outputs":
+                    history = data["result"] or {}
+                    if data["error"] is not None:
+                        yield finish(prompt_id, data["error"])
+                    elif (history.get("status") or {}).get("status_str") == "error":
+                        yield finish(prompt_id, "ComfyUI reported an error")
+                    elif not (files := self._output_files(history)):
+                        yield finish(prompt_id, "No image data returned from ComfyUI")
+                    else:
+                        state = fetching[prompt_id]
+                        state["total"] = state["left"] = len(files)
+                        for index, (node_id, file_ref) in enumerate(files):
+                            path = self._output_path(state["key"], prompt_id, node_id, index, file_ref["filename"])
+                            state["order"][path] = index
+                            pool.submit(run, "file", prompt_id, self._download_file, node_id, file_ref, path)
+                    continue
+                if kind == "file":
+                    state = fetching[prompt_id]
+                    state["left"] -= 1
+                    if data["error"] is None:
+                        state["files"].append(data["result"])
+                    else:
+                        state["errors"].append(data["error"])
+                    if not state["left"]:
+                        yield finish(prompt_id)
+                    continue
+                if prompt_id not in waiting:
+                    continue
+
+                entry = waiting[prompt_id]
+                entry["last"] = last_message = time.monotonic()
+                if entry["started"] is None and kind in ("execution_start", "execution_cached",
+                                                         "executing", "progress"):
+                    # execution_start can be missed, e.g. across a reconnect;
+                    # any sign of execution starts the job timeout
+                    entry["started"] = entry["last"]
+                if on_event and kind in ("execution_start", "executing", "progress"):
+                    if kind == "execution_start":
+                        event = ProgressEvent(entry["key"], prompt_id, "started")
+                    elif kind == "executing" and data.get("node") is not None:
+                        event = ProgressEvent(entry["key"], prompt_id, "executing", data["node"])
+                    elif kind == "progress":
+                        event = ProgressEvent(entry["key"], prompt_id, "progress", data.get("node"),
+                                              data.get("value", 0), data.get("max", 0))
+                    else:
+                        event = None
+                    if event is not None:
+                        on_event(event)
+                status = self._prompt_state(prompt_id, msg)
+                if status is not None:
+                    result = settle(prompt_id, status)
+                    if result is not None:
+                        yield result
+        finally:
+            self._unlisten(list(waiting))
+            if waiting:
+                try:
+                    self.cancel(waiting)
+                except (RuntimeError, requests.RequestException) as e:
+                    logging.warning(f"Could not cancel ComfyUI prompts: {e}")
+            pool.shutdown(wait=False)
+
+    def generate_image(
+        self,
+        prompt: str,
+        model: str,
+        width: int,
+        height: int,
+        steps: int,
+        workflow: str,
+        seed: int = None,
+        on_event=None,
+        should_stop=None,
+    ) -> GenerationResult:
+        """Generate images using a ComfyUI server.
+
+        ``prompt``, ``model``, the size, ``steps`` and ``seed`` are filled
+        into the API-format ``workflow`` JSON (see :class:`WorkflowTemplate`);
+        empty values keep the workflow's own. ``on_event`` and
+        ``should_stop`` are passed to :meth:`generate_many`. Returns the
+        :class:`GenerationResult` with every output file.
+        """
 
-        history_req = urllib.request.urlopen(f"{self.server}/history/{prompt_id}")
-        history = json.loads(history_req.read())[prompt_id]
-
-        image_data = None
-        for _node_id, node_output in history.get("outputs", {}).items():
-            if "images" in node_output and node_output["images"]:
-                img = node_output["images"][0]
-                image_data = self._get_image(
-                    img["filename"], img["subfolder"], img["type"]
-                )
-                break
-
-        ws.close()
-
-        if image_data is None:
-            raise RuntimeError("No image data returned from ComfyUI")
-
-        out_dir = os.path.join(os.path.dirname(__file__), "generated")
-        os.makedirs(out_dir, exist_ok=True)
-        file_path = os.path.join(out_dir, f"{uuid.uuid4().hex}.png")
-        with open(file_path, "wb") as f:
-            f.write(image_data)
-        return file_path
+        prompt_data = load_template(workflow).render(prompt, model, width, height, steps, seed)
+        results = list(self.generate_many([(None, prompt_data)], on_event=on_event, should_stop=should_stop))
+        if not results:
+            raise RuntimeError("Generation cancelled")
+        result = results[0]
+        if result.error is not None and not result.outputs:
+            raise RuntimeError(result.error)
+        return result
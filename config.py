@@ -1,4 +1,7 @@
 OPENAI_API_KEY = ""
+# API endpoint; None uses OpenAI (or the OPENAI_BASE_URL environment variable).
+# Point it at a compatible local server to test without spending credits.
+OPENAI_BASE_URL = None
 DEFAULT_PROMPT = "1. Begin with the special word: gsai, illustration. 2. The description should be short and concise but contain all key requirements. 3. Requirements: Highlight and describe the main objects in the image that are in the foreground. Then, describe the secondary objects, if any. Describe the background. Describe the atmsphere or mood of the image. Pay special attention to the light and shadows, and the nature of the lighting. Describe the lighting in detail. Describe the composition and the dynamic arrangement of the objects in the image. Describe the interactions between the objects in the image. Pay attention to the time of day, season, natural environment, weather, etc. If there is a character in the image, describe them in detail (appearance, physique, emotions, clothing details). Briefly describe the narrative of the image, if there is a story being told. 4. Write the whole thing in one paragraph"
 
 # Default settings used for image generation via ComfyUI
@@ -8,5 +11,81 @@ COMFY_DEFAULTS = {
     "width": 512,
     "height": 512,
     "steps": 20,
+    "seed": -1,          # -1 picks a random seed for every image
     "workflow": ""
 }
+
+# Nodes of the workflow that receive the generation parameters, for
+# workflows where they cannot be found by class type, e.g.
+# {"prompt": ["6", "text"], "seed": ["3", "seed"]}
+COMFY_WORKFLOW_NODES = {}
+
+# Connections to the ComfyUI server, kept open between generations
+COMFY_CONNECTION = {
+    "pool_size": 8,            # keep-alive HTTP connections
+    "http_timeout": 30,        # seconds per HTTP request
+    "reconnect_attempts": 5,   # WebSocket reconnects before giving up
+    "reconnect_delay": 1.0,    # seconds, doubled after each failed attempt
+}
+
+# Batch generation: prompts kept queued on the server so it never idles
+# between jobs, and threads downloading finished outputs
+COMFY_BATCH = {
+    "max_queued": 8,
+    "download_workers": 4,
+}
+
+# Seconds before a ComfyUI prompt is cancelled: "job" once it has started
+# executing, "idle" without any progress message
+COMFY_TIMEOUTS = {
+    "job": 600,
+    "idle": 120,
+}
+
+# Number of images annotated in parallel during folder runs
+ANNOTATION_CONCURRENCY = 4
+
+# Images sent together in one request during folder runs; 1 disables packing
+ANNOTATION_PACK_SIZE = 1
+
+# Model list cached on disk so startup needs no network; refreshed in the
+# background once older than ttl_hours
+MODEL_LIST_CACHE = {
+    "path": "models_cache.json",
+    "ttl_hours": 24,
+}
+
+# Client-side limits for OpenAI calls, shared by every annotation path.
+# "rpm"/"tpm" only apply until a response reports the account's own limits
+# in its x-ratelimit-limit-* headers; None means no limit until then
+OPENAI_RATE_LIMITS = {
+    "rpm": None,         # requests per minute
+    "tpm": None,         # tokens per minute
+    "max_retries": 5,    # per call, on 429/5xx/connection errors
+    "retry_budget": 20,  # retries available across all concurrent calls
+}
+
+# Responses cached by image content, prompt and model; "enabled": False bypasses it
+ANNOTATION_CACHE = {
+    "enabled": True,
+    "path": "annotation_cache.db",
+    "max_entries": 50000,
+    "max_age_days": 90,
+}
+
+# Images are downscaled and re-encoded before upload (needs Pillow)
+IMAGE_PREPROCESS = {
+    "enabled": True,
+    "max_side": 1536,    # pixels on the long side
+    "format": "JPEG",    # or "WEBP"
+    "quality": 85,
+    "detail": "auto",    # images up to 512 px always use "low"
+    "workers": 0,        # processes, 0 = one per CPU
+}
+
+# Per-request metrics of API calls, appended to a JSONL log
+TELEMETRY = {
+    "enabled": True,
+    "path": "telemetry.jsonl",  # None keeps records in memory only
+    "keep": 10000,              # records kept in memory for reports
+}
@@ -0,0 +1,221 @@
+import io
+import os
+import csv
+import gzip
+import json
+import codecs
+
+# Column order used by exports and accepted by imports
+EXPORT_FIELDS = ("image_path", "annotation", "is_new", "is_approved")
+
+# Export formats, keyed by the file extension they are written with
+EXPORT_FORMATS = ("jsonl", "jsonl.gz", "csv", "json")
+
+READ_CHUNK_SIZE = 1 << 16
+
+
+def export_format(path):
+    """Guess the export format of ``path`` from its extension (default ``jsonl``)."""
+    name = path.lower()
+    for fmt in sorted(EXPORT_FORMATS, key=len, reverse=True):
+        if name.endswith("." + fmt):
+            return fmt
+    return "jsonl"
+
+
+def normalize_record(item):
+    """Return ``(image_path, annotation, is_new, is_approved)`` for ``item``.
+
+    Both the list rows written by the old JSON export and dictionaries keyed
+    by :data:`EXPORT_FIELDS` are accepted.
+    """
+    if isinstance(item, dict):
+        return (
+            item["image_path"],
+            item.get("annotation", ""),
+            int(item.get("is_new", 1)),
+            int(item.get("is_approved", 0)),
+        )
+    image_path, annotation, is_new, is_approved = item
+    return image_path, annotation, int(is_new), int(is_approved)
+
+
+def _incomplete(error, buf):
+    """Whether ``error`` from decoding ``buf`` only means the record runs
+    past the end of the buffer, rather than that it is malformed."""
+    # Only an unterminated string or a failure within the last few characters
+    # (a cut literal or escape such as "tr" or "\\u00") can be fixed by more data
+    return error.msg.startswith("Unterminated string") or error.pos >= len(buf.rstrip()) - 6
+
+
+def iter_json_array(fp, chunk_size=READ_CHUNK_SIZE):
+    """Yield each element of a JSON array read from binary stream ``fp``.
+
+    Only one chunk plus the record being decoded is held in memory, whatever
+    the size of the file. Malformed input - including empty elements such
+    as ``[1,,2]`` and anything but whitespace after the closing ``]`` -
+    raises ``ValueError`` where it occurs instead of being buffered until
+    the end of the file.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    json_decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    # What may come next: "[" to open, a "value" (or "]" in an empty
+    # array), a "separator" ("," or "]") after an element, or an "element"
+    # after a comma
+    expect = "["
+
+    def read():
+        """Return ``(text, eof)``; EOF is the stream running dry, never an
+        empty decode (a chunk holding only a BOM or part of a character)."""
+        while True:
+            data = fp.read(chunk_size)
+            text = decoder.decode(data, final=not data)
+            if text or not data:
+                return text, not data
+
+    def finish():
+        """Check that only whitespace follows the closing bracket."""
+        rest = buf[pos + 1:]
+        while True:
+            if rest.strip():
+                raise ValueError("Unexpected data after the end of the JSON array")
+            if eof:
+                return
+            rest, _ = read()
+            if not rest:
+                return
+
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            buf, eof = read()
+            pos = 0
+            continue
+
+        char = buf[pos]
+        if expect == "[":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            expect = "value"
+            pos += 1
+            continue
+        if expect == "separator":
+            if char == "]":
+                return finish()
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {char!r}")
+            expect = "element"
+            pos += 1
+            continue
+        if char == "]" and expect == "value":
+            return finish()
+        if char in ",]":
+            raise ValueError(f"Empty element in JSON array at {char!r}")
+
+        try:
+            obj, end = json_decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if eof or not _incomplete(e, buf):
+                raise
+            end = None
+        # A number at the end of the buffer may have more digits to come
+        if end is None or (not eof and not buf[end:].strip("0123456789+-.eE")):
+            chunk, eof = read()
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        pos = end
+        expect = "separator"
+        yield obj
+
+
+def iter_jsonl(fp):
+    """Yield the record on each non-empty line of a JSONL stream."""
+    for line in fp:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_csv(fp):
+    """Yield a record for each row of a CSV export with a header line."""
+    text = io.TextIOWrapper(fp, encoding="utf-8-sig", newline="")
+    yield from csv.DictReader(text)
+
+
+def iter_export_records(path):
+    """Yield ``(row, bytes_read, total_bytes)`` from any export written by
+    :class:`ExportWriter`, plain or gzip-compressed.
+
+    JSON arrays and JSON Lines are told apart by the first non-blank
+    character, so ``.json`` files holding JSON Lines are handled as well.
+    ``bytes_read`` counts bytes of the file on disk, compressed or not.
+    """
+    total = os.path.getsize(path)
+    with open(path, "rb") as raw:
+        compressed = raw.read(2) == b"\x1f\x8b"
+        raw.seek(0)
+        fp = gzip.GzipFile(fileobj=raw) if compressed else raw
+        name = path.lower()[:-3] if path.lower().endswith(".gz") else path.lower()
+        if name.endswith(".csv"):
+            records = iter_csv(fp)
+        else:
+            head = fp.peek(READ_CHUNK_SIZE) if compressed else fp.read(READ_CHUNK_SIZE)
+            if not compressed:
+                fp.seek(0)
+            head = head.lstrip(codecs.BOM_UTF8).lstrip()
+            records = iter_json_array(fp) if head.startswith(b"[") else iter_jsonl(fp)
+        for item in records:
+            yield normalize_record(item), raw.tell(), total
+
+
+class ExportWriter:
+    """Write export rows one at a time in one of :data:`EXPORT_FORMATS`.
+
+    ``jsonl`` and ``jsonl.gz`` hold one object per line keyed by
+    :data:`EXPORT_FIELDS`; ``json`` keeps the legacy array-of-lists layout.
+    Use as a context manager so the file is always finalised.
+    """
+
+    def __init__(self, path, fmt=None):
+        self.path = path
+        self.fmt = fmt or export_format(path)
+        if self.fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {self.fmt}")
+        if self.fmt == "jsonl.gz":
+            self.fp = gzip.open(path, "wt", encoding="utf-8", newline="")
+        else:
+            self.fp = open(path, "w", encoding="utf-8", newline="")
+        self.count = 0
+        if self.fmt == "csv":
+            self._csv = csv.writer(self.fp)
+            self._csv.writerow(EXPORT_FIELDS)
+        elif self.fmt == "json":
+            self.fp.write("[")
+
+    def write(self, row):
+        row = normalize_record(row)
+        if self.fmt == "csv":
+            self._csv.writerow(row)
+        elif self.fmt == "json":
+            self.fp.write(("," if self.count else "") + "\n  " + json.dumps(list(row), ensure_ascii=False))
+        else:
+            self.fp.write(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + "\n")
+        self.count += 1
+
+    def close(self):
+        if self.fmt == "json":
+            self.fp.write("\n]\n")
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -2,14 +2,447 @@ import sqlite3
 import logging
 import os
 import json
+import time
+import random
+import weakref
+import threading
+from contextlib import contextmanager
+from itertools import islice
+from data_transfer import ExportWriter, iter_export_records, normalize_record
+
+# PRAGMAs applied to every long-lived connection in pooled mode
+POOLED_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-20000",      # ~20 MB page cache
+    "PRAGMA mmap_size=268435456",    # 256 MB memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Pure SQL basename of ``image_path`` (handles both / and \ separators):
+# rtrim() strips the file name, leaving the directory prefix to skip.
+BASENAME_SQL = ("substr({col}, length(rtrim({col}, "
+                "replace(replace({col}, '/', ''), '\\', ''))) + 1)")
+
+def _migrate_fts(conn):
+    """Create the FTS5 index over annotation text, if SQLite has FTS5."""
+    try:
+        conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS annotations_fts
+                        USING fts5(annotation, content='annotations', content_rowid='id')""")
+    except sqlite3.OperationalError as e:
+        logging.warning(f"Full-text search unavailable, falling back to LIKE: {e}")
+        return
+    for statement in (
+        """CREATE TRIGGER IF NOT EXISTS annotations_fts_insert
+           AFTER INSERT ON annotations BEGIN
+               INSERT INTO annotations_fts (rowid, annotation) VALUES (NEW.id, NEW.annotation);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS annotations_fts_delete
+           AFTER DELETE ON annotations BEGIN
+               INSERT INTO annotations_fts (annotations_fts, rowid, annotation)
+                   VALUES ('delete', OLD.id, OLD.annotation);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS annotations_fts_update
+           AFTER UPDATE OF annotation ON annotations BEGIN
+               INSERT INTO annotations_fts (annotations_fts, rowid, annotation)
+                   VALUES ('delete', OLD.id, OLD.annotation);
+               INSERT INTO annotations_fts (rowid, annotation) VALUES (NEW.id, NEW.annotation);
+           END""",
+        "INSERT INTO annotations_fts (annotations_fts) VALUES ('rebuild')",
+    ):
+        conn.execute(statement)
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last
+    one as a prefix so results follow the user while typing."""
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+# Number of change-feed entries kept; older readers fall back to a full reload
+CHANGELOG_KEEP = 10000
+# The change feed is trimmed back to CHANGELOG_KEEP entries every this many writes
+CHANGELOG_PRUNE_EVERY = 1000
+
+
+def _log_siblings(name_sql, row_id):
+    """Trigger statement logging the only other row named ``name_sql``: its
+    ``ambiguous`` list flag flips when a namesake appears or goes away."""
+    return f"""INSERT INTO annotation_changes (image_path, op)
+                   SELECT image_path, 'upsert' FROM annotations
+                   WHERE basename = {name_sql} AND id != {row_id}
+                     AND (SELECT COUNT(*) FROM annotations
+                          WHERE basename = {name_sql} AND id != {row_id}) = 1;"""
+
+
+# Schema migrations, applied in order: tuples of statements or callables
+# taking the connection. ``PRAGMA user_version`` records how many of them the
+# database has already seen.
+MIGRATIONS = [
+    # 1: indexed basename column kept in sync by triggers
+    (
+        "ALTER TABLE annotations ADD COLUMN basename TEXT",
+        "UPDATE annotations SET basename = " + BASENAME_SQL.format(col="image_path"),
+        "CREATE INDEX IF NOT EXISTS idx_basename ON annotations(basename)",
+        """CREATE TRIGGER IF NOT EXISTS annotations_basename_insert
+           AFTER INSERT ON annotations BEGIN
+               UPDATE annotations SET basename = """ + BASENAME_SQL.format(col="NEW.image_path") + """
+               WHERE id = NEW.id;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS annotations_basename_update
+           AFTER UPDATE OF image_path ON annotations BEGIN
+               UPDATE annotations SET basename = """ + BASENAME_SQL.format(col="NEW.image_path") + """
+               WHERE id = NEW.id;
+           END""",
+    ),
+    # 2: status filters for keyset-paginated listing
+    (
+        "CREATE INDEX IF NOT EXISTS idx_status ON annotations(is_approved, is_new, id)",
+        "CREATE INDEX IF NOT EXISTS idx_approved ON annotations(is_approved, id)",
+    ),
+    # 3: change feed - every write to annotations appends a revision
+    (
+        """CREATE TABLE IF NOT EXISTS annotation_changes
+           (revision INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_path TEXT,
+            op TEXT NOT NULL)""",
+        """CREATE TRIGGER IF NOT EXISTS annotations_log_insert
+           AFTER INSERT ON annotations BEGIN
+               INSERT INTO annotation_changes (image_path, op) VALUES (NEW.image_path, 'upsert');
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS annotations_log_update
+           AFTER UPDATE OF image_path, annotation, is_new, is_approved ON annotations BEGIN
+               INSERT INTO annotation_changes (image_path, op)
+                   SELECT OLD.image_path, 'delete' WHERE OLD.image_path IS NOT NEW.image_path;
+               INSERT INTO annotation_changes (image_path, op) VALUES (NEW.image_path, 'upsert');
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS annotations_log_delete
+           AFTER DELETE ON annotations BEGIN
+               INSERT INTO annotation_changes (image_path, op) VALUES (OLD.image_path, 'delete');
+           END""",
+        "INSERT INTO annotation_changes (image_path, op) VALUES (NULL, 'reset')",
+    ),
+    # 4: caption sidecars written by caption_sync
+    (
+        """CREATE TABLE IF NOT EXISTS caption_files
+           (image_path TEXT PRIMARY KEY,
+            txt_path TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            revision INTEGER,
+            written_at REAL)""",
+    ),
+    # 5: full-text search over annotation text
+    _migrate_fts,
+    # 6: OpenAI Batch API jobs and the image behind every request in them
+    (
+        """CREATE TABLE IF NOT EXISTS annotation_batches
+           (batch_id TEXT PRIMARY KEY,
+            input_file_id TEXT NOT NULL,
+            model TEXT,
+            status TEXT,
+            output_file_id TEXT,
+            error_file_id TEXT,
+            created_at REAL,
+            imported_at REAL)""",
+        """CREATE TABLE IF NOT EXISTS annotation_batch_items
+           (batch_id TEXT NOT NULL,
+            custom_id TEXT NOT NULL,
+            image_path TEXT NOT NULL,
+            cache_key TEXT,
+            PRIMARY KEY (batch_id, custom_id))""",
+        "CREATE INDEX IF NOT EXISTS idx_batch_items_path ON annotation_batch_items(image_path)",
+    ),
+    # 7: resumable annotation jobs with per-image task state
+    (
+        """CREATE TABLE IF NOT EXISTS annotation_jobs
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT,
+            prompt TEXT,
+            model TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at REAL,
+            updated_at REAL)""",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_lookup ON annotation_jobs(source, model, status)",
+        """CREATE TABLE IF NOT EXISTS annotation_tasks
+           (job_id INTEGER NOT NULL,
+            image_path TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            updated_at REAL,
+            PRIMARY KEY (job_id, image_path))""",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_state ON annotation_tasks(job_id, state)",
+    ),
+    # 8: log rows whose ambiguous flag changes, and keep the change feed bounded
+    (
+        """CREATE TRIGGER IF NOT EXISTS annotations_log_siblings_insert
+           AFTER INSERT ON annotations BEGIN
+               """ + _log_siblings(BASENAME_SQL.format(col="NEW.image_path"), "NEW.id") + """
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS annotations_log_siblings_update
+           AFTER UPDATE OF image_path ON annotations
+           WHEN """ + BASENAME_SQL.format(col="OLD.image_path") + " IS NOT "
+        + BASENAME_SQL.format(col="NEW.image_path") + """ BEGIN
+               """ + _log_siblings(BASENAME_SQL.format(col="OLD.image_path"), "NEW.id") + """
+               """ + _log_siblings(BASENAME_SQL.format(col="NEW.image_path"), "NEW.id") + """
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS annotations_log_siblings_delete
+           AFTER DELETE ON annotations BEGIN
+               """ + _log_siblings("OLD.basename", "OLD.id") + """
+           END""",
+        f"""CREATE TRIGGER IF NOT EXISTS annotation_changes_prune
+            AFTER INSERT ON annotation_changes
+            WHEN NEW.revision % {CHANGELOG_PRUNE_EVERY} = 0 BEGIN
+                DELETE FROM annotation_changes WHERE revision <= NEW.revision - {CHANGELOG_KEEP};
+            END""",
+    ),
+]
+
+# States of an annotation task; "running" tasks left by a crash are resumed
+TASK_STATES = ("pending", "running", "done", "failed")
+
+# WHERE fragments for the status filters offered by the annotation lists
+STATUS_FILTERS = {
+    "all": "1",
+    "approved": "is_approved = 1",
+    "not_approved": "is_approved = 0 AND is_new = 0",
+    "new": "is_approved = 0 AND is_new = 1",
+}
+
+
+# Columns of the lightweight list rows: (id, image_path, is_new, is_approved, ambiguous)
+LIST_COLUMNS = """id, image_path, is_new, is_approved,
+                  EXISTS(SELECT 1 FROM annotations AS other
+                         WHERE other.basename = annotations.basename
+                           AND other.id != annotations.id)"""
+
+
+def status_matches(status, is_new, is_approved):
+    """Python twin of :data:`STATUS_FILTERS` for rows already in memory."""
+    if status == "approved":
+        return bool(is_approved)
+    if status == "not_approved":
+        return not is_approved and not is_new
+    if status == "new":
+        return not is_approved and bool(is_new)
+    return True
+
+
+def is_busy_error(error):
+    """Whether ``error`` is SQLite's transient ``database is locked``/busy failure."""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def file_basename(path):
+    """Python twin of :data:`BASENAME_SQL`, splitting on both separators."""
+    return path.replace("\\", "/").rsplit("/", 1)[-1]
+
+
+def display_name(image_path, ambiguous=False):
+    """List label for ``image_path``; ambiguous names get their parent folder."""
+    name = file_basename(image_path)
+    if ambiguous:
+        parent = file_basename(image_path[:-len(name)].rstrip("/\\"))
+        name = f"{parent}/{name}"
+    return name
+
+
+# An upsert keeps the row id, so the update fires UPDATE triggers (change
+# feed, full-text index) where INSERT OR REPLACE would silently delete
+UPSERT_ANNOTATION = """INSERT INTO annotations (image_path, annotation, is_new)
+                       VALUES (?, ?, 1)
+                       ON CONFLICT(image_path) DO UPDATE
+                       SET annotation = excluded.annotation, is_new = 1, is_approved = 0"""
+
+
+# Longest wait between retries of a failing write-behind flush, in seconds
+MAX_FLUSH_RETRY_DELAY = 30.0
+
+
+class WriteBehindBuffer:
+    """Collect generated annotations and write them in batches.
+
+    ``add`` only queues the row; a background thread hands the queue to
+    ``write_rows`` in one transaction once ``max_rows`` rows are pending or
+    ``max_delay`` seconds have passed. ``close`` - or leaving the ``with``
+    block, also through an exception or cancellation - flushes whatever is
+    left. Rows of a failed flush are kept and retried with the next one,
+    after a delay that doubles with every failure up to
+    :data:`MAX_FLUSH_RETRY_DELAY` seconds.
+    """
+
+    def __init__(self, write_rows, max_rows=50, max_delay=2.0):
+        self.write_rows = write_rows
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.written = 0
+        self._rows = []
+        self._closed = False
+        self._flush_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def add(self, image_path, annotation):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write-behind buffer is closed")
+            self._rows.append((image_path, annotation))
+            if len(self._rows) >= self.max_rows:
+                self._condition.notify()
+
+    def flush(self):
+        """Write all pending rows now; raises if the write fails."""
+        with self._flush_lock:
+            with self._condition:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return
+            try:
+                self.write_rows(rows)
+            except BaseException:
+                with self._condition:
+                    self._rows[:0] = rows
+                raise
+            self.written += len(rows)
+
+    def _run(self):
+        retry_delay = 0.0
+        while True:
+            with self._condition:
+                if retry_delay:
+                    # After a failed flush wait even if the queue is full, so
+                    # a broken database is not hammered in a tight loop
+                    self._condition.wait_for(lambda: self._closed, retry_delay)
+                elif not self._closed and len(self._rows) < self.max_rows:
+                    self._condition.wait(self.max_delay)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+                retry_delay = 0.0
+            except Exception as e:
+                retry_delay = min(max(retry_delay * 2, self.max_delay), MAX_FLUSH_RETRY_DELAY)
+                logging.error(f"Write-behind flush failed, retrying in {retry_delay:.1f}s: {e}")
+
+    def close(self):
+        """Stop the background thread and flush the remaining rows."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _ThreadConnection:
+    """The pooled connection of one thread, kept in its thread-local data."""
+
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn):
+        self.conn = conn
+
 
 class DatabaseManager:
-    def __init__(self, db_name='annotations.db'):
+    def __init__(self, db_name='annotations.db', pooled=True, timeout=30.0,
+                 busy_retries=5, raise_errors=False):
+        """Create a manager for the SQLite database ``db_name``.
+
+        With ``pooled=True`` every thread keeps one long-lived connection in
+        WAL mode, so Gradio workers and Qt threads can read while another
+        thread writes and statements stay in the per-connection cache.
+        ``pooled=False`` restores the old connect-per-query behaviour.
+
+        Queries that still hit ``database is locked`` after the ``timeout``
+        busy wait are retried ``busy_retries`` times with backoff. Errors are
+        logged and reported as ``False``/``None`` unless ``raise_errors`` is
+        set, in which case they propagate to the caller.
+        """
         self.db_name = db_name
+        self.pooled = pooled
+        self.timeout = timeout
+        self.busy_retries = busy_retries
+        self.raise_errors = raise_errors
+        self._local = threading.local()
+        self._connections = set()
+        self._connections_lock = threading.Lock()
         self.init_db()
 
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=self.timeout,
+                               check_same_thread=False, cached_statements=256)
+        if self.pooled:
+            for pragma in POOLED_PRAGMAS:
+                conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        """Return a connection for the calling thread."""
+        if not self.pooled:
+            return self._connect()
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            holder = _ThreadConnection(self._connect())
+            self._local.holder = holder
+            with self._connections_lock:
+                self._connections.add(holder.conn)
+            # Thread-local data is freed when its thread exits; the
+            # connection goes with it instead of staying open until close()
+            weakref.finalize(holder, self._discard, holder.conn)
+        return holder.conn
+
+    def _discard(self, conn):
+        with self._connections_lock:
+            self._connections.discard(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _release(self, conn):
+        if conn is not None and not self.pooled:
+            conn.close()
+
+    def close(self):
+        """Close every pooled connection opened by this manager."""
+        with self._connections_lock:
+            connections, self._connections = self._connections, set()
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        """Yield a connection and commit once the block succeeds.
+
+        Any exception rolls the whole block back, so bulk operations never
+        leave a half-written chunk behind.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
     def init_db(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = self._acquire()
         c = conn.cursor()
         c.execute('''CREATE TABLE IF NOT EXISTS annotations
                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -19,32 +452,72 @@ class DatabaseManager:
                       is_approved INTEGER DEFAULT 0)''')
         c.execute('CREATE INDEX IF NOT EXISTS idx_image_path ON annotations(image_path)')
         conn.commit()
-        conn.close()
+        self._migrate(conn)
+        self._release(conn)
+        self.prune_changes()
 
-    def execute_query(self, query, params=(), fetch=False):
+    def _migrate(self, conn):
+        """Apply pending :data:`MIGRATIONS` inside one immediate transaction."""
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+            return
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            conn = sqlite3.connect(self.db_name)
-            c = conn.cursor()
-            c.execute(query, params)
-            if fetch:
-                result = c.fetchall()
-            else:
-                result = None
+            # Re-read under the write lock in case another process migrated
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                if callable(statements):
+                    statements(conn)
+                else:
+                    for statement in statements:
+                        conn.execute(statement)
+                logging.info(f"Applied database migration {number}")
+            conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
             conn.commit()
-            return result if fetch else True
-        except sqlite3.Error as e:
-            logging.error(f"Database error: {e}")
-            logging.error(f"Query: {query}")
-            logging.error(f"Params: {params}")
-            return None if fetch else False
-        finally:
-            conn.close()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def execute_query(self, query, params=(), fetch=False):
+        for attempt in range(self.busy_retries + 1):
+            conn = None
+            try:
+                conn = self._acquire()
+                c = conn.cursor()
+                c.execute(query, params)
+                if fetch:
+                    result = c.fetchall()
+                else:
+                    result = None
+                conn.commit()
+                return result if fetch else True
+            except sqlite3.Error as e:
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
+                if is_busy_error(e) and attempt < self.busy_retries:
+                    time.sleep(random.uniform(0.5, 1.0) * min(0.05 * 2 ** attempt, 2.0))
+                    continue
+                logging.error(f"Database error: {e}")
+                logging.error(f"Query: {query}")
+                logging.error(f"Params: {params}")
+                if self.raise_errors:
+                    raise
+                return None if fetch else False
+            finally:
+                self._release(conn)
 
     def insert_or_update_annotation(self, image_path, annotation):
-        query = """INSERT OR REPLACE INTO annotations 
-                   (image_path, annotation, is_new) 
-                   VALUES (?, ?, 1)"""
-        return self.execute_query(query, (image_path, annotation))
+        return self.execute_query(UPSERT_ANNOTATION, (image_path, annotation))
+
+    def insert_or_update_annotations(self, rows):
+        """Upsert many ``(image_path, annotation)`` pairs in one transaction."""
+        with self.transaction() as conn:
+            conn.executemany(UPSERT_ANNOTATION, rows)
+        return True
+
+    def write_behind(self, max_rows=50, max_delay=2.0, write_rows=None):
+        """Return a :class:`WriteBehindBuffer` that batches annotation upserts,
+        or calls to ``write_rows(rows)`` if given."""
+        return WriteBehindBuffer(write_rows or self.insert_or_update_annotations, max_rows, max_delay)
 
     # Для обратной совместимости, если где-то все еще используется старый метод
     def insert_annotation(self, image_path, annotation):
@@ -61,23 +534,54 @@ class DatabaseManager:
             logging.error(f"Failed to update annotation for {image_path}")
         return success
 
+    def get_paths_by_filename(self, filename):
+        """Return every stored path whose file name is ``filename``.
+
+        Several rows match when different folders hold the same file name.
+        """
+        query = "SELECT image_path FROM annotations WHERE basename = ? ORDER BY id"
+        result = self.execute_query(query, (file_basename(filename),), fetch=True)
+        return [row[0] for row in result] if result else []
+
+    def _resolve_filename(self, filename):
+        """Map ``filename`` (a full path or a bare name) to a single stored path."""
+        if self.get_annotation(filename) is not None:
+            return filename
+        paths = self.get_paths_by_filename(filename)
+        if len(paths) > 1:
+            logging.warning(f"Ambiguous file name {filename!r} matches {len(paths)} paths, using {paths[0]}")
+        return paths[0] if paths else None
+
     def get_annotation_by_filename(self, filename):
-        query = """SELECT annotation, is_approved, image_path 
-                   FROM annotations 
-                   WHERE image_path LIKE ?"""
-        result = self.execute_query(query, ('%' + filename,), fetch=True)
-        if result:
-            return result[0]
-        return None
+        image_path = self._resolve_filename(filename)
+        if image_path is None:
+            return None
+        # The row may be deleted between the lookup and the read
+        row = self.get_annotation(image_path)
+        if row is None:
+            return None
+        annotation, is_approved = row
+        return annotation, is_approved, image_path
 
     def get_image_path(self, image_name):
-        query = "SELECT image_path FROM annotations WHERE image_path LIKE ?"
-        result = self.execute_query(query, ('%' + image_name,), fetch=True)
-        return result[0][0] if result else None
+        return self._resolve_filename(image_name)
 
     def update_image_path(self, old_image_name, new_image_path):
-        query = "UPDATE annotations SET image_path = ? WHERE image_path LIKE ?"
-        return self.execute_query(query, (new_image_path, '%' + old_image_name))
+        """Point the row for ``old_image_name`` at ``new_image_path``.
+
+        ``old_image_name`` may be the stored path or a bare file name; a bare
+        name shared by several folders is refused rather than guessed.
+        """
+        if self.get_annotation(old_image_name) is not None:
+            old_path = old_image_name
+        else:
+            paths = self.get_paths_by_filename(old_image_name)
+            if len(paths) != 1:
+                logging.error(f"Cannot update path for {old_image_name!r}: {len(paths)} matching rows")
+                return False
+            old_path = paths[0]
+        query = "UPDATE annotations SET image_path = ? WHERE image_path = ?"
+        return self.execute_query(query, (new_image_path, old_path))
 
     def get_annotation(self, image_path):
         query = "SELECT annotation, is_approved FROM annotations WHERE image_path = ?"
@@ -104,17 +608,395 @@ class DatabaseManager:
         return self.execute_query(query, (image_path,))
 
     def clear_database(self):
-        query = "DELETE FROM annotations"
-        return self.execute_query(query)
+        try:
+            with self.transaction() as conn:
+                conn.execute("DELETE FROM annotations")
+                # One reset marker replaces the per-row delete entries
+                conn.execute("DELETE FROM annotation_changes")
+                conn.execute("INSERT INTO annotation_changes (image_path, op) VALUES (NULL, 'reset')")
+        except sqlite3.Error as e:
+            logging.error(f"Database error: {e}")
+            if self.raise_errors:
+                raise
+            return False
+        return True
 
     def get_all_annotations(self):
         query = "SELECT image_path, annotation, is_new, is_approved FROM annotations"
         return self.execute_query(query, fetch=True)
 
-    def import_annotations(self, data):
-        for item in data:
-            image_path, annotation, is_new, is_approved = item
-            query = """INSERT OR REPLACE INTO annotations 
-                       (image_path, annotation, is_new, is_approved) 
-                       VALUES (?, ?, ?, ?)"""
-            self.execute_query(query, (image_path, annotation, is_new, is_approved))
+    def list_annotations(self, after_id=0, limit=200, status="all"):
+        """Return one page of lightweight rows for the annotation lists.
+
+        Rows are ``(id, image_path, is_new, is_approved, ambiguous)`` ordered
+        by ``id``, without the annotation text. Pass the last ``id`` of a page
+        as ``after_id`` to fetch the next one; the index seek makes every page
+        cost the same however deep it is. ``ambiguous`` is true when another
+        row has the same file name.
+        """
+        query = f"""SELECT {LIST_COLUMNS}
+                    FROM annotations
+                    WHERE id > ? AND {STATUS_FILTERS[status]}
+                    ORDER BY id
+                    LIMIT ?"""
+        return self.execute_query(query, (after_id, limit), fetch=True) or []
+
+    def has_fts(self):
+        """Whether the FTS5 index exists (SQLite may be built without FTS5)."""
+        if getattr(self, "_has_fts", None) is None:
+            result = self.execute_query(
+                "SELECT 1 FROM sqlite_master WHERE name = 'annotations_fts'", fetch=True)
+            self._has_fts = bool(result)
+        return self._has_fts
+
+    def search_annotations(self, text, status="all", limit=200):
+        """Return list rows (see :meth:`list_annotations`) whose annotation
+        contains every word of ``text``, best matches first.
+
+        Uses the FTS5 index when available and a LIKE scan otherwise.
+        """
+        if not text.strip():
+            return []
+        if self.has_fts():
+            query = f"""SELECT {LIST_COLUMNS}
+                        FROM annotations_fts
+                        JOIN annotations ON annotations.id = annotations_fts.rowid
+                        WHERE annotations_fts MATCH ? AND {STATUS_FILTERS[status]}
+                        ORDER BY rank
+                        LIMIT ?"""
+            return self.execute_query(query, (fts_query(text), limit), fetch=True) or []
+        words = text.split()
+        where = " AND ".join(["annotation LIKE ?"] * len(words))
+        query = f"""SELECT {LIST_COLUMNS} FROM annotations
+                    WHERE {where} AND {STATUS_FILTERS[status]}
+                    ORDER BY id LIMIT ?"""
+        return self.execute_query(query, [f"%{w}%" for w in words] + [limit], fetch=True) or []
+
+    def current_revision(self):
+        """Return the revision of the latest change to the annotations table."""
+        result = self.execute_query("SELECT MAX(revision) FROM annotation_changes", fetch=True)
+        return (result[0][0] or 0) if result else 0
+
+    def changes_since(self, revision, limit=500):
+        """Return ``(current_revision, changes)`` for writes after ``revision``.
+
+        ``changes`` maps each touched image path to its list row (see
+        :meth:`list_annotations`) or to ``None`` if the row is gone. It is
+        ``None`` instead when the caller has to reload from scratch: the
+        database was cleared, the entries were pruned, or more than ``limit``
+        rows changed.
+        """
+        current = self.current_revision()
+        if revision >= current:
+            return current, {}
+        oldest = self.execute_query("SELECT MIN(revision) FROM annotation_changes", fetch=True)
+        if not oldest or revision + 1 < oldest[0][0]:
+            return current, None
+        query = """SELECT image_path, op FROM annotation_changes
+                   WHERE revision > ? AND revision <= ?
+                   ORDER BY revision LIMIT ?"""
+        entries = self.execute_query(query, (revision, current, limit + 1), fetch=True)
+        if entries is None or len(entries) > limit or any(op == "reset" for _path, op in entries):
+            return current, None
+
+        paths = list(dict.fromkeys(path for path, _op in entries))
+        changes = dict.fromkeys(paths)
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            query = f"""SELECT {LIST_COLUMNS} FROM annotations
+                        WHERE image_path IN ({", ".join("?" * len(chunk))})"""
+            for row in self.execute_query(query, chunk, fetch=True) or []:
+                changes[row[1]] = row
+        return current, changes
+
+    def prune_changes(self, keep=CHANGELOG_KEEP):
+        """Drop all but the newest ``keep`` change-feed entries."""
+        query = "DELETE FROM annotation_changes WHERE revision <= (SELECT MAX(revision) FROM annotation_changes) - ?"
+        return self.execute_query(query, (max(keep, 1),))
+
+    def _export_filter(self, status, path_prefix):
+        where, params = [STATUS_FILTERS[status]], []
+        if path_prefix:
+            # A range on image_path can use idx_image_path, unlike LIKE 'prefix%'
+            where.append("image_path >= ? AND image_path < ?")
+            params += [path_prefix, path_prefix + "\U0010ffff"]
+        return " AND ".join(where), params
+
+    def count_annotations(self, status="all", path_prefix=""):
+        where, params = self._export_filter(status, path_prefix)
+        result = self.execute_query(f"SELECT COUNT(*) FROM annotations WHERE {where}", params, fetch=True)
+        return result[0][0] if result else 0
+
+    def iter_annotations(self, status="all", path_prefix="", batch_size=1000):
+        """Yield full ``(image_path, annotation, is_new, is_approved)`` rows.
+
+        Rows are streamed from one cursor with ``fetchmany`` so the table is
+        never loaded into memory at once. The generator uses its own
+        connection, leaving the calling thread's pooled one free for writes.
+        """
+        where, params = self._export_filter(status, path_prefix)
+        query = f"""SELECT image_path, annotation, is_new, is_approved
+                    FROM annotations WHERE {where} ORDER BY id"""
+        return self.iter_query(query, params, batch_size)
+
+    def iter_query(self, query, params=(), batch_size=1000):
+        """Yield the rows of ``query`` in ``fetchmany`` batches from a private connection."""
+        conn = sqlite3.connect(self.db_name, timeout=self.timeout)
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def export_file(self, path, fmt=None, status="all", path_prefix="", progress=None):
+        """Stream matching rows to ``path`` as JSONL, gzip JSONL, CSV or JSON.
+
+        ``fmt`` defaults to the one implied by the extension (see
+        :func:`data_transfer.export_format`). ``progress(rows_done, total)``
+        is called every 1000 rows. Returns the number of exported rows.
+        """
+        total = self.count_annotations(status, path_prefix)
+        with ExportWriter(path, fmt) as writer:
+            for row in self.iter_annotations(status, path_prefix):
+                writer.write(row)
+                if progress and writer.count % 1000 == 0:
+                    progress(writer.count, total)
+        if progress:
+            progress(writer.count, total)
+        return writer.count
+
+    def iter_caption_candidates(self):
+        """Yield ``(image_path, annotation, txt_path, content_hash)`` for every
+        approved annotation, with the sidecar last written for it (or ``None``s).
+        """
+        query = """SELECT a.image_path, a.annotation, c.txt_path, c.content_hash
+                   FROM annotations AS a
+                   LEFT JOIN caption_files AS c ON c.image_path = a.image_path
+                   WHERE a.is_approved = 1
+                   ORDER BY a.id"""
+        return self.iter_query(query)
+
+    def get_orphan_caption_files(self):
+        """Return ``(image_path, txt_path)`` of sidecars whose annotation is no
+        longer approved or no longer exists."""
+        query = """SELECT c.image_path, c.txt_path FROM caption_files AS c
+                   LEFT JOIN annotations AS a ON a.image_path = c.image_path
+                   WHERE a.is_approved IS NOT 1"""
+        return self.execute_query(query, fetch=True) or []
+
+    def record_caption_files(self, rows):
+        """Remember written sidecars: ``(image_path, txt_path, content_hash, revision, written_at)``."""
+        query = "INSERT OR REPLACE INTO caption_files VALUES (?, ?, ?, ?, ?)"
+        with self.transaction() as conn:
+            conn.executemany(query, rows)
+
+    def forget_caption_files(self, image_paths):
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM caption_files WHERE image_path = ?",
+                             [(path,) for path in image_paths])
+
+    def iter_unannotated_paths(self):
+        """Yield the image paths of rows that have no annotation text yet."""
+        query = """SELECT image_path FROM annotations
+                   WHERE annotation IS NULL OR annotation = ''
+                   ORDER BY id"""
+        return (row[0] for row in self.iter_query(query))
+
+    def record_batch(self, batch_id, input_file_id, model, status, items):
+        """Remember a submitted batch and its ``(custom_id, image_path, cache_key)`` items."""
+        with self.transaction() as conn:
+            conn.execute("""INSERT INTO annotation_batches
+                            (batch_id, input_file_id, model, status, created_at)
+                            VALUES (?, ?, ?, ?, ?)""",
+                         (batch_id, input_file_id, model, status, time.time()))
+            conn.executemany("INSERT INTO annotation_batch_items VALUES (?, ?, ?, ?)",
+                             [(batch_id, *item) for item in items])
+
+    def update_batch(self, batch_id, status, output_file_id=None, error_file_id=None, imported=False):
+        query = """UPDATE annotation_batches
+                   SET status = ?, output_file_id = ?, error_file_id = ?,
+                       imported_at = CASE WHEN ? THEN ? ELSE imported_at END
+                   WHERE batch_id = ?"""
+        return self.execute_query(query, (status, output_file_id, error_file_id,
+                                          imported, time.time(), batch_id))
+
+    def get_open_batches(self):
+        """Return ``(batch_id, status, model)`` of batches whose results are not imported yet."""
+        query = """SELECT batch_id, status, model FROM annotation_batches
+                   WHERE imported_at IS NULL ORDER BY created_at"""
+        return self.execute_query(query, fetch=True) or []
+
+    def get_batch_items(self, batch_id):
+        """Return ``{custom_id: (image_path, cache_key)}`` for ``batch_id``."""
+        query = "SELECT custom_id, image_path, cache_key FROM annotation_batch_items WHERE batch_id = ?"
+        rows = self.execute_query(query, (batch_id,), fetch=True) or []
+        return {custom_id: (image_path, key) for custom_id, image_path, key in rows}
+
+    def get_open_batch_paths(self):
+        """Return the set of image paths already queued in an open batch."""
+        query = """SELECT i.image_path FROM annotation_batch_items AS i
+                   JOIN annotation_batches AS b ON b.batch_id = i.batch_id
+                   WHERE b.imported_at IS NULL"""
+        return {row[0] for row in self.execute_query(query, fetch=True) or []}
+
+    def get_annotated_paths(self, image_paths, chunk_size=500):
+        """Return the subset of ``image_paths`` that already have annotation text."""
+        image_paths = list(image_paths)
+        found = set()
+        for start in range(0, len(image_paths), chunk_size):
+            chunk = image_paths[start:start + chunk_size]
+            query = f"""SELECT image_path FROM annotations
+                        WHERE image_path IN ({", ".join("?" * len(chunk))})
+                          AND annotation IS NOT NULL AND annotation != ''"""
+            found.update(row[0] for row in self.execute_query(query, chunk, fetch=True) or [])
+        return found
+
+    def open_job(self, source, prompt, model):
+        """Return ``(job_id, resumed)``: the latest unfinished job for the same
+        source, prompt and model, or a new one."""
+        with self.transaction() as conn:
+            row = conn.execute("""SELECT id FROM annotation_jobs
+                                  WHERE source = ? AND model = ? AND prompt = ? AND status != 'done'
+                                  ORDER BY id DESC LIMIT 1""", (source, model, prompt)).fetchone()
+            if row:
+                return row[0], True
+            now = time.time()
+            cursor = conn.execute("""INSERT INTO annotation_jobs (source, prompt, model, created_at, updated_at)
+                                     VALUES (?, ?, ?, ?, ?)""", (source, prompt, model, now, now))
+            return cursor.lastrowid, False
+
+    def add_job_tasks(self, job_id, image_paths, force=False):
+        """Add ``image_paths`` to ``job_id`` as pending tasks.
+
+        Images that already have an annotation are left out unless ``force``
+        is set; images already in the job keep their state, except that
+        ``force`` returns them to pending so they are annotated again.
+        Returns ``(added, skipped)``.
+        """
+        image_paths = list(dict.fromkeys(image_paths))
+        annotated = set() if force else self.get_annotated_paths(image_paths)
+        rows = [(job_id, path, time.time()) for path in image_paths if path not in annotated]
+        if force:
+            query = """INSERT INTO annotation_tasks (job_id, image_path, updated_at) VALUES (?, ?, ?)
+                       ON CONFLICT(job_id, image_path) DO UPDATE
+                       SET state = 'pending', last_error = NULL, updated_at = excluded.updated_at"""
+        else:
+            query = """INSERT OR IGNORE INTO annotation_tasks (job_id, image_path, updated_at)
+                       VALUES (?, ?, ?)"""
+        with self.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(query, rows)
+            added = conn.total_changes - before
+        return added, len(annotated)
+
+    def start_job_tasks(self, job_id, states=("pending", "running", "failed")):
+        """Mark the tasks of ``job_id`` in ``states`` as running and return
+        their image paths in the order they were added."""
+        marks = ", ".join("?" * len(states))
+        with self.transaction() as conn:
+            paths = [row[0] for row in conn.execute(
+                f"""SELECT image_path FROM annotation_tasks
+                    WHERE job_id = ? AND state IN ({marks}) ORDER BY rowid""", (job_id, *states))]
+            now = time.time()
+            conn.execute(f"""UPDATE annotation_tasks SET state = 'running', updated_at = ?
+                             WHERE job_id = ? AND state IN ({marks})""", (now, job_id, *states))
+            conn.execute("UPDATE annotation_jobs SET status = 'running', updated_at = ? WHERE id = ?",
+                         (now, job_id))
+        return paths
+
+    def complete_job_tasks(self, job_id, rows):
+        """Upsert ``(image_path, annotation)`` rows and mark their tasks done,
+        in one transaction so a crash never loses either half."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(UPSERT_ANNOTATION, rows)
+            conn.executemany("""UPDATE annotation_tasks
+                                SET state = 'done', attempts = attempts + 1, last_error = NULL, updated_at = ?
+                                WHERE job_id = ? AND image_path = ?""",
+                             [(now, job_id, image_path) for image_path, _ in rows])
+        return True
+
+    def fail_job_task(self, job_id, image_path, error):
+        query = """UPDATE annotation_tasks
+                   SET state = 'failed', attempts = attempts + 1, last_error = ?, updated_at = ?
+                   WHERE job_id = ? AND image_path = ?"""
+        return self.execute_query(query, (str(error), time.time(), job_id, image_path))
+
+    def get_job_counts(self, job_id):
+        """Return ``{state: count}`` over every :data:`TASK_STATES` for ``job_id``."""
+        counts = dict.fromkeys(TASK_STATES, 0)
+        rows = self.execute_query("SELECT state, COUNT(*) FROM annotation_tasks WHERE job_id = ? GROUP BY state",
+                                  (job_id,), fetch=True) or []
+        counts.update(rows)
+        return counts
+
+    def finish_job(self, job_id):
+        """Return tasks a stopped run did not reach to pending and set the job
+        status: ``done``, ``failed`` (only failures left) or ``stopped``.
+        Returns the task counts."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("""UPDATE annotation_tasks SET state = 'pending', updated_at = ?
+                            WHERE job_id = ? AND state = 'running'""", (now, job_id))
+            counts = dict.fromkeys(TASK_STATES, 0)
+            counts.update(conn.execute("SELECT state, COUNT(*) FROM annotation_tasks WHERE job_id = ? GROUP BY state",
+                                       (job_id,)))
+            status = "stopped" if counts["pending"] else "failed" if counts["failed"] else "done"
+            conn.execute("UPDATE annotation_jobs SET status = ?, updated_at = ? WHERE id = ?",
+                         (status, now, job_id))
+        return counts
+
+    def get_failed_tasks(self, job_id):
+        """Return ``(image_path, attempts, last_error)`` of the failed tasks of ``job_id``."""
+        query = """SELECT image_path, attempts, last_error FROM annotation_tasks
+                   WHERE job_id = ? AND state = 'failed' ORDER BY rowid"""
+        return self.execute_query(query, (job_id,), fetch=True) or []
+
+    def import_annotations(self, data, chunk_size=5000, progress=None):
+        """Insert ``data`` rows in chunks of ``chunk_size``, one transaction each.
+
+        ``data`` may be any iterable of export rows, so generators are never
+        materialised. ``progress(rows_done)`` is called after every chunk.
+        Returns the number of imported rows.
+        """
+        query = """INSERT INTO annotations (image_path, annotation, is_new, is_approved)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT(image_path) DO UPDATE
+                   SET annotation = excluded.annotation, is_new = excluded.is_new,
+                       is_approved = excluded.is_approved"""
+        rows = (normalize_record(item) for item in data)
+        done = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            with self.transaction() as conn:
+                conn.executemany(query, chunk)
+            done += len(chunk)
+            if progress:
+                progress(done)
+        self.prune_changes()
+        return done
+
+    def import_file(self, path, chunk_size=5000, progress=None):
+        """Stream an export written by :meth:`export_file` into the database.
+
+        ``progress(rows_done, bytes_read, total_bytes)`` is reported after
+        each committed chunk. Returns the number of imported rows.
+        """
+        state = {"bytes_read": 0, "total": 0}
+
+        def rows():
+            for row, bytes_read, total in iter_export_records(path):
+                state["bytes_read"], state["total"] = bytes_read, total
+                yield row
+
+        def on_chunk(done):
+            if progress:
+                progress(done, state["bytes_read"], state["total"])
+
+        return self.import_annotations(rows(), chunk_size, on_chunk)
@@ -0,0 +1,117 @@
+import time
+import logging
+from workflow_template import load_template
+
+# Output files the UIs can display as images
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp")
+
+
+def generate_for_approved(db, client, settings, progress=None, should_stop=None, on_result=None,
+                          on_event=None) -> dict:
+    """Generate an image from every approved annotation.
+
+    All prompts go through :meth:`ComfyUIClient.generate_many`, which keeps
+    the server's queue filled and downloads outputs as they finish.
+    Each annotation is filled into the workflow template together with the
+    model, size, steps and seed of ``settings``. Annotations are streamed
+    from the database, so only the prompts in flight are held in memory.
+
+    Parameters
+    ----------
+    db : DatabaseManager
+        Database holding the annotations.
+    client : ComfyUIClient
+        Client of the generation server.
+    settings : dict
+        Generation settings as in ``COMFY_DEFAULTS``.
+    progress : callable, optional
+        Called as ``progress(done, total)`` after every image.
+    should_stop : callable, optional
+        Polled while waiting; once it returns True the prompts still queued
+        or executing are cancelled on the server.
+    on_result : callable, optional
+        Called with every :class:`GenerationResult`.
+    on_event : callable, optional
+        Called with the :class:`ProgressEvent` of every node and sampler
+        step.
+
+    Returns
+    -------
+    dict
+        ``total``, ``generated`` and ``failed`` annotations, ``stopped``,
+        the output ``paths`` with their count (``files``) and total
+        ``bytes``, the first few ``errors``, ``elapsed`` seconds and the
+        summed ``download_seconds``.
+    """
+    started = time.perf_counter()
+    template = load_template(settings.get("workflow", ""))
+    options = {name: settings.get(name) for name in ("model", "width", "height", "steps", "seed")}
+    total = db.count_annotations("approved")
+    jobs = ((image_path, template.render(annotation, **options))
+            for image_path, annotation, _is_new, _is_approved in db.iter_annotations("approved"))
+
+    paths, errors = [], []
+    failed = done = size = 0
+    download_seconds = 0.0
+    results = client.generate_many(jobs, on_event=on_event, should_stop=should_stop)
+    try:
+        for result in results:
+            done += 1
+            paths += [output.path for output in result.outputs]
+            size += sum(output.size for output in result.outputs)
+            download_seconds += result.download_seconds
+            if result.error is not None:
+                failed += 1
+                logging.error(f"Error generating image for {result.key}: {result.error}")
+                if len(errors) < 10:
+                    errors.append(f"{result.key}: {result.error}")
+            if on_result:
+                on_result(result)
+            if progress:
+                progress(done, total)
+            if should_stop and should_stop():
+                break
+    finally:
+        results.close()
+    stopped = bool(should_stop and should_stop())
+
+    return {
+        "total": total,
+        "generated": done - failed,
+        "failed": failed,
+        "files": len(paths),
+        "bytes": size,
+        "download_seconds": download_seconds,
+        "stopped": stopped,
+        "paths": paths,
+        "errors": errors,
+        "elapsed": time.perf_counter() - started,
+    }
+
+
+def split_image_paths(paths) -> tuple:
+    """Split output ``paths`` into ``(images, others)`` by file extension."""
+    images = [path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS)]
+    others = [path for path in paths if not path.lower().endswith(IMAGE_EXTENSIONS)]
+    return images, others
+
+
+def event_text(event) -> str:
+    """Short description of a :class:`ProgressEvent` for progress labels."""
+    if event.kind == "progress":
+        return f"Step {event.value}/{event.maximum}"
+    if event.kind == "executing":
+        return f"Running node {event.node}"
+    return "Started"
+
+
+def summary_text(summary: dict) -> str:
+    """Description of a :func:`generate_for_approved` result."""
+    text = (f"Generated images for {summary['generated']} of {summary['total']} annotations, "
+            f"{summary['failed']} failed in {summary['elapsed']:.1f}s; "
+            f"{summary['files']} files, {summary['bytes'] / 1024 / 1024:.1f} MB")
+    if summary["stopped"]:
+        text += " (stopped)"
+    if summary["errors"]:
+        text += "\n" + "\n".join(summary["errors"])
+    return text
@@ -1,89 +1,278 @@
 import os
-import json
+import asyncio
+import logging
+import functools
+import tempfile
+import threading
 import gradio as gr
-from database import DatabaseManager
-from annotation import AnnotationManager, available_models
+from async_db import AsyncDatabase
+from database import display_name, status_matches
+from data_transfer import EXPORT_FORMATS
+from caption_sync import sync_caption_files, summary_text
+from annotation import AnnotationManager, available_models, rate_limiter, preprocessor, telemetry
+from annotation_jobs import run_annotation_job, summary_text as job_summary_text
 from comfy_client import ComfyUIClient
-from config import DEFAULT_PROMPT, COMFY_DEFAULTS
-
-# Managers for annotations and image generation
-_db = DatabaseManager()
-_annotator = AnnotationManager()
+from generation_jobs import (generate_for_approved, event_text, split_image_paths,
+                             summary_text as generation_summary_text)
+from config import DEFAULT_PROMPT, COMFY_DEFAULTS, ANNOTATION_CONCURRENCY, ANNOTATION_PACK_SIZE
+
+# Managers for annotations and image generation, created by _init() rather
+# than on import: image pre-processing workers started with "spawn" import
+# the main module again, and must not open the database or start threads.
+# Handlers serve several reviewers at once, so database calls go through the
+# async facade: one writer thread and a pool of readers.
+_db = None
+_annotator = None
 _generation_settings = COMFY_DEFAULTS.copy()
-_comfy = ComfyUIClient(_generation_settings.get("server", ""))
-
-MODELS = available_models() or ["gpt-4-turbo"]
-
-
-def _refresh_list():
-    """Return annotation list in display format."""
-    rows = _db.get_all_annotations() or []
-    items = []
-    for image_path, _ann, is_new, is_approved in rows:
-        status = "[Approved]" if is_approved else "[Not Approved]" if not is_new else "[New]"
-        items.append(f"{os.path.basename(image_path)} {status}")
-    return gr.update(choices=items)
-
-
-def load_image(image_path):
+_comfy = None
+MODELS = ["gpt-4-turbo"]
+
+
+def _init():
+    """Create the managers on first use."""
+    global _db, _annotator, _comfy, MODELS
+    if _db is not None:
+        return
+    _db = AsyncDatabase()
+    _annotator = AnnotationManager()
+    _comfy = ComfyUIClient(_generation_settings.get("server", ""))
+    # Read from the on-disk cache; a stale cache is refreshed in the background
+    MODELS = available_models() or MODELS
+
+
+PAGE_SIZE = 200
+LIST_FILTERS = {"All": "all", "New": "new", "Approved": "approved", "Not Approved": "not_approved"}
+
+
+def _list_choice(row):
+    """Dropdown choice ``(label, image_path)`` for a list row.
+
+    The value is the full path, so files with the same name in different
+    folders stay distinguishable.
+    """
+    _id, image_path, is_new, is_approved, ambiguous = row
+    label = "[Approved]" if is_approved else "[Not Approved]" if not is_new else "[New]"
+    return f"{display_name(image_path, ambiguous)} {label}", image_path
+
+
+async def _list_page(status, start_id):
+    """Return ``(rows, last_id)`` for one page; ``last_id`` is None on the last page."""
+    rows = await _db.list_annotations(start_id, PAGE_SIZE + 1, status)
+    last_id = rows[PAGE_SIZE - 1][0] if len(rows) > PAGE_SIZE else None
+    return rows[:PAGE_SIZE], last_id
+
+
+async def _refresh_list(list_filter="All", search="", cursor=None):
+    """Reload the page of the annotation list currently shown.
+
+    ``cursor`` keeps the start id of every visited page, so paging back is
+    as cheap as paging forward, plus the rows and change-feed revision the
+    page was built from. A non-empty ``search`` shows the best full-text
+    matches instead of a page.
+    """
+    status = LIST_FILTERS[list_filter]
+    revision = await _db.current_revision()
+    if search and search.strip():
+        rows = await _db.search_annotations(search, status, PAGE_SIZE)
+        return (gr.update(choices=[_list_choice(row) for row in rows],
+                          label=f"Annotations ({len(rows)} matches)"),
+                {"pages": [0], "next": None, "revision": revision, "rows": rows, "search": search})
+
+    pages = (cursor or {}).get("pages") or [0]
+    rows, next_id = await _list_page(status, pages[-1])
+    while not rows and len(pages) > 1:
+        # The page became empty (deletes, filter change) - step back
+        pages = pages[:-1]
+        rows, next_id = await _list_page(status, pages[-1])
+    return (gr.update(choices=[_list_choice(row) for row in rows],
+                      label=f"Annotations (page {len(pages)})"),
+            {"pages": pages, "next": next_id, "revision": revision, "rows": rows})
+
+
+async def _sync_list(list_filter="All", search="", cursor=None):
+    """Apply the changes made since the page was loaded, without re-reading it.
+
+    Only the rows touched since ``cursor["revision"]`` are fetched. Falls
+    back to :func:`_refresh_list` when the change feed cannot cover the gap
+    or search results are shown (their ranking may have changed).
+    """
+    if not cursor or "revision" not in cursor or cursor.get("search"):
+        return await _refresh_list(list_filter, search, cursor)
+    revision, changes = await _db.changes_since(cursor["revision"])
+    if changes is None:
+        return await _refresh_list(list_filter, search, cursor)
+    if not changes:
+        return gr.update(), cursor
+
+    status = LIST_FILTERS[list_filter]
+    start, last_id = cursor["pages"][-1], cursor["next"]
+    rows = {row[1]: row for row in cursor["rows"]}
+    for image_path, row in changes.items():
+        rows.pop(image_path, None)
+        if row is None or not status_matches(status, row[2], row[3]):
+            continue
+        if row[0] > start and (last_id is None or row[0] <= last_id):
+            rows[image_path] = row
+    rows = sorted(rows.values())
+    return (gr.update(choices=[_list_choice(row) for row in rows]),
+            {**cursor, "revision": revision, "rows": rows})
+
+
+async def _next_page(list_filter, search, cursor):
+    if cursor and cursor.get("next") is not None:
+        cursor = {"pages": cursor["pages"] + [cursor["next"]]}
+    return await _refresh_list(list_filter, search, cursor)
+
+
+async def _prev_page(list_filter, search, cursor):
+    pages = (cursor or {}).get("pages", [0])[:-1]
+    return await _refresh_list(list_filter, search, {"pages": pages})
+
+
+async def _model_choices(current):
+    """Pick up a model list refreshed since the app started."""
+    models = available_models(refresh=False) or MODELS
+    return gr.update(choices=models, value=current if current in models else models[0])
+
+
+def _list_controls():
+    """Create a paged, searchable annotation list and wire its controls.
+
+    Returns ``(dropdown, refresh_inputs, refresh_outputs)``; chain
+    ``_sync_list`` with these after any event that changes the data.
+    """
+    list_filter = gr.Radio(list(LIST_FILTERS), value="All", label="Show")
+    search_box = gr.Textbox(label="Search annotations", placeholder="night lighting")
+    dropdown = gr.Dropdown(choices=[], label="Annotations")
+    with gr.Row():
+        prev_btn = gr.Button("< Prev")
+        next_btn = gr.Button("Next >")
+    cursor = gr.State()
+    inputs, outputs = [list_filter, search_box, cursor], [dropdown, cursor]
+    prev_btn.click(_prev_page, inputs, outputs, queue=False)
+    next_btn.click(_next_page, inputs, outputs, queue=False)
+    list_filter.change(_refresh_list, [list_filter, search_box], outputs, queue=False)
+    search_box.change(_refresh_list, [list_filter, search_box], outputs, queue=False)
+    return dropdown, inputs, outputs
+
+
+async def load_image(image_path):
     if not image_path:
         return None, "", False, "No image selected"
-    data = _db.get_annotation(image_path)
+    data = await _db.get_annotation(image_path)
     annotation = data[0] if data else ""
     is_app = bool(data[1]) if data else False
     return image_path, annotation, is_app, "Image loaded"
 
 
-def save_annotation(current_image, text):
+async def save_annotation(current_image, text):
     if not current_image or not text.strip():
         return "No image or annotation"
-    _db.insert_or_update_annotation(current_image, text.strip())
+    await _db.insert_or_update_annotation(current_image, text.strip())
     return "Annotation saved"
 
 
-def auto_annotate(current_image, prompt, model):
+async def auto_annotate(current_image, prompt, model, bypass_cache=False):
     if not current_image:
-        return "", "No image"
+        yield "", "No image"
+        return
     prompt = prompt or DEFAULT_PROMPT
-    annotation = _annotator.generate_annotation(current_image, prompt, model)
-    _db.insert_or_update_annotation(current_image, annotation)
-    return annotation, "Annotation generated"
-
-
-def annotate_folder(files, prompt, model, progress=gr.Progress(track_tqdm=False)):
+    deltas = _annotator.generate_annotation(current_image, prompt, model, use_cache=not bypass_cache, stream=True)
+    text = ""
+    # Each delta is fetched on a worker thread so the event loop stays free
+    while (delta := await asyncio.to_thread(next, deltas, None)) is not None:
+        text += delta
+        yield text, "Generating annotation..."
+    annotation = text.strip()
+    await _db.insert_or_update_annotation(current_image, annotation)
+    yield annotation, "Annotation generated"
+
+
+async def annotate_folder(files, prompt, model, concurrency=ANNOTATION_CONCURRENCY, bypass_cache=False,
+                          force=False, pack_size=ANNOTATION_PACK_SIZE, failed_only=False,
+                          progress=gr.Progress(track_tqdm=False)):
     if not files:
         return "No files provided"
     prompt = prompt or DEFAULT_PROMPT
-    for i, file in enumerate(files, start=1):
-        annotation = _annotator.generate_annotation(file.name, prompt, model)
-        _db.insert_or_update_annotation(file.name, annotation)
-        progress(i / len(files))
-    return "Folder annotated"
-
-
-def approve_annotation(current_image):
+    generate = functools.partial(_annotator.generate_annotation, use_cache=not bypass_cache)
+    generate_many = functools.partial(_annotator.generate_annotations, use_cache=not bypass_cache)
+    stop = threading.Event()
+
+    def report(done, total):
+        # Nobody is listening once the request is cancelled; a failing
+        # progress call must not end the run while requests are in flight
+        if not stop.is_set():
+            progress(done / total, desc=f"Annotated {done}/{total}")
+
+    job = asyncio.create_task(asyncio.to_thread(
+        run_annotation_job,
+        _db.blocking(),
+        [file.name for file in files],
+        prompt,
+        model,
+        generate,
+        concurrency=concurrency,
+        force=force,
+        failed_only=failed_only,
+        limiter=rate_limiter,
+        preprocessor=preprocessor,
+        generate_many=generate_many,
+        pack_size=pack_size,
+        telemetry=telemetry,
+        progress=report,
+        should_stop=stop.is_set,
+    ))
+    try:
+        summary = await asyncio.shield(job)
+    except asyncio.CancelledError:
+        # Only stop submitting: the job keeps running until the requests in
+        # flight are answered, and run_annotation_job closes its write buffer
+        # after the engine returns, so nothing already paid for is dropped.
+        # Unfinished images stay pending for the next run.
+        stop.set()
+        job.add_done_callback(_log_abandoned_job)
+        raise
+    return job_summary_text(summary)
+
+
+def _log_abandoned_job(job):
+    if job.cancelled():
+        return
+    if job.exception() is not None:
+        logging.error(f"Cancelled folder annotation failed: {job.exception()}")
+    else:
+        logging.info(f"Cancelled folder annotation stopped: {job_summary_text(job.result())}")
+
+
+async def retry_failed(files, prompt, model, concurrency=ANNOTATION_CONCURRENCY, bypass_cache=False,
+                       pack_size=ANNOTATION_PACK_SIZE, progress=gr.Progress(track_tqdm=False)):
+    return await annotate_folder(files, prompt, model, concurrency, bypass_cache, pack_size=pack_size,
+                                 failed_only=True, progress=progress)
+
+
+async def approve_annotation(current_image):
     if not current_image:
         return "No image"
-    _db.update_annotation_status(current_image, True)
+    await _db.update_annotation_status(current_image, True)
     return "Approved"
 
 
-def not_approve_annotation(current_image):
+async def not_approve_annotation(current_image):
     if not current_image:
         return "No image"
-    _db.update_annotation_status(current_image, False)
+    await _db.update_annotation_status(current_image, False)
     return "Not approved"
 
 
-def approve_all():
-    _db.approve_all_annotations()
+async def approve_all():
+    await _db.approve_all_annotations()
     return "All annotations approved"
 
 
-def save_changes(current_image, text):
+async def save_changes(current_image, text):
     if not current_image:
         return "No image"
-    _db.update_annotation(current_image, text.strip())
+    await _db.update_annotation(current_image, text.strip())
     return "Saved"
 
 
@@ -91,56 +280,69 @@ def clear_preview():
     return None, "", False
 
 
-def clear_database():
-    _db.clear_database()
+async def clear_database():
+    await _db.clear_database()
     return "Database cleared"
 
 
-def delete_annotation(current_image):
+async def delete_annotation(current_image):
     if not current_image:
         return "No image"
-    _db.delete_annotation(current_image)
+    await _db.delete_annotation(current_image)
     return "Annotation deleted"
 
 
-def generate_text_files():
-    rows = _db.get_approved_annotations() or []
-    for image_path, ann in rows:
-        txt_path = os.path.splitext(image_path)[0] + ".txt"
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(ann)
-    return f"Created {len(rows)} text files"
+async def generate_text_files(delete_orphans=False, progress=gr.Progress(track_tqdm=False)):
+    # Scanning and file writes stay on a reader; the bookkeeping writes go to the writer thread
+    summary = await _db.run(
+        sync_caption_files,
+        _db.blocking(),
+        delete_orphans=delete_orphans,
+        progress=lambda done, total: progress(done / total, desc=f"Writing text files {done}/{total}"),
+    )
+    return summary_text(summary)
+
+
+async def export_database(fmt, list_filter, path_prefix, progress=gr.Progress(track_tqdm=False)):
+    """Stream the matching rows to a downloadable file in the chosen format."""
+    out_dir = tempfile.mkdtemp(prefix="annotations_export_")
+    path = os.path.join(out_dir, f"annotations.{fmt}")
 
+    def report(done, total):
+        progress(done / total if total else 1, desc=f"Exported {done} of {total} rows")
 
-def export_database():
-    rows = _db.get_all_annotations() or []
-    return json.dumps([list(r) for r in rows], ensure_ascii=False, indent=2)
+    try:
+        count = await _db.export_file(path, fmt, LIST_FILTERS[list_filter], (path_prefix or "").strip(), report)
+    except Exception as e:
+        return None, f"Failed to export: {e}"
+    return path, f"Exported {count} rows"
 
 
-def import_database(file_obj):
+async def import_database(file_obj, progress=gr.Progress(track_tqdm=False)):
     if not file_obj:
         return "No file"
+
+    def report(rows, bytes_read, total):
+        progress(bytes_read / total if total else 1, desc=f"Imported {rows} rows")
+
     try:
-        with open(file_obj.name, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        _db.import_annotations(data)
+        count = await _db.import_file(file_obj.name, progress=report)
     except Exception:
         return "Failed to import"
-    return "Database imported"
+    return f"Database imported ({count} rows)"
 
 
-def select_from_list(name_with_status):
-    if not name_with_status:
+async def select_from_list(image_path):
+    if not image_path:
         return None, "", False, ""
-    name = name_with_status.split(" [")[0]
-    result = _db.get_annotation_by_filename(name)
+    result = await _db.get_annotation_by_filename(image_path)
     if not result:
         return None, "", False, "Not found"
     annotation, is_app, path = result
     return path, annotation, bool(is_app), "Loaded"
 
 
-def generate_image(server, model, steps, width, height, annotation_text, workflow_file):
+def _update_generation_settings(server, model, steps, width, height, seed, workflow_file):
     workflow = ""
     if workflow_file is not None:
         try:
@@ -154,13 +356,69 @@ def generate_image(server, model, steps, width, height, annotation_text, workflo
         "steps": steps,
         "width": width,
         "height": height,
+        "seed": seed,
         "workflow": workflow,
     })
     _comfy.set_server(server)
-    return _comfy.generate_image(annotation_text, model, width, height, steps, workflow)
+    return workflow
+
+
+async def _run_generation(fn, *args, **kwargs):
+    """Run a blocking generation call on a worker thread.
+
+    If the request is cancelled the call is told to stop, which cancels its
+    prompts on the ComfyUI server instead of leaving the worker waiting.
+    """
+    stop = threading.Event()
+    job = asyncio.create_task(asyncio.to_thread(fn, *args, should_stop=stop.is_set, **kwargs))
+    try:
+        return await asyncio.shield(job)
+    finally:
+        stop.set()
+
+
+def _gallery_outputs(paths):
+    """Split output ``paths`` into gallery images and a note listing the
+    files gr.Gallery cannot show (video, latents, text)."""
+    images, others = split_image_paths(paths)
+    note = f"Other output files ({len(others)}):\n" + "\n".join(others) if others else ""
+    return images, note
+
+
+async def generate_image(server, model, steps, width, height, seed, annotation_text, workflow_file,
+                         progress=gr.Progress(track_tqdm=False)):
+    workflow = _update_generation_settings(server, model, steps, width, height, seed, workflow_file)
+
+    def report(event):
+        progress(event.value / event.maximum if event.maximum else None, desc=event_text(event))
+
+    result = await _run_generation(_comfy.generate_image, annotation_text, model, width, height, steps,
+                                   workflow, seed, on_event=report)
+    images, note = _gallery_outputs([output.path for output in result.outputs])
+    return images, "\n".join(filter(None, [f"Generated {len(images)} images", note]))
+
+
+async def generate_approved(server, model, steps, width, height, seed, workflow_file,
+                            progress=gr.Progress(track_tqdm=False)):
+    _update_generation_settings(server, model, steps, width, height, seed, workflow_file)
+    counts = [0, 0]
+
+    def report(done, total):
+        counts[:] = done, total
+        progress(done / total, desc=f"Generated {done}/{total}")
+
+    def report_event(event):
+        done, total = counts
+        progress(done / total if total else None, desc=f"Generated {done}/{total} - {event_text(event)}")
+
+    summary = await _run_generation(generate_for_approved, _db.db, _comfy, dict(_generation_settings),
+                                    progress=report, on_event=report_event)
+    images, note = _gallery_outputs(summary["paths"])
+    return images, "\n".join(filter(None, [generation_summary_text(summary), note]))
 
 
 def build_interface():
+    _init()
     with gr.Blocks() as demo:
         current_image = gr.State()
         # placeholder state for generation tab selections
@@ -178,14 +436,25 @@ def build_interface():
                     gr.Markdown("**LLM Annotation**")
                     prompt_box = gr.Textbox(value=DEFAULT_PROMPT, label="Prompt")
                     annotate_btn = gr.Button("Annotate Image")
+                    concurrency_in = gr.Slider(1, 32, value=ANNOTATION_CONCURRENCY, step=1, label="Parallel requests")
+                    pack_size_in = gr.Slider(1, 10, value=ANNOTATION_PACK_SIZE, step=1, label="Images per request")
+                    bypass_cache_box = gr.Checkbox(value=False, label="Bypass annotation cache")
+                    force_box = gr.Checkbox(value=False, label="Re-annotate images that already have text")
                     folder_input = gr.File(file_count="multiple", label="Annotate Folder")
+                    retry_failed_btn = gr.Button("Retry Failed")
                 with gr.Column():
                     gr.Markdown("**Image Data Base**")
                     clear_db_btn = gr.Button("Clear Database")
                     delete_btn = gr.Button("Delete Annotation")
                     gen_txt_btn = gr.Button("Generate Text Files")
-                    export_btn = gr.Button("Export Database")
-                    import_file = gr.File(file_types=[".json"], label="Import Database")
+                    delete_orphans_box = gr.Checkbox(value=False, label="Remove text files of unapproved annotations")
+                    with gr.Accordion("Export Database", open=False):
+                        export_format = gr.Dropdown(list(EXPORT_FORMATS), value=EXPORT_FORMATS[0], label="Format")
+                        export_filter = gr.Dropdown(list(LIST_FILTERS), value="All", label="Status")
+                        export_prefix = gr.Textbox(label="Path prefix")
+                        export_btn = gr.Button("Export Database")
+                        export_file = gr.File(label="Exported file", interactive=False)
+                    import_file = gr.File(file_types=[".json", ".jsonl", ".gz", ".csv"], label="Import Database")
 
             with gr.Row():
                 with gr.Column(scale=2):
@@ -198,34 +467,34 @@ def build_interface():
                         not_approve_btn = gr.Button("Not Approved")
                         save_changes_btn = gr.Button("Save")
                 with gr.Column():
-                    annotation_list = gr.Dropdown(choices=[], label="Annotations")
+                    annotation_list, list_inputs, list_outputs = _list_controls()
 
             # Events
             image_input.upload(load_image, image_input, [preview, annotation_box, approve_btn, status],
                                show_progress=False).then(lambda p: p, None, current_image)
-            save_btn.click(save_annotation, [current_image, annotation_box], status)
-            annotate_btn.click(auto_annotate, [current_image, prompt_box, model_select], [annotation_box, status])
-            folder_input.change(annotate_folder, [folder_input, prompt_box, model_select], status).then(_refresh_list, None, annotation_list, queue=False)
-            approve_btn.click(approve_annotation, current_image, status)
-            approve_all_btn.click(lambda: approve_all(), None, status)
-            not_approve_btn.click(not_approve_annotation, current_image, status)
-            save_changes_btn.click(save_changes, [current_image, annotation_box], status)
+            save_btn.click(save_annotation, [current_image, annotation_box], status).then(_sync_list, list_inputs, list_outputs, queue=False)
+            annotate_btn.click(auto_annotate, [current_image, prompt_box, model_select, bypass_cache_box],
+                               [annotation_box, status]).then(_sync_list, list_inputs, list_outputs, queue=False)
+            folder_input.change(annotate_folder, [folder_input, prompt_box, model_select, concurrency_in,
+                                                  bypass_cache_box, force_box, pack_size_in], status).then(_sync_list, list_inputs, list_outputs, queue=False)
+            retry_failed_btn.click(retry_failed, [folder_input, prompt_box, model_select, concurrency_in,
+                                                  bypass_cache_box, pack_size_in], status).then(_sync_list, list_inputs, list_outputs, queue=False)
+            approve_btn.click(approve_annotation, current_image, status).then(_sync_list, list_inputs, list_outputs, queue=False)
+            approve_all_btn.click(approve_all, None, status).then(_sync_list, list_inputs, list_outputs, queue=False)
+            not_approve_btn.click(not_approve_annotation, current_image, status).then(_sync_list, list_inputs, list_outputs, queue=False)
+            save_changes_btn.click(save_changes, [current_image, annotation_box], status).then(_sync_list, list_inputs, list_outputs, queue=False)
             clear_preview_btn.click(clear_preview, None, [preview, annotation_box, approve_btn])
-            clear_db_btn.click(clear_database, None, status)
-            delete_btn.click(delete_annotation, current_image, status)
-            gen_txt_btn.click(generate_text_files, None, status)
-            export_btn.click(export_database, None, status)
-            import_file.change(import_database, import_file, status).then(_refresh_list, None, annotation_list, queue=False)
+            clear_db_btn.click(clear_database, None, status).then(_sync_list, list_inputs, list_outputs, queue=False)
+            delete_btn.click(delete_annotation, current_image, status).then(_sync_list, list_inputs, list_outputs, queue=False)
+            gen_txt_btn.click(generate_text_files, delete_orphans_box, status).then(_sync_list, list_inputs, list_outputs, queue=False)
+            export_btn.click(export_database, [export_format, export_filter, export_prefix], [export_file, status])
+            import_file.change(import_database, import_file, status).then(_sync_list, list_inputs, list_outputs, queue=False)
             annotation_list.change(select_from_list, annotation_list, [preview, annotation_box, approve_btn, status]).then(lambda p: p, None, current_image)
-            demo.load(_refresh_list, None, annotation_list)
-
-            # Refresh list after button actions
-            for btn in [save_btn, annotate_btn, clear_db_btn, delete_btn, gen_txt_btn,
-                        export_btn, approve_btn, approve_all_btn, not_approve_btn,
-                        save_changes_btn]:
-                btn.click(_refresh_list, None, annotation_list, queue=False)
+            demo.load(_refresh_list, list_inputs, list_outputs)
+            demo.load(_model_choices, model_select, model_select)
 
-            # File components trigger refresh after handling events above
+            # Every write handler refreshes the list with .then(), i.e. only
+            # after its write has committed
 
         with gr.Tab("Генерация изображений"):
             server_in = gr.Textbox(value=_generation_settings["server"], label="Сервер генерации ComfyUI")
@@ -233,20 +502,25 @@ def build_interface():
             steps_in = gr.Number(value=_generation_settings.get("steps", 20), label="Шаги (Steps)")
             width_in = gr.Number(value=_generation_settings.get("width", 512), label="Ширина")
             height_in = gr.Number(value=_generation_settings.get("height", 512), label="Высота")
+            seed_in = gr.Number(value=_generation_settings.get("seed", -1), precision=0, label="Seed (-1 = случайный)")
             annotation_disp = gr.Textbox(lines=8, interactive=True, label="Аннотация")
             workflow_in = gr.File(file_types=[".json"], label="Workflow JSON")
             gen_btn = gr.Button("Generate")
-            output_img = gr.Image(label="Result")
+            output_img = gr.Gallery(label="Result")
+            gen_approved_btn = gr.Button("Generate for all approved")
+            gen_gallery = gr.Gallery(label="Generated from approved annotations")
             with gr.Column():
-                gen_list = gr.Dropdown(choices=[], label="Annotations")
+                gen_list, gen_list_inputs, gen_list_outputs = _list_controls()
 
             gen_list.change(
                 select_from_list,
                 gen_list,
                 [current_image, annotation_disp, gen_state, status],
             )
-            gen_btn.click(generate_image, [server_in, model_in, steps_in, width_in, height_in, annotation_disp, workflow_in], output_img)
-            demo.load(_refresh_list, None, gen_list)
+            gen_btn.click(generate_image, [server_in, model_in, steps_in, width_in, height_in, seed_in, annotation_disp, workflow_in], [output_img, status])
+            gen_approved_btn.click(generate_approved, [server_in, model_in, steps_in, width_in, height_in, seed_in, workflow_in],
+                                   [gen_gallery, status])
+            demo.load(_refresh_list, gen_list_inputs, gen_list_outputs)
 
     return demo
 
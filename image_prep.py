@@ -0,0 +1,139 @@
+import io
+import os
+import logging
+import mimetypes
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from config import IMAGE_PREPROCESS
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - Pillow ships with gradio
+    Image = None
+
+PreparedImage = namedtuple("PreparedImage", "data mime_type detail original_size width height")
+
+# Pillow format name -> MIME type of the re-encoded image
+ENCODE_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+def mime_type(path: str) -> str:
+    """MIME type of ``path`` guessed from its extension (``image/jpeg`` if unknown)."""
+    return mimetypes.guess_type(path)[0] or "image/jpeg"
+
+
+def choose_detail(width, height, detail="auto", low_detail_side=512):
+    """``low`` for images small enough to be billed as one tile, else ``detail``."""
+    if width and height and max(width, height) <= low_detail_side:
+        return "low"
+    return detail
+
+
+def prepare_image(image_bytes: bytes, name: str = "", max_side=IMAGE_PREPROCESS["max_side"],
+                  fmt=IMAGE_PREPROCESS["format"], quality=IMAGE_PREPROCESS["quality"],
+                  detail=IMAGE_PREPROCESS["detail"]) -> PreparedImage:
+    """Downscale ``image_bytes`` to ``max_side`` pixels on the long side and
+    re-encode them as ``fmt``.
+
+    The original bytes are kept whenever re-encoding would not make them
+    smaller, or when Pillow is not installed. ``name`` is only used to guess
+    the MIME type of the original. Runs in worker processes, so it takes and
+    returns plain picklable values.
+    """
+    original = PreparedImage(image_bytes, mime_type(name), detail, len(image_bytes), None, None)
+    if Image is None:
+        return original
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image.load()
+            width, height = image.size
+            resized = max_side and max(width, height) > max_side
+            if resized:
+                image.thumbnail((max_side, max_side), Image.LANCZOS)
+                width, height = image.size
+            if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+                # JPEG has no alpha: flatten onto white like most viewers do
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                rgba = image.convert("RGBA")
+                background.paste(rgba, mask=rgba.getchannel("A"))
+                image = background
+            out = io.BytesIO()
+            image.save(out, fmt, quality=quality, optimize=True)
+    except Exception as e:
+        logging.warning(f"Could not pre-process {name or 'image'}, sending it unchanged: {e}")
+        return original
+
+    data = out.getvalue()
+    detail = choose_detail(width, height, detail)
+    if len(data) >= len(image_bytes) and not resized:
+        return original._replace(detail=detail, width=width, height=height)
+    return PreparedImage(data, ENCODE_MIME_TYPES.get(fmt, "image/jpeg"), detail, len(image_bytes), width, height)
+
+
+class ImagePreprocessor:
+    """Runs :func:`prepare_image` in a pool of worker processes.
+
+    Decoding and re-encoding are CPU bound, so doing them in processes lets
+    them overlap with the network I/O of the annotation threads instead of
+    competing for the GIL. The pool starts on first use. Bytes before and
+    after pre-processing are counted for reporting.
+    """
+
+    def __init__(self, workers=IMAGE_PREPROCESS["workers"], enabled=IMAGE_PREPROCESS["enabled"], **options):
+        self.workers = workers or os.cpu_count() or 1
+        self.enabled = enabled and Image is not None
+        self.options = options
+        self._pool = None
+        self._lock = threading.Lock()
+        self._counters = {"images": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # Spawned workers start clean instead of forking a process
+                # that already runs database, UI and network threads; they
+                # only need this module to run prepare_image
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    @property
+    def settings(self) -> str:
+        """The settings that shape the uploaded image, as a string for
+        cache keys: a changed size, format, quality or detail gives a
+        different answer for the same original bytes."""
+        if not self.enabled:
+            return f"original detail={IMAGE_PREPROCESS['detail']}"
+        # Options use the argument names of prepare_image
+        options = {name: self.options.get(argument, IMAGE_PREPROCESS[name])
+                   for name, argument in (("max_side", "max_side"), ("format", "fmt"),
+                                          ("quality", "quality"), ("detail", "detail"))}
+        return " ".join(f"{name}={value}" for name, value in options.items())
+
+    def prepare(self, image_bytes: bytes, name: str = "") -> PreparedImage:
+        """Return the :class:`PreparedImage` to upload for ``image_bytes``."""
+        if self.enabled:
+            prepared = self._get_pool().submit(prepare_image, image_bytes, name, **self.options).result()
+        else:
+            prepared = PreparedImage(image_bytes, mime_type(name), IMAGE_PREPROCESS["detail"],
+                                     len(image_bytes), None, None)
+        with self._lock:
+            self._counters["images"] += 1
+            self._counters["bytes_in"] += prepared.original_size
+            self._counters["bytes_out"] += len(prepared.data)
+        if prepared.original_size != len(prepared.data):
+            logging.info(f"Pre-processed {name}: {prepared.original_size} -> {len(prepared.data)} bytes")
+        return prepared
+
+    def stats(self) -> dict:
+        """Return ``images``, ``bytes_in`` and ``bytes_out`` counted so far."""
+        with self._lock:
+            return dict(self._counters)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
@@ -26,13 +26,13 @@ def decrypt_string(enc_text: str, secret: str = SECRET) -> str:
     return _xor_bytes(data, key).decode()
 
 
-def get_openai_api_key() -> str:
+def get_openai_api_key(interactive: bool = True) -> str:
     """Retrieve the OpenAI API key.
 
     The key is loaded from the ``OPENAI_API_KEY`` environment variable if
     available. Otherwise it is read from ``openai.key`` and decrypted. If the
     file does not exist the user is prompted to enter a key which will then be
-    stored encrypted.
+    stored encrypted; with ``interactive=False`` None is returned instead.
     """
 
     env_key = os.getenv("OPENAI_API_KEY")
@@ -47,6 +47,8 @@ def get_openai_api_key() -> str:
         except Exception:
             pass
 
+    if not interactive:
+        return None
     key = input("Enter OpenAI API key: ").strip()
     with open(API_KEY_FILE, "w", encoding="utf-8") as f:
         f.write(encrypt_string(key))
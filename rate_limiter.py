@@ -0,0 +1,210 @@
+import re
+import time
+import random
+import logging
+import threading
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_SECONDS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def parse_duration(value) -> float:
+    """Parse OpenAI reset durations such as ``"1s"``, ``"6m0s"`` or ``"20ms"``."""
+    if value is None:
+        return 0.0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    return sum(float(amount) * _DURATION_SECONDS[unit] for amount, unit in _DURATION_PART.findall(str(value)))
+
+
+class TokenBucket:
+    """Bucket refilled continuously at ``per_minute`` units per minute.
+
+    Reservations may drive the level negative; the caller then waits until
+    the debt is repaid, which keeps concurrent callers in FIFO-ish order.
+    ``per_minute=None`` means no limit until :meth:`set_limit` gives one.
+    """
+
+    def __init__(self, per_minute=None):
+        self.capacity = self.rate = None
+        self.level = 0.0
+        self.updated = time.monotonic()
+        if per_minute is not None:
+            self.set_limit(per_minute, self.updated)
+
+    def set_limit(self, per_minute: float, now: float):
+        """Resize the bucket to ``per_minute``, e.g. from the limit the server reported."""
+        if per_minute is None or per_minute <= 0:
+            return
+        if self.rate is None:
+            self.level = float(per_minute)
+        else:
+            self._refill(now)
+            self.level = min(self.level, float(per_minute))
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.updated = now
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take ``amount`` units and return the seconds to wait before using them."""
+        if self.rate is None:
+            return 0.0
+        self._refill(now)
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def sync(self, remaining, reset_seconds, now):
+        """Align the bucket with the ``remaining``/``reset`` the server reported."""
+        if self.rate is None:
+            return
+        self._refill(now)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+            if remaining <= 0 and reset_seconds:
+                # Nothing left until the server window resets
+                self.level = min(self.level, -reset_seconds * self.rate)
+
+
+class RateLimiter:
+    """Client-side rate limiting and retries for API calls.
+
+    Requests and tokens are metered by two token buckets sized from the
+    configured RPM/TPM limits (None: unlimited until the server reports
+    one), resized to the account's ``x-ratelimit-limit-*`` headers and
+    corrected by the ``x-ratelimit-remaining-*`` headers of every response. Rate-limit (429), server (5xx) and connection errors
+    are retried with exponential backoff and full jitter, honouring
+    ``retry-after``. A shared retry budget - refilled by successful calls -
+    stops a failing API from being hammered by every worker at once.
+    One instance is meant to be shared by all threads calling the API.
+    """
+
+    def __init__(self, rpm=None, tpm=None, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 retry_budget=20, retry_ratio=0.2):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = float(retry_budget)
+        self.retry_budget_cap = float(retry_budget)
+        self.retry_ratio = retry_ratio
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "succeeded": 0, "failed": 0, "throttled": 0,
+                          "retried": 0, "rate_limited": 0, "wait_seconds": 0.0}
+
+    def stats(self) -> dict:
+        """Return a snapshot of the call, throttle and retry counters."""
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def acquire(self, cost_tokens=0) -> float:
+        """Block until one request and ``cost_tokens`` tokens may be spent.
+        Returns the seconds waited."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self.requests.reserve(1, now), self.tokens.reserve(cost_tokens, now))
+        if wait > 0:
+            self._count("throttled")
+            self._count("wait_seconds", wait)
+            time.sleep(wait)
+        return max(wait, 0.0)
+
+    def update_from_headers(self, headers):
+        """Apply ``x-ratelimit-*`` response headers to the buckets."""
+        if not headers:
+            return
+
+        def number(name):
+            value = headers.get(name)
+            try:
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        with self._lock:
+            now = time.monotonic()
+            self.requests.set_limit(number("x-ratelimit-limit-requests"), now)
+            self.tokens.set_limit(number("x-ratelimit-limit-tokens"), now)
+            self.requests.sync(number("x-ratelimit-remaining-requests"),
+                               parse_duration(headers.get("x-ratelimit-reset-requests")), now)
+            self.tokens.sync(number("x-ratelimit-remaining-tokens"),
+                             parse_duration(headers.get("x-ratelimit-reset-tokens")), now)
+
+    def _backoff(self, attempt, error) -> float:
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            try:
+                return float(headers["retry-after"])
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @staticmethod
+    def is_retryable(error) -> bool:
+        status = getattr(error, "status_code", None)
+        if status is not None:
+            return status == 429 or status >= 500
+        return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+    def call(self, fn, cost_tokens=0, headers_of=None, stats=None):
+        """Call ``fn()`` under the limits, retrying transient failures.
+
+        ``headers_of(result)`` extracts response headers used to resync the
+        buckets. The last error is re-raised once retries, or the shared
+        retry budget, are exhausted. A ``stats`` dict is filled with the
+        ``queue_wait`` and ``backoff`` seconds, ``retries`` and the
+        ``latency`` of the last attempt of this call.
+        """
+        self._count("calls")
+        if stats is None:
+            stats = {}
+        stats.update(queue_wait=0.0, backoff=0.0, retries=0, latency=0.0)
+        attempt = 0
+        while True:
+            stats["queue_wait"] += self.acquire(cost_tokens)
+            started = time.perf_counter()
+            try:
+                result = fn()
+            except Exception as e:
+                stats["latency"] = time.perf_counter() - started
+                response = getattr(e, "response", None)
+                self.update_from_headers(getattr(response, "headers", None))
+                if getattr(e, "status_code", None) == 429:
+                    self._count("rate_limited")
+                with self._lock:
+                    can_retry = (self.is_retryable(e) and attempt < self.max_retries
+                                 and self.retry_budget >= 1)
+                    if can_retry:
+                        self.retry_budget -= 1
+                if not can_retry:
+                    self._count("failed")
+                    raise
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                stats["retries"] = attempt
+                stats["backoff"] += delay
+                self._count("retried")
+                self._count("wait_seconds", delay)
+                logging.warning(f"API call failed ({e}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            stats["latency"] = time.perf_counter() - started
+            if headers_of:
+                self.update_from_headers(headers_of(result))
+            with self._lock:
+                self.retry_budget = min(self.retry_budget_cap, self.retry_budget + self.retry_ratio)
+                self._counters["succeeded"] += 1
+            return result
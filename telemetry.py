@@ -0,0 +1,150 @@
+import json
+import math
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import deque
+from config import TELEMETRY
+
+# Fields of one telemetry record, as written to the JSONL log
+RECORD_FIELDS = ("ts", "kind", "model", "images", "image_bytes", "prompt_tokens", "completion_tokens",
+                 "queue_wait", "backoff", "latency", "retries", "outcome", "error", "run_id")
+
+# Run the calls made in this context belong to, set by Telemetry.tag_run
+_run_id = contextvars.ContextVar("telemetry_run_id", default=None)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values`` (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+class Telemetry:
+    """Per-request metrics for API calls.
+
+    Every call is appended to a JSONL log (one object per line, keyed by
+    :data:`RECORD_FIELDS`) for offline analysis, and the latest ``keep``
+    records stay in memory so :meth:`report` can summarise a run without
+    reading the file back. Calls made inside :meth:`tag_run` carry its run
+    id, which keeps concurrent runs apart.
+    """
+
+    def __init__(self, path=TELEMETRY["path"], enabled=TELEMETRY["enabled"], keep=TELEMETRY["keep"]):
+        self.path = path
+        self.enabled = enabled
+        self._records = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self._file = None
+
+    def record(self, kind, model, images=1, image_bytes=0, prompt_tokens=0, completion_tokens=0,
+               queue_wait=0.0, backoff=0.0, latency=0.0, retries=0, outcome="ok", error=None):
+        """Store the metrics of one API call.
+
+        ``queue_wait`` is time spent waiting on the rate limiter, ``backoff``
+        time slept between retries and ``latency`` the duration of the
+        network request itself.
+        """
+        if not self.enabled:
+            return
+        entry = dict(zip(RECORD_FIELDS, (time.time(), kind, model, images, image_bytes, prompt_tokens,
+                                         completion_tokens, queue_wait, backoff, latency, retries, outcome,
+                                         error, _run_id.get())))
+        with self._lock:
+            self._records.append(entry)
+            if not self.path:
+                return
+            try:
+                if self._file is None:
+                    self._file = open(self.path, "a", encoding="utf-8")
+                self._file.write(json.dumps(entry) + "\n")
+                self._file.flush()
+            except OSError as e:
+                logging.warning(f"Could not write telemetry: {e}")
+
+    @contextmanager
+    def tag_run(self, run_id=None):
+        """Tag the calls made in this context with ``run_id`` (a new one by
+        default) and yield it.
+
+        The id lives in a context variable, so it follows the code into
+        threads started with a copy of the context (as
+        :class:`AnnotationEngine` and ``asyncio.to_thread`` do) but not into
+        other runs.
+        """
+        run_id = run_id or uuid.uuid4().hex
+        token = _run_id.set(run_id)
+        try:
+            yield run_id
+        finally:
+            _run_id.reset(token)
+
+    def records(self, since=None, run_id=None):
+        """Return the in-memory records, optionally only those after ``since``
+        or of ``run_id``."""
+        with self._lock:
+            return [entry for entry in self._records
+                    if (since is None or entry["ts"] >= since) and (run_id is None or entry["run_id"] == run_id)]
+
+    def report(self, since=None, run_id=None) -> dict:
+        """Aggregate the records after ``since`` (a ``time.time()`` value) or
+        of the :meth:`tag_run` ``run_id``.
+
+        Returns
+        -------
+        dict
+            ``calls``, ``errors``, ``images``, ``retries``, p50/p95 of
+            ``latency`` and ``queue_wait`` in seconds, ``tokens_per_image``,
+            total ``prompt_tokens``/``completion_tokens`` and ``throughput``
+            in images per second over the covered period.
+        """
+        entries = self.records(since, run_id)
+        ok = [entry for entry in entries if entry["outcome"] == "ok"]
+        latencies = [entry["latency"] for entry in ok]
+        waits = [entry["queue_wait"] for entry in entries]
+        images = sum(entry["images"] for entry in ok)
+        prompt_tokens = sum(entry["prompt_tokens"] for entry in ok)
+        completion_tokens = sum(entry["completion_tokens"] for entry in ok)
+        period = 0.0
+        if entries:
+            # A record is written when its call ends; start from the first call's start
+            first = min(entries, key=lambda entry: entry["ts"])
+            started = first["ts"] - first["latency"] - first["queue_wait"] - first["backoff"]
+            period = max(entry["ts"] for entry in entries) - started
+        return {
+            "calls": len(entries),
+            "errors": len(entries) - len(ok),
+            "images": images,
+            "retries": sum(entry["retries"] for entry in entries),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "queue_wait_p50": percentile(waits, 0.5),
+            "queue_wait_p95": percentile(waits, 0.95),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "tokens_per_image": (prompt_tokens + completion_tokens) / images if images else 0.0,
+            "throughput": images / period if period > 0 else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def report_text(report: dict) -> str:
+    """Short multi-line description of a :meth:`Telemetry.report`."""
+    if not report["calls"]:
+        return "No API calls"
+    return (f"{report['calls']} API calls ({report['errors']} failed, {report['retries']} retries) "
+            f"for {report['images']} images, {report['throughput']:.2f} images/s\n"
+            f"Latency p50 {report['latency_p50']:.2f}s, p95 {report['latency_p95']:.2f}s; "
+            f"queue wait p50 {report['queue_wait_p50']:.2f}s, p95 {report['queue_wait_p95']:.2f}s\n"
+            f"Tokens: {report['prompt_tokens']} prompt, {report['completion_tokens']} completion, "
+            f"{report['tokens_per_image']:.0f} per image")
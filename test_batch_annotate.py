@@ -0,0 +1,89 @@
+"""End-to-end test of ``batch_annotate.py`` against ``batch_stub_server.py``.
+
+Run with ``python -m unittest test_batch_annotate`` (or pytest). Needs the
+``openai`` package but no API key or network access.
+"""
+import os
+import zlib
+import struct
+import tempfile
+import unittest
+from openai import OpenAI
+from database import DatabaseManager
+from annotation_cache import AnnotationCache
+from batch_annotate import BatchAnnotator, folder_images
+from batch_stub_server import BatchStubServer
+
+
+def png_bytes(shade):
+    """Return a valid 2x2 grey PNG of the given ``shade``."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    rows = b"".join(b"\x00" + bytes([shade, shade]) for _ in range(2))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 2, 2, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+class BatchAnnotateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self.tmp.name, "images")
+        os.mkdir(self.folder)
+        for index in range(3):
+            with open(os.path.join(self.folder, f"image_{index}.png"), "wb") as f:
+                f.write(png_bytes(index * 80))
+        # The third request of every batch fails on the server
+        self.server = BatchStubServer(failing={"img-2"}).start()
+        self.client = OpenAI(api_key="stub", base_url=self.server.base_url, max_retries=0)
+        self.db = DatabaseManager(os.path.join(self.tmp.name, "annotations.db"))
+        self.cache = AnnotationCache(os.path.join(self.tmp.name, "cache.db"))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.db.close()
+        self.cache.close()
+        self.tmp.cleanup()
+
+    def annotator(self):
+        return BatchAnnotator(self.db, "Describe the image", "gpt-4o", client=self.client, cache=self.cache)
+
+    def test_submit_poll_and_import(self):
+        paths = folder_images(self.folder)
+        summary = self.annotator().submit(paths)
+        self.assertEqual(len(summary["batches"]), 1)
+        self.assertEqual((summary["requests"], summary["cached"], summary["skipped"]), (3, 0, 0))
+        self.assertEqual(summary["errors"], [])
+        batch_id = summary["batches"][0]
+        self.assertEqual(set(self.db.get_batch_items(batch_id)), {"img-0", "img-1", "img-2"})
+
+        # Submitting again while the batch is open does not queue the images twice
+        again = self.annotator().submit(paths)
+        self.assertEqual((again["batches"], again["skipped"]), ([], 3))
+
+        # A fresh annotator, as after a restart, finds the batch in the database
+        self.assertEqual(self.annotator().poll(), [(batch_id, "in_progress", None, None)])
+        self.assertEqual(self.annotator().poll(), [(batch_id, "completed", 2, 1)])
+        self.assertEqual(self.db.get_open_batches(), [])
+
+        self.assertEqual(self.db.get_annotation(paths[0]), ("Stub annotation for img-0", 0))
+        self.assertEqual(self.db.get_annotation(paths[1]), ("Stub annotation for img-1", 0))
+        self.assertIsNone(self.db.get_annotation(paths[2]))
+
+        # Annotated images are left alone, so only the failed image is sent again
+        self.db.update_annotation(paths[0], "Edited by hand")
+        self.db.update_annotation_status(paths[0], True)
+        retry = self.annotator().submit(paths)
+        self.assertEqual((retry["requests"], retry["cached"], retry["annotated"]), (1, 0, 2))
+        self.assertEqual(list(self.db.get_batch_items(retry["batches"][0]).values())[0][0], paths[2])
+        self.assertEqual(self.db.get_annotation(paths[0]), ("Edited by hand", 1))
+
+        # With force the imported answers come from the cache instead of the API
+        self.db.update_batch(retry["batches"][0], "cancelled", imported=True)
+        forced = self.annotator().submit(paths, force=True)
+        self.assertEqual((forced["requests"], forced["cached"], forced["annotated"]), (1, 2, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,17 +1,31 @@
 import os
 import json
+import logging
+import functools
 from PyQt5.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QPushButton, QTextEdit, QLabel, QFileDialog, QMessageBox,
                              QListWidget, QListWidgetItem, QProgressBar, QGroupBox, QComboBox, QDialog,
-                             QRadioButton, QButtonGroup, QLineEdit, QFormLayout)
+                             QRadioButton, QButtonGroup, QLineEdit, QFormLayout, QSpinBox, QCheckBox)
 from PyQt5.QtGui import QPixmap, QColor, QDragEnterEvent, QDropEvent
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
-from database import DatabaseManager
-from annotation import AnnotationManager, available_models
-from config import DEFAULT_PROMPT, COMFY_DEFAULTS
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal
+from database import DatabaseManager, display_name, status_matches
+from annotation import AnnotationManager, available_models, rate_limiter, preprocessor, telemetry
+from config import DEFAULT_PROMPT, COMFY_DEFAULTS, ANNOTATION_CONCURRENCY, ANNOTATION_PACK_SIZE
 from comfy_client import ComfyUIClient
+from caption_sync import sync_caption_files, summary_text
+from annotation_jobs import run_annotation_job, summary_text as job_summary_text
+from generation_jobs import generate_for_approved, event_text, split_image_paths, summary_text as generation_summary_text
 
 SETTINGS_FILE = "comfy_settings.json"
+LIST_PAGE_SIZE = 200
+LIST_ID_ROLE = Qt.ItemDataRole.UserRole + 1
+EXPORT_FILE_FILTERS = {
+    "JSON Lines (*.jsonl)": "jsonl",
+    "Compressed JSON Lines (*.jsonl.gz)": "jsonl.gz",
+    "CSV (*.csv)": "csv",
+    "JSON (*.json)": "json",
+}
+LIST_FILTERS = [("All", "all"), ("New", "new"), ("Approved", "approved"), ("Not Approved", "not_approved")]
 
 
 def load_generation_settings():
@@ -135,12 +149,15 @@ class GenerationSettingsDialog(QDialog):
         self.width_edit = QLineEdit(str(settings.get("width", 512)))
         self.height_edit = QLineEdit(str(settings.get("height", 512)))
         self.steps_edit = QLineEdit(str(settings.get("steps", 20)))
+        self.seed_edit = QLineEdit(str(settings.get("seed", -1)))
+        self.seed_edit.setToolTip("-1 picks a random seed for every image")
 
         form.addRow("Server", self.server_edit)
         form.addRow("Model", self.model_edit)
         form.addRow("Width", self.width_edit)
         form.addRow("Height", self.height_edit)
         form.addRow("Steps", self.steps_edit)
+        form.addRow("Seed", self.seed_edit)
 
         layout.addLayout(form)
         layout.addWidget(QLabel("Workflow JSON:"))
@@ -166,11 +183,13 @@ class GenerationSettingsDialog(QDialog):
             "width": int(self.width_edit.text() or 0),
             "height": int(self.height_edit.text() or 0),
             "steps": int(self.steps_edit.text() or 0),
+            "seed": int(self.seed_edit.text() or -1),
             "workflow": self.workflow_edit.toPlainText(),
         }
 
 
 class GenerateImageThread(QThread):
+    step = pyqtSignal(int, int, str)
     finished = pyqtSignal(str)
     error = pyqtSignal(str)
 
@@ -182,67 +201,192 @@ class GenerateImageThread(QThread):
 
     def run(self):
         try:
-            path = self.client.generate_image(
+            result = self.client.generate_image(
                 self.prompt,
                 self.settings.get("model", ""),
                 self.settings.get("width", 512),
                 self.settings.get("height", 512),
                 self.settings.get("steps", 20),
                 self.settings.get("workflow", ""),
+                self.settings.get("seed", -1),
+                on_event=lambda event: self.step.emit(event.value, event.maximum, event_text(event)),
+                should_stop=self.isInterruptionRequested,
             )
-            self.finished.emit(path)
+            # Показываем первое изображение: workflow может сохранять и другие файлы
+            images, others = split_image_paths([output.path for output in result.outputs])
+            if not images:
+                raise RuntimeError(f"The workflow produced no image; files saved: {', '.join(others) or 'none'}")
+            self.finished.emit(images[0])
+        except Exception as e:
+            self.error.emit(str(e))
+
+class GenerateApprovedThread(QThread):
+    progress = pyqtSignal(int, int)
+    step = pyqtSignal(str)
+    finished = pyqtSignal(str)
+    error = pyqtSignal(str)
+
+    def __init__(self, client: ComfyUIClient, db_manager, settings: dict):
+        super().__init__()
+        self.client = client
+        self.db_manager = db_manager
+        self.settings = settings
+
+    def run(self):
+        try:
+            # Все промпты ставятся в очередь сервера сразу, результаты приходят по мере готовности
+            summary = generate_for_approved(self.db_manager, self.client, self.settings,
+                                            progress=self.progress.emit,
+                                            should_stop=self.isInterruptionRequested,
+                                            on_event=lambda event: self.step.emit(event_text(event)))
+            self.finished.emit(generation_summary_text(summary))
         except Exception as e:
             self.error.emit(str(e))
 
 class SingleAnnotationThread(QThread):
+    partial = pyqtSignal(str)
     finished = pyqtSignal(str)
     error = pyqtSignal(str)
 
-    def __init__(self, annotation_manager, image_path, prompt, model):
+    def __init__(self, annotation_manager, image_path, prompt, model, use_cache=True):
         super().__init__()
         self.annotation_manager = annotation_manager
         self.image_path = image_path
         self.prompt = prompt
         self.model = model
+        self.use_cache = use_cache
 
     def run(self):
         try:
-            annotation = self.annotation_manager.generate_annotation(self.image_path, self.prompt, self.model)
-            self.finished.emit(annotation)
+            deltas = self.annotation_manager.generate_annotation(self.image_path, self.prompt, self.model,
+                                                                 use_cache=self.use_cache, stream=True)
+            # Текст показывается по мере генерации, сохраняется один раз в конце
+            text = ""
+            for delta in deltas:
+                text += delta
+                self.partial.emit(text)
+            self.finished.emit(text.strip())
         except Exception as e:
             self.error.emit(str(e))
 
 class AnnotationThread(QThread):
     progress = pyqtSignal(int, int, int)
-    finished = pyqtSignal()
+    finished = pyqtSignal(str)
     error = pyqtSignal(str)
+    image_error = pyqtSignal(str)
 
-    def __init__(self, folder_path, prompt, model, db_manager, annotation_manager):
+    def __init__(self, folder_path, prompt, model, db_manager, annotation_manager,
+                 concurrency=ANNOTATION_CONCURRENCY, use_cache=True, force=False, failed_only=False,
+                 pack_size=ANNOTATION_PACK_SIZE):
         super().__init__()
         self.folder_path = folder_path
         self.prompt = prompt
         self.model = model
         self.db_manager = db_manager
         self.annotation_manager = annotation_manager
+        self.concurrency = concurrency
+        self.use_cache = use_cache
+        self.force = force
+        self.failed_only = failed_only
+        self.pack_size = pack_size
+
+    def run(self):
+        try:
+            image_files = [f for f in os.listdir(self.folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
+            image_paths = [os.path.join(self.folder_path, f) for f in image_files]
+            generate = functools.partial(self.annotation_manager.generate_annotation, use_cache=self.use_cache)
+            generate_many = functools.partial(self.annotation_manager.generate_annotations, use_cache=self.use_cache)
+
+            # Задание сохраняется в базе: после сбоя или остановки оно продолжится с того же места
+            summary = run_annotation_job(
+                self.db_manager,
+                image_paths,
+                self.prompt,
+                self.model,
+                generate,
+                source=os.path.abspath(self.folder_path),
+                concurrency=self.concurrency,
+                force=self.force,
+                failed_only=self.failed_only,
+                generate_many=generate_many,
+                pack_size=self.pack_size,
+                limiter=rate_limiter,
+                preprocessor=preprocessor,
+                telemetry=telemetry,
+                progress=lambda done, total: self.progress.emit(done, total, int(done * 100 / total)),
+                should_stop=self.isInterruptionRequested,
+                on_error=lambda result: self.image_error.emit(
+                    f"Error annotating {os.path.basename(result.image_path)}: {result.error}"),
+            )
+
+            self.finished.emit(job_summary_text(summary))
+        except Exception as e:
+            self.error.emit(str(e))
+
+class CaptionSyncThread(QThread):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(dict)
+    error = pyqtSignal(str)
+
+    def __init__(self, db_manager, delete_orphans):
+        super().__init__()
+        self.db_manager = db_manager
+        self.delete_orphans = delete_orphans
 
     def run(self):
-        image_files = [f for f in os.listdir(self.folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
-        total_files = len(image_files)
+        try:
+            summary = sync_caption_files(self.db_manager, delete_orphans=self.delete_orphans,
+                                         progress=self.progress.emit)
+            self.finished.emit(summary)
+        except Exception as e:
+            self.error.emit(str(e))
 
-        for i, image_file in enumerate(image_files, start=1):
-            try:
-                image_path = os.path.join(self.folder_path, image_file)
-                annotation = self.annotation_manager.generate_annotation(image_path, self.prompt, self.model)
-                # Используем правильный метод для вставки аннотации
-                self.db_manager.insert_or_update_annotation(image_path, annotation)
-                self.progress.emit(i, total_files, int((i / total_files) * 100))
-            except Exception as e:
-                self.error.emit(f"Error annotating {image_file}: {str(e)}")
+class ImportThread(QThread):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(int)
+    error = pyqtSignal(str)
+
+    def __init__(self, file_path, db_manager):
+        super().__init__()
+        self.file_path = file_path
+        self.db_manager = db_manager
+
+    def run(self):
+        def report(rows, bytes_read, total):
+            self.progress.emit(rows, int(bytes_read * 100 / total) if total else 100)
+
+        try:
+            count = self.db_manager.import_file(self.file_path, progress=report)
+            self.finished.emit(count)
+        except Exception as e:
+            self.error.emit(str(e))
+
+class ExportThread(QThread):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(int)
+    error = pyqtSignal(str)
+
+    def __init__(self, file_path, fmt, status, db_manager):
+        super().__init__()
+        self.file_path = file_path
+        self.fmt = fmt
+        self.status = status
+        self.db_manager = db_manager
+
+    def run(self):
+        def report(done, total):
+            self.progress.emit(done, int(done * 100 / total) if total else 100)
 
-        self.finished.emit()
+        try:
+            count = self.db_manager.export_file(self.file_path, self.fmt, self.status, progress=report)
+            self.finished.emit(count)
+        except Exception as e:
+            self.error.emit(str(e))
 
 #Functional
 class ImageAnnotationApp(QMainWindow):
+    models_refreshed = pyqtSignal(list)
+
     def __init__(self):
         super().__init__()
         self.db_manager = DatabaseManager()
@@ -263,7 +407,9 @@ class ImageAnnotationApp(QMainWindow):
         model_layout = QHBoxLayout()
         model_layout.addWidget(QLabel("LLM Model:"))
         self.model_combo = QComboBox()
-        models = available_models() or ["gpt-4-turbo"]
+        # Список моделей берётся из кэша; устаревший кэш обновляется в фоне
+        self.models_refreshed.connect(self.update_model_list)
+        models = available_models(on_refresh=self.models_refreshed.emit) or ["gpt-4-turbo"]
         self.model_combo.addItems(models)
         self.model_combo.setFixedWidth(200)
         model_layout.addWidget(self.model_combo)
@@ -298,10 +444,41 @@ class ImageAnnotationApp(QMainWindow):
         self.folder_annotate_button.clicked.connect(self.annotate_folder)
         llm_layout.addWidget(self.folder_annotate_button)
 
+        self.concurrency_spin = QSpinBox()
+        self.concurrency_spin.setRange(1, 32)
+        self.concurrency_spin.setValue(ANNOTATION_CONCURRENCY)
+        self.concurrency_spin.setToolTip("Parallel requests")
+        llm_layout.addWidget(self.concurrency_spin)
+
+        self.pack_size_spin = QSpinBox()
+        self.pack_size_spin.setRange(1, 10)
+        self.pack_size_spin.setValue(ANNOTATION_PACK_SIZE)
+        self.pack_size_spin.setToolTip("Images per request")
+        llm_layout.addWidget(self.pack_size_spin)
+
+        self.bypass_cache_check = QCheckBox("Bypass cache")
+        self.bypass_cache_check.setToolTip("Request fresh annotations instead of reusing cached ones")
+        llm_layout.addWidget(self.bypass_cache_check)
+
+        self.force_check = QCheckBox("Re-annotate existing")
+        self.force_check.setToolTip("Also annotate images that already have text")
+        llm_layout.addWidget(self.force_check)
+
+        self.retry_failed_button = QPushButton("Retry Failed")
+        self.retry_failed_button.setToolTip("Re-run only the images that failed in the last folder run")
+        self.retry_failed_button.setEnabled(False)
+        self.retry_failed_button.clicked.connect(self.retry_failed)
+        llm_layout.addWidget(self.retry_failed_button)
+
         self.generate_button = QPushButton("Generate")
         self.generate_button.clicked.connect(self.generate_image)
         generate_layout.addWidget(self.generate_button)
 
+        self.generate_approved_button = QPushButton("Generate All Approved")
+        self.generate_approved_button.setToolTip("Generate an image for every approved annotation")
+        self.generate_approved_button.clicked.connect(self.generate_approved)
+        generate_layout.addWidget(self.generate_approved_button)
+
         self.gen_settings_button = QPushButton("Generation Settings")
         self.gen_settings_button.clicked.connect(self.open_generation_settings)
         generate_layout.addWidget(self.gen_settings_button)
@@ -403,9 +580,24 @@ class ImageAnnotationApp(QMainWindow):
         content_layout.addLayout(left_layout, 2)
 
         right_layout = QVBoxLayout()
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("Search annotations...")
+        # Небольшая задержка, чтобы не искать на каждое нажатие клавиши
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(250)
+        self.search_timer.timeout.connect(self.load_annotations)
+        self.search_edit.textChanged.connect(self.search_timer.start)
+        self.list_filter_combo = QComboBox()
+        for label, status in LIST_FILTERS:
+            self.list_filter_combo.addItem(label, status)
+        self.list_filter_combo.currentIndexChanged.connect(self.load_annotations)
         self.annotation_list = QListWidget()
         self.annotation_list.itemClicked.connect(self.load_selected_annotation)
+        self.annotation_list.verticalScrollBar().valueChanged.connect(self.annotation_list_scrolled)
         right_layout.addWidget(QLabel("Saved Annotations:"))
+        right_layout.addWidget(self.search_edit)
+        right_layout.addWidget(self.list_filter_combo)
         right_layout.addWidget(self.annotation_list)
 
         content_layout.addLayout(right_layout, 1)
@@ -416,6 +608,21 @@ class ImageAnnotationApp(QMainWindow):
 
         self.set_dark_theme()
 
+    def closeEvent(self, event):
+        # Останавливаем пакетную аннотацию, чтобы буфер записи успел сохраниться
+        thread = getattr(self, 'annotation_thread', None)
+        if isinstance(thread, AnnotationThread) and thread.isRunning():
+            thread.requestInterruption()
+            thread.wait()
+        # Незавершённые задания отменяются на сервере ComfyUI
+        for name in ('gen_thread', 'gen_approved_thread'):
+            gen_thread = getattr(self, name, None)
+            if gen_thread is not None and gen_thread.isRunning():
+                gen_thread.requestInterruption()
+                gen_thread.wait()
+        self.comfy_client.close()
+        super().closeEvent(event)
+
     def set_dark_theme(self):
         self.setStyleSheet("""
             QMainWindow, QWidget {
@@ -481,7 +688,7 @@ class ImageAnnotationApp(QMainWindow):
         if reply == QMessageBox.StandardButton.Yes:
             try:
                 self.db_manager.approve_all_annotations()
-                self.load_annotations()  # Обновляем список аннотаций
+                self.sync_annotations()  # Обновляем список аннотаций
                 QMessageBox.information(self, "Success", "All annotations have been approved!")
             except Exception as e:
                 QMessageBox.warning(self, "Error", f"Failed to approve all annotations: {str(e)}")
@@ -547,27 +754,48 @@ class ImageAnnotationApp(QMainWindow):
         self.not_approve_button.setText("Not Approved" if not is_approved else "Mark as Not Approved")
 
     def generate_text_files(self):
-        approved_annotations = self.db_manager.get_approved_annotations()
-        if not approved_annotations:
-            QMessageBox.information(self, "Info", "No approved annotations found.")
+        reply = QMessageBox.question(
+            self, "Generate Text Files",
+            "Also remove text files of annotations that are no longer approved?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No | QMessageBox.StandardButton.Cancel,
+            QMessageBox.StandardButton.No
+        )
+        if reply == QMessageBox.StandardButton.Cancel:
             return
 
-        success_count = 0
-        for image_path, annotation in approved_annotations:
-            try:
-                text_file_path = os.path.splitext(image_path)[0] + '.txt'
-                with open(text_file_path, 'w', encoding='utf-8') as f:
-                    f.write(annotation)
-                success_count += 1
-            except Exception as e:
-                print(f"Error creating text file for {image_path}: {str(e)}")
+        self.progress_bar.setVisible(True)
+        self.progress_label.setVisible(True)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0)
+        self.progress_label.setText("Writing text files...")
+        self.generate_text_files_button.setEnabled(False)
+
+        self.caption_thread = CaptionSyncThread(self.db_manager, reply == QMessageBox.StandardButton.Yes)
+        self.caption_thread.progress.connect(self.update_caption_progress)
+        self.caption_thread.finished.connect(self.text_files_finished)
+        self.caption_thread.error.connect(self.text_files_error)
+        self.caption_thread.start()
+
+    def update_caption_progress(self, done, total):
+        self.progress_bar.setValue(int(done * 100 / total) if total else 100)
+        self.progress_label.setText(f"Writing text files {done}/{total}")
+
+    def text_files_finished(self, summary):
+        self.progress_bar.setVisible(False)
+        self.progress_label.setVisible(False)
+        self.generate_text_files_button.setEnabled(True)
+        QMessageBox.information(self, "Success", summary_text(summary))
 
-        QMessageBox.information(self, "Success", f"Created {success_count} text files for approved annotations.")
+    def text_files_error(self, error_message):
+        self.progress_bar.setVisible(False)
+        self.progress_label.setVisible(False)
+        self.generate_text_files_button.setEnabled(True)
+        QMessageBox.warning(self, "Error", f"Failed to generate text files: {error_message}")
 
     def approve_annotation(self):
         if hasattr(self, 'current_image'):
             self.db_manager.update_annotation_status(self.current_image, True)
-            self.load_annotations()
+            self.sync_annotations()
             self.update_approval_buttons(True)
             QMessageBox.information(self, "Success", "Annotation approved successfully!")
         else:
@@ -582,35 +810,100 @@ class ImageAnnotationApp(QMainWindow):
     def not_approve_annotation(self):
         if hasattr(self, 'current_image'):
             self.db_manager.update_annotation_status(self.current_image, False)
-            self.load_annotations()
+            self.sync_annotations()
             self.update_approval_buttons(False)
             QMessageBox.information(self, "Success", "Annotation marked as not approved!")
         else:
             QMessageBox.warning(self, "Error", "Please load an image first.")
 
     def load_annotations(self):
+        """Reset the list and load its first page; further pages load on scroll."""
         self.annotation_list.clear()
-        annotations = self.db_manager.get_all_annotations()
-        for row in annotations:
-            image_path, annotation, is_new, is_approved = row
-            item = QListWidgetItem(os.path.basename(image_path))
-            if is_approved:
-                item.setBackground(QColor(0, 100, 0))
-                item.setForeground(QColor(255, 255, 255))
-            elif is_new:
-                item.setBackground(QColor(100, 100, 0))
-                item.setForeground(QColor(255, 255, 255))
+        self.list_items = {}
+        self.list_last_id = 0
+        self.list_exhausted = False
+        self.list_revision = self.db_manager.current_revision()
+        self.load_more_annotations()
+
+    def sync_annotations(self):
+        """Apply only the rows changed since the list was loaded or last synced."""
+        revision, changes = self.db_manager.changes_since(self.list_revision)
+        if changes is None or (changes and self.search_edit.text().strip()):
+            # Ранжирование результатов поиска могло измениться - ищем заново
+            self.load_annotations()
+            return
+        self.list_revision = revision
+        status = self.list_filter_combo.currentData()
+        for image_path, row in changes.items():
+            old_item = self.list_items.pop(image_path, None)
+            if old_item is not None:
+                self.annotation_list.takeItem(self.annotation_list.row(old_item))
+            if row is None or not status_matches(status, row[2], row[3]):
+                continue
+            row_id = row[0]
+            if row_id > self.list_last_id and not self.list_exhausted:
+                continue  # Попадёт в список при подгрузке следующей страницы
+            self.insert_list_item(row_id, self.make_list_item(*row[1:]))
+            self.list_last_id = max(self.list_last_id, row_id)
+
+    def insert_list_item(self, row_id, item):
+        """Insert ``item`` keeping the list ordered by row id."""
+        item.setData(LIST_ID_ROLE, row_id)
+        low, high = 0, self.annotation_list.count()
+        while low < high:
+            mid = (low + high) // 2
+            if self.annotation_list.item(mid).data(LIST_ID_ROLE) < row_id:
+                low = mid + 1
             else:
-                item.setBackground(QColor(40, 40, 40))
-                item.setForeground(QColor(200, 200, 200))
-
-            status = " [Approved]" if is_approved else " [Not Approved]" if not is_new else " [New]"
-            item.setText(os.path.basename(image_path) + status)
+                high = mid
+        self.annotation_list.insertItem(low, item)
+        self.list_items[item.data(Qt.ItemDataRole.UserRole)] = item
 
+    def load_more_annotations(self):
+        if self.list_exhausted:
+            return
+        search = self.search_edit.text().strip()
+        status = self.list_filter_combo.currentData()
+        if search:
+            # Результаты поиска: одна страница лучших совпадений по рангу
+            rows = self.db_manager.search_annotations(search, status, LIST_PAGE_SIZE)
+        else:
+            rows = self.db_manager.list_annotations(self.list_last_id, LIST_PAGE_SIZE, status)
+        for row_id, image_path, is_new, is_approved, ambiguous in rows:
+            item = self.make_list_item(image_path, is_new, is_approved, ambiguous)
+            item.setData(LIST_ID_ROLE, row_id)
             self.annotation_list.addItem(item)
+            self.list_items[image_path] = item
+        if rows:
+            self.list_last_id = rows[-1][0]
+        self.list_exhausted = bool(search) or len(rows) < LIST_PAGE_SIZE
+
+    def annotation_list_scrolled(self, value):
+        # Подгружаем следующую страницу, когда список прокручен почти до конца
+        if value >= self.annotation_list.verticalScrollBar().maximum() - 5:
+            self.load_more_annotations()
+
+    def make_list_item(self, image_path, is_new, is_approved, ambiguous=False):
+        name = display_name(image_path, ambiguous)
+        item = QListWidgetItem()
+        item.setData(Qt.ItemDataRole.UserRole, image_path)
+        item.setToolTip(image_path)
+        if is_approved:
+            item.setBackground(QColor(0, 100, 0))
+            item.setForeground(QColor(255, 255, 255))
+        elif is_new:
+            item.setBackground(QColor(100, 100, 0))
+            item.setForeground(QColor(255, 255, 255))
+        else:
+            item.setBackground(QColor(40, 40, 40))
+            item.setForeground(QColor(200, 200, 200))
+
+        status = " [Approved]" if is_approved else " [Not Approved]" if not is_new else " [New]"
+        item.setText(name + status)
+        return item
 
     def load_selected_annotation(self, item):
-        image_name = item.text().split(" [")[0]  # Получаем имя файла без статуса
+        image_name = item.data(Qt.ItemDataRole.UserRole)  # Полный путь, сохранённый в элементе списка
         result = self.db_manager.get_annotation_by_filename(image_name)
         if result:
             annotation, is_approved, image_path = result
@@ -654,7 +947,7 @@ class ImageAnnotationApp(QMainWindow):
             new_annotation = self.annotation_text.toPlainText()
             success = self.db_manager.update_annotation(self.current_image, new_annotation)
             if success:
-                self.load_annotations()
+                self.sync_annotations()
                 QMessageBox.information(self, "Success", "Changes saved successfully!")
             else:
                 QMessageBox.warning(self, "Error", "Failed to save changes. Please try again.")
@@ -666,7 +959,7 @@ class ImageAnnotationApp(QMainWindow):
             annotation = self.annotation_text.toPlainText()
             success = self.db_manager.insert_or_update_annotation(self.current_image, annotation)
             if success:
-                self.load_annotations()
+                self.sync_annotations()
                 QMessageBox.information(self, "Success", "Annotation saved successfully!")
             else:
                 QMessageBox.warning(self, "Error", "Failed to save annotation. Please try again.")
@@ -684,6 +977,13 @@ class ImageAnnotationApp(QMainWindow):
                 self.annotation_text.clear()
                 self.update_approval_buttons(False)
 
+    def update_model_list(self, models):
+        current = self.model_combo.currentText()
+        self.model_combo.clear()
+        self.model_combo.addItems(models)
+        if current in models:
+            self.model_combo.setCurrentText(current)
+
     def auto_annotate(self):
         if hasattr(self, 'current_image'):
             prompt_dialog = PromptDialog(self)
@@ -701,7 +1001,8 @@ class ImageAnnotationApp(QMainWindow):
                 self.auto_annotate_button.setEnabled(False)
 
                 self.annotation_thread = SingleAnnotationThread(self.annotation_manager, self.current_image, prompt,
-                                                                model)
+                                                                model, not self.bypass_cache_check.isChecked())
+                self.annotation_thread.partial.connect(self.annotation_text.setText)
                 self.annotation_thread.finished.connect(self.annotation_finished)
                 self.annotation_thread.error.connect(self.annotation_error)
                 self.annotation_thread.start()
@@ -741,41 +1042,62 @@ class ImageAnnotationApp(QMainWindow):
                 if not prompt:
                     prompt = DEFAULT_PROMPT
 
-                self.progress_bar.setVisible(True)
-                self.progress_label.setVisible(True)
-                self.folder_annotate_button.setEnabled(False)
-                self.progress_bar.setValue(0)
-                self.progress_label.setText("Preparing to annotate...")
-
-                self.annotation_thread = AnnotationThread(
-                    folder_path,
-                    prompt,
-                    self.model_combo.currentText(),
-                    self.db_manager,
-                    self.annotation_manager
-                )
-                self.annotation_thread.progress.connect(self.update_progress)
-                self.annotation_thread.finished.connect(self.folder_annotation_finished)
-                self.annotation_thread.error.connect(self.folder_annotation_error)
-                self.annotation_thread.start()
+                self.last_folder_run = (folder_path, prompt, self.model_combo.currentText())
+                self.start_folder_annotation(folder_path, prompt, self.model_combo.currentText())
+
+    def retry_failed(self):
+        if getattr(self, 'last_folder_run', None):
+            self.start_folder_annotation(*self.last_folder_run, failed_only=True)
+
+    def start_folder_annotation(self, folder_path, prompt, model, failed_only=False):
+        self.progress_bar.setVisible(True)
+        self.progress_label.setVisible(True)
+        self.folder_annotate_button.setEnabled(False)
+        self.retry_failed_button.setEnabled(False)
+        self.progress_bar.setValue(0)
+        self.progress_label.setText("Preparing to annotate...")
+
+        self.annotation_thread = AnnotationThread(
+            folder_path,
+            prompt,
+            model,
+            self.db_manager,
+            self.annotation_manager,
+            self.concurrency_spin.value(),
+            not self.bypass_cache_check.isChecked(),
+            self.force_check.isChecked(),
+            failed_only,
+            self.pack_size_spin.value()
+        )
+        self.annotation_thread.progress.connect(self.update_progress)
+        self.annotation_thread.finished.connect(self.folder_annotation_finished)
+        self.annotation_thread.error.connect(self.folder_annotation_error)
+        self.annotation_thread.image_error.connect(self.folder_image_error)
+        self.annotation_thread.start()
 
     def update_progress(self, current, total, percentage):
         self.progress_bar.setValue(percentage)
         self.progress_label.setText(f"Annotating image {current} of {total}")
 
-    def folder_annotation_finished(self):
+    def folder_annotation_finished(self, summary):
         self.progress_bar.setVisible(False)
         self.progress_label.setVisible(False)
         self.folder_annotate_button.setEnabled(True)
-        self.load_annotations()
-        QMessageBox.information(self, "Success", "Folder annotation completed!")
+        self.retry_failed_button.setEnabled(True)
+        self.sync_annotations()
+        QMessageBox.information(self, "Success", f"Folder annotation completed!\n{summary}")
+
+    def folder_image_error(self, error_message):
+        # Ошибка одного изображения не прерывает задание: оно попадёт в итоговую сводку
+        logging.error(error_message)
 
     def folder_annotation_error(self, error_message):
         print(f"Annotation error: {error_message}")  # Для отладки
         self.progress_bar.setVisible(False)
         self.progress_label.setVisible(False)
         self.folder_annotate_button.setEnabled(True)
-        QMessageBox.warning(self, "Error", error_message)
+        self.retry_failed_button.setEnabled(True)
+        QMessageBox.warning(self, "Error", f"Folder annotation failed: {error_message}")
 
     def clear_database(self):
         reply = QMessageBox.question(self, 'Clear Database',
@@ -793,27 +1115,76 @@ class ImageAnnotationApp(QMainWindow):
             QMessageBox.information(self, "Success", "Database cleared successfully!")
 
     def export_database(self):
-        file_path, _ = QFileDialog.getSaveFileName(self, "Export Database", "", "JSON Files (*.json)")
+        file_path, selected_filter = QFileDialog.getSaveFileName(self, "Export Database", "",
+                                                                 ";;".join(EXPORT_FILE_FILTERS))
         if file_path:
-            try:
-                data = self.db_manager.get_all_annotations()
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump([list(item) for item in data], f, ensure_ascii=False, indent=4)
-                QMessageBox.information(self, "Success", "Database exported successfully!")
-            except Exception as e:
-                QMessageBox.warning(self, "Error", f"Failed to export database: {str(e)}")
+            fmt = EXPORT_FILE_FILTERS.get(selected_filter)
+            if fmt and not file_path.lower().endswith("." + fmt):
+                file_path += "." + fmt
+            self.progress_bar.setVisible(True)
+            self.progress_label.setVisible(True)
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(0)
+            self.progress_label.setText("Exporting database...")
+            self.export_db_button.setEnabled(False)
+
+            # Экспортируем те же записи, что показаны в списке (фильтр по статусу)
+            self.export_thread = ExportThread(file_path, fmt, self.list_filter_combo.currentData(),
+                                              self.db_manager)
+            self.export_thread.progress.connect(self.update_export_progress)
+            self.export_thread.finished.connect(self.export_finished)
+            self.export_thread.error.connect(self.export_error)
+            self.export_thread.start()
+
+    def update_export_progress(self, rows, percentage):
+        self.progress_bar.setValue(percentage)
+        self.progress_label.setText(f"Exported {rows} rows")
+
+    def export_finished(self, count):
+        self.progress_bar.setVisible(False)
+        self.progress_label.setVisible(False)
+        self.export_db_button.setEnabled(True)
+        QMessageBox.information(self, "Success", f"Database exported successfully! ({count} rows)")
+
+    def export_error(self, error_message):
+        self.progress_bar.setVisible(False)
+        self.progress_label.setVisible(False)
+        self.export_db_button.setEnabled(True)
+        QMessageBox.warning(self, "Error", f"Failed to export database: {error_message}")
 
     def import_database(self):
-        file_path, _ = QFileDialog.getOpenFileName(self, "Import Database", "", "JSON Files (*.json)")
+        file_path, _ = QFileDialog.getOpenFileName(self, "Import Database", "",
+                                                   "Exports (*.json *.jsonl *.jsonl.gz *.csv)")
         if file_path:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                self.db_manager.import_annotations(data)
-                self.load_annotations()  # Обновляем список аннотаций в интерфейсе
-                QMessageBox.information(self, "Success", "Database imported successfully!")
-            except Exception as e:
-                QMessageBox.warning(self, "Error", f"Failed to import database: {str(e)}")
+            self.progress_bar.setVisible(True)
+            self.progress_label.setVisible(True)
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(0)
+            self.progress_label.setText("Importing database...")
+            self.import_db_button.setEnabled(False)
+
+            self.import_thread = ImportThread(file_path, self.db_manager)
+            self.import_thread.progress.connect(self.update_import_progress)
+            self.import_thread.finished.connect(self.import_finished)
+            self.import_thread.error.connect(self.import_error)
+            self.import_thread.start()
+
+    def update_import_progress(self, rows, percentage):
+        self.progress_bar.setValue(percentage)
+        self.progress_label.setText(f"Imported {rows} rows")
+
+    def import_finished(self, count):
+        self.progress_bar.setVisible(False)
+        self.progress_label.setVisible(False)
+        self.import_db_button.setEnabled(True)
+        self.sync_annotations()  # Обновляем список аннотаций в интерфейсе
+        QMessageBox.information(self, "Success", f"Database imported successfully! ({count} rows)")
+
+    def import_error(self, error_message):
+        self.progress_bar.setVisible(False)
+        self.progress_label.setVisible(False)
+        self.import_db_button.setEnabled(True)
+        QMessageBox.warning(self, "Error", f"Failed to import database: {error_message}")
 
     def delete_annotation(self):
         if hasattr(self, 'current_image'):
@@ -824,7 +1195,7 @@ class ImageAnnotationApp(QMainWindow):
 
             if reply == QMessageBox.StandardButton.Yes:
                 self.db_manager.delete_annotation(self.current_image)
-                self.load_annotations()
+                self.sync_annotations()
                 self.annotation_text.clear()
                 QMessageBox.information(self, "Success", "Annotation deleted successfully!")
         else:
@@ -846,6 +1217,13 @@ class ImageAnnotationApp(QMainWindow):
             self.comfy_client.set_server(self.generation_settings.get("server", ""))
 
     def generate_image(self):
+        # Во время генерации кнопка отменяет задание на сервере
+        thread = getattr(self, 'gen_thread', None)
+        if thread is not None and thread.isRunning():
+            thread.requestInterruption()
+            self.generate_button.setEnabled(False)
+            return
+
         prompt = self.annotation_text.toPlainText().strip()
         if not prompt:
             QMessageBox.warning(self, "Error", "No annotation text to generate.")
@@ -855,17 +1233,28 @@ class ImageAnnotationApp(QMainWindow):
         self.progress_label.setVisible(True)
         self.progress_bar.setRange(0, 0)
         self.progress_label.setText("Generating image...")
-        self.generate_button.setEnabled(False)
+        self.generate_button.setText("Cancel")
 
         self.gen_thread = GenerateImageThread(self.comfy_client, prompt, self.generation_settings)
+        self.gen_thread.step.connect(self.update_generation_step)
         self.gen_thread.finished.connect(self.show_generated_image)
         self.gen_thread.error.connect(self.generate_error)
         self.gen_thread.start()
 
-    def show_generated_image(self, path: str):
+    def update_generation_step(self, value, maximum, text):
+        if maximum:
+            self.progress_bar.setRange(0, maximum)
+            self.progress_bar.setValue(value)
+        self.progress_label.setText(f"Generating image: {text}")
+
+    def _reset_generate_button(self):
         self.progress_bar.setVisible(False)
         self.progress_label.setVisible(False)
+        self.generate_button.setText("Generate")
         self.generate_button.setEnabled(True)
+
+    def show_generated_image(self, path: str):
+        self._reset_generate_button()
         dlg = QDialog(self)
         dlg.setWindowTitle("Generated Image")
         layout = QVBoxLayout(dlg)
@@ -875,9 +1264,54 @@ class ImageAnnotationApp(QMainWindow):
         layout.addWidget(label)
         dlg.exec()
 
-    def generate_error(self, msg: str):
+    def generate_approved(self):
+        # Повторное нажатие во время генерации останавливает её
+        thread = getattr(self, 'gen_approved_thread', None)
+        if thread is not None and thread.isRunning():
+            thread.requestInterruption()
+            self.generate_approved_button.setEnabled(False)
+            return
+
+        self.progress_bar.setVisible(True)
+        self.progress_label.setVisible(True)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0)
+        self.progress_label.setText("Generating images...")
+        self.generation_progress = (0, 0)
+        self.generate_approved_button.setText("Stop Generating")
+
+        self.gen_approved_thread = GenerateApprovedThread(self.comfy_client, self.db_manager,
+                                                          dict(self.generation_settings))
+        self.gen_approved_thread.progress.connect(self.update_generation_progress)
+        self.gen_approved_thread.step.connect(self.update_approved_step)
+        self.gen_approved_thread.finished.connect(self.generate_approved_finished)
+        self.gen_approved_thread.error.connect(self.generate_approved_error)
+        self.gen_approved_thread.start()
+
+    def update_generation_progress(self, done, total):
+        self.generation_progress = (done, total)
+        self.progress_bar.setValue(int(done * 100 / total) if total else 100)
+        self.progress_label.setText(f"Generated {done}/{total}")
+
+    def update_approved_step(self, text):
+        done, total = getattr(self, 'generation_progress', (0, 0))
+        self.progress_label.setText(f"Generated {done}/{total} - {text}")
+
+    def _reset_generate_approved(self):
         self.progress_bar.setVisible(False)
         self.progress_label.setVisible(False)
-        self.generate_button.setEnabled(True)
+        self.generate_approved_button.setText("Generate All Approved")
+        self.generate_approved_button.setEnabled(True)
+
+    def generate_approved_finished(self, summary):
+        self._reset_generate_approved()
+        QMessageBox.information(self, "Image Generation", summary)
+
+    def generate_approved_error(self, msg: str):
+        self._reset_generate_approved()
+        QMessageBox.warning(self, "Error", f"Failed to generate images: {msg}")
+
+    def generate_error(self, msg: str):
+        self._reset_generate_button()
         QMessageBox.warning(self, "Error", f"Failed to generate image: {msg}")
 
@@ -0,0 +1,144 @@
+import json
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from config import COMFY_WORKFLOW_NODES
+
+# Parameters a template can set, with the (class_type, input) pairs they are
+# found at in API-format workflows
+PARAMETER_INPUTS = {
+    "model": [("CheckpointLoaderSimple", "ckpt_name"), ("CheckpointLoader", "ckpt_name"),
+              ("UNETLoader", "unet_name")],
+    "width": [("EmptyLatentImage", "width"), ("EmptySD3LatentImage", "width")],
+    "height": [("EmptyLatentImage", "height"), ("EmptySD3LatentImage", "height")],
+    "steps": [("KSampler", "steps"), ("KSamplerAdvanced", "steps"), ("BasicScheduler", "steps")],
+    "seed": [("KSampler", "seed"), ("KSamplerAdvanced", "noise_seed"), ("RandomNoise", "noise_seed")],
+}
+SAMPLER_TYPES = ("KSampler", "KSamplerAdvanced", "CFGGuider", "BasicGuider")
+# Text encoders and the inputs the prompt is written to
+PROMPT_INPUTS = {
+    "CLIPTextEncode": ("text",),
+    "CLIPTextEncodeFlux": ("clip_l", "t5xxl"),
+}
+TEXT_ENCODER_TYPES = tuple(PROMPT_INPUTS)
+MAX_SEED = 2 ** 32
+
+TEMPLATE_CACHE_SIZE = 32
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def _positive_prompt_nodes(graph):
+    """Text encoders feeding the positive input of a sampler or guider."""
+    found = []
+    for node in graph.values():
+        if node.get("class_type") not in SAMPLER_TYPES:
+            continue
+        inputs = node.get("inputs", {})
+        link = inputs.get("positive", inputs.get("conditioning"))
+        # Links are [source_node_id, output_index]
+        if isinstance(link, list) and link and str(link[0]) in graph:
+            source = str(link[0])
+            if graph[source].get("class_type") in TEXT_ENCODER_TYPES and source not in found:
+                found.append(source)
+    return found
+
+
+def find_targets(graph: dict, node_map=None) -> dict:
+    """Map each parameter to the ``(node_id, input)`` pairs it is written to.
+
+    ``node_map`` (``{"prompt": ["6", "text"], ...}``) overrides discovery
+    for workflows whose nodes cannot be recognised by class type. The text
+    prompt goes to the encoder linked to the sampler's positive input, or to
+    the only text encoder of the workflow - into every text input the
+    encoder has (``clip_l`` and ``t5xxl`` for Flux).
+    """
+    if not isinstance(graph, dict) or isinstance(graph.get("nodes"), list):
+        raise ValueError("Workflow is not in the API format; export it with \"Save (API Format)\"")
+    graph = {node_id: node for node_id, node in graph.items() if isinstance(node, dict)}
+    targets = {}
+    for parameter, candidates in PARAMETER_INPUTS.items():
+        targets[parameter] = [(node_id, input_name) for node_id, node in graph.items()
+                              for class_type, input_name in candidates
+                              if node.get("class_type") == class_type and input_name in node.get("inputs", {})]
+
+    prompt_nodes = _positive_prompt_nodes(graph)
+    if not prompt_nodes:
+        encoders = [node_id for node_id, node in graph.items()
+                    if node.get("class_type") in TEXT_ENCODER_TYPES]
+        prompt_nodes = encoders if len(encoders) == 1 else []
+    targets["prompt"] = [(node_id, input_name) for node_id in prompt_nodes
+                         for input_name in PROMPT_INPUTS[graph[node_id]["class_type"]]]
+
+    for parameter, (node_id, input_name) in (node_map or {}).items():
+        node_id = str(node_id)
+        if node_id not in graph:
+            raise ValueError(f"Workflow has no node {node_id} for {parameter}")
+        targets[parameter] = [(node_id, input_name)]
+    return {parameter: pairs for parameter, pairs in targets.items() if pairs}
+
+
+class WorkflowTemplate:
+    """An API-format ComfyUI workflow parsed once and patched per request.
+
+    :meth:`render` copies only the nodes it changes, so producing a prompt
+    graph costs a few dict copies instead of parsing the workflow again.
+    Rendered graphs share the unchanged nodes with the template and must
+    not be modified.
+    """
+
+    def __init__(self, graph: dict, node_map=None):
+        self.graph = graph
+        self.targets = find_targets(graph, node_map)
+        missing = [parameter for parameter in ("prompt", *PARAMETER_INPUTS) if parameter not in self.targets]
+        if graph and missing:
+            logging.info(f"Workflow has no node for {', '.join(missing)}; the workflow's own values are used")
+
+    def render(self, prompt=None, model=None, width=None, height=None, steps=None, seed=None) -> dict:
+        """Return the prompt graph with the given parameters filled in.
+
+        Parameters left as None (or empty) keep the workflow's value. A
+        negative ``seed`` picks a random one.
+        """
+        if seed is not None and int(seed) < 0:
+            seed = random.randrange(MAX_SEED)
+        values = {"prompt": prompt or None, "model": model or None, "width": width or None,
+                  "height": height or None, "steps": steps or None, "seed": seed}
+        graph = dict(self.graph)
+        copied = set()
+        for parameter, value in values.items():
+            if value is None or parameter not in self.targets:
+                continue
+            if parameter != "prompt" and parameter != "model":
+                value = int(value)
+            for node_id, input_name in self.targets[parameter]:
+                if node_id not in copied:
+                    node = dict(graph[node_id])
+                    node["inputs"] = dict(node.get("inputs", {}))
+                    graph[node_id] = node
+                    copied.add(node_id)
+                graph[node_id]["inputs"][input_name] = value
+        return graph
+
+
+def load_template(workflow: str, node_map=None) -> WorkflowTemplate:
+    """Return the :class:`WorkflowTemplate` for the ``workflow`` JSON text.
+
+    Templates are cached by the SHA-256 of the text (and the node map), so
+    the same workflow is only parsed once however often it is used.
+    """
+    node_map = COMFY_WORKFLOW_NODES if node_map is None else node_map
+    key = hashlib.sha256(workflow.encode("utf-8")).hexdigest() + json.dumps(node_map, sort_keys=True)
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is not None:
+            _templates.move_to_end(key)
+            return template
+    template = WorkflowTemplate(json.loads(workflow) if workflow else {}, node_map)
+    with _templates_lock:
+        _templates[key] = template
+        while len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template